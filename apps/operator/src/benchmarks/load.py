@@ -0,0 +1,169 @@
+"""
+Load test of the create handler for a burst of AXIS resources created at once.
+Every event builds the workflow, creates it and updates the status of the resource, against a local stand in for the
+Kubernetes API server that answers every request after a fixed latency.
+
+The blocking handlers are run like they were before: a new CustomObjectsApi (and so a new connection pool) per call,
+on an executor of 5 workers. The async handlers share one pooled client limited to the operator's concurrency,
+and queue their status updates on the status writer, which reads the status of a resource it has not seen before patching it.
+
+Handler throughput and latencies are measured until the handlers return, which is what holds up the next events.
+The queued status updates are written after the merge window of the status writer (STATUS_MERGE_WINDOW), the time until
+the writer has flushed them is reported separately.
+
+Run from the src directory:
+    python3 -m benchmarks.load
+"""
+import time
+import asyncio
+import logging
+import argparse
+import threading
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+import kopf
+import kubernetes
+from aiohttp import web
+from kubernetes_asyncio import client as async_client
+
+from handlers import create, update
+from utilities import jinja, k8s
+from utilities.status import STATUS_MERGE_WINDOW, writer
+from benchmarks.template import TEMPLATE_PATH, values
+
+logger = logging.getLogger('benchmark')
+
+
+def stand_in_api_server(latency: float) -> tuple:
+    """ Starts a stand in for the API server on a thread of its own and returns its url and the counters of the requests it served """
+    served = {'create': 0, 'get': 0, 'patch': 0, 'connections': set()}
+
+    async def create_object(request):
+        served['create'] += 1
+        served['connections'].add(request.transport.get_extra_info('peername'))
+        body = await request.json()
+        await asyncio.sleep(latency)
+        body['metadata']['name'] = body['metadata'].pop('generateName', '') + 'x'
+        return web.json_response(body, status=201)
+
+    async def get_status(request):
+        served['get'] += 1
+        served['connections'].add(request.transport.get_extra_info('peername'))
+        await asyncio.sleep(latency)
+        return web.json_response({'metadata': {'name': request.match_info['name'], 'resourceVersion': '1'}, 'status': {}})
+
+    async def patch_status(request):
+        served['patch'] += 1
+        served['connections'].add(request.transport.get_extra_info('peername'))
+        body = await request.json()
+        await asyncio.sleep(latency)
+        return web.json_response({'metadata': {'name': request.match_info['name'], 'resourceVersion': '2'}, 'status': body['status']})
+
+    app = web.Application()
+    app.router.add_post('/apis/{group}/{version}/namespaces/{namespace}/{plural}', create_object)
+    app.router.add_get('/apis/{group}/{version}/namespaces/{namespace}/{plural}/{name}/status', get_status)
+    app.router.add_patch('/apis/{group}/{version}/namespaces/{namespace}/{plural}/{name}/status', patch_status)
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(app, access_log=None)
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, '127.0.0.1', 0, backlog=1024)
+    loop.run_until_complete(site.start())
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}", served
+
+
+def resource(index: int) -> dict:
+    return {
+        'apiVersion': 'aquakube.io/v1',
+        'kind': 'AXIS',
+        'metadata': {'name': f"axis-{index}", 'namespace': 'axis', 'labels': {}},
+        'spec': values(index, 'steps')['resource']['spec'],
+    }
+
+
+def blocking_event(index: int):
+    """ The create handler and the status patch of a workflow as they were, blocking and with a new API client per call """
+    body = resource(index)
+    workflow = jinja.load_workflow_template().build(**{**values(index, 'steps'), 'resource': body})
+    kubernetes.client.CustomObjectsApi().create_namespaced_custom_object(
+        group="argoproj.io", version="v1alpha1", namespace="argo", plural="workflows", body=workflow,
+    )
+    kubernetes.client.CustomObjectsApi().patch_namespaced_custom_object_status(
+        group="aquakube.io", version="v1", namespace='axis', plural="axis", name=body['metadata']['name'], body={'status': {'phase': 'provisioned'}},
+    )
+
+
+async def async_event(index: int):
+    body = resource(index)
+    await create.workflow(body['metadata']['name'], 'axis', body, logger, kopf.Patch())
+    update.status(namespace='axis', name=body['metadata']['name'], status={'phase': 'provisioned'}, logger=logger)
+
+
+def report(label: str, latencies: list, elapsed: float, flushed: float, served: dict):
+    latencies = sorted(latencies)
+    print(
+        f"{label:<28} {len(latencies) / elapsed:>9.1f}/s {statistics.median(latencies) * 1000:>9.0f}ms "
+        f"{latencies[int(len(latencies) * 0.95) - 1] * 1000:>9.0f}ms {flushed * 1000:>9.0f}ms {len(served['connections']):>12}"
+    )
+
+
+def run_blocking(events: int, workers: int) -> tuple:
+    start_time = time.perf_counter()
+    latencies = []
+
+    def timed(index):
+        blocking_event(index)
+        latencies.append(time.perf_counter() - start_time)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(timed, range(events)))
+    elapsed = time.perf_counter() - start_time
+    # the status is patched by the handler itself, there is nothing left to flush
+    return latencies, elapsed, elapsed
+
+
+async def run_async(url: str, events: int, concurrency: int) -> tuple:
+    configuration = async_client.Configuration(host=url)
+    await k8s.connect(concurrency=concurrency, configuration=configuration)
+    start_time = time.perf_counter()
+
+    async def timed(index):
+        await async_event(index)
+        return time.perf_counter() - start_time
+
+    try:
+        latencies = await asyncio.gather(*(timed(index) for index in range(events)))
+        elapsed = time.perf_counter() - start_time
+        # the status patches are queued, they are written once the merge window has passed
+        await writer().drain()
+        flushed = time.perf_counter() - start_time
+    finally:
+        await k8s.close()
+    return latencies, elapsed, flushed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--events', type=int, default=500, help='AXIS resources created at once')
+    parser.add_argument('--latency', type=float, default=0.02, help='Seconds the stand in API server takes to answer a request')
+    parser.add_argument('--workers', type=int, default=5, help='Executor workers of the blocking handlers')
+    parser.add_argument('--concurrency', type=int, default=k8s.CONCURRENCY, help='Concurrency of the shared async client')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    jinja.workflow_template_path = lambda: TEMPLATE_PATH
+    url, served = stand_in_api_server(args.latency)
+    configuration = kubernetes.client.Configuration()
+    configuration.host = url
+    kubernetes.client.Configuration.set_default(configuration)
+
+    print(f"{args.events} events, API server latency {args.latency * 1000:.0f}ms")
+    print(f"{'handlers':<28} {'throughput':>11} {'p50':>11} {'p95':>11} {'flushed':>11} {'connections':>12}")
+    latencies, elapsed, flushed = run_blocking(args.events, args.workers)
+    report(f"blocking, {args.workers} workers", latencies, elapsed, flushed, served)
+    served['connections'].clear()
+    latencies, elapsed, flushed = asyncio.run(run_async(url, args.events, args.concurrency))
+    report(f"async, concurrency {args.concurrency}", latencies, elapsed, flushed, served)
+    print(f"status updates are flushed {STATUS_MERGE_WINDOW * 1000:.0f}ms (STATUS_MERGE_WINDOW) after they are queued at the earliest")
+    assert served['create'] == served['patch'] == 2 * args.events
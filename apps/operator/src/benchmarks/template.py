@@ -0,0 +1,76 @@
+"""
+Measures the per event cost of building the provisioning Workflow from its template:
+loading the template from scratch (read, compile, render and parse the YAML), rendering a cached compiled template,
+and building the Workflow from a cached pre-parsed skeleton.
+
+Run from the src directory:
+    python3 -m benchmarks.template
+"""
+import os
+import time
+import argparse
+
+import yaml
+from jinja2 import Template, StrictUndefined
+
+from utilities.jinja import TemplateCache
+
+TEMPLATE_PATH = os.path.join(os.path.dirname(__file__), '..', '..', 'kubernetes', 'provision.yaml')
+
+
+def values(index: int, pipeline: str) -> dict:
+    """ Returns the values a create event of the index'th AXIS resource injects into the template """
+    name = f"axis-{index}"
+    return {
+        'name': name,
+        'namespace': 'axis',
+        'pipeline': pipeline,
+        'image': "456087932636.dkr.ecr.us-west-2.amazonaws.com/kube-axis/workflow:1.0.0",
+        'google_webhook': "https://chat.googleapis.com/v1/spaces/example",
+        'slack_webhook': "https://hooks.slack.com/services/example",
+        'firmware_allow_list': "",
+        'firmware_deny_list': "",
+        'lease_service_url': "",
+        'resource': {
+            'apiVersion': 'aquakube.io/v1',
+            'kind': 'AXIS',
+            'metadata': {'name': name, 'namespace': 'axis', 'labels': {'site': 'example'}},
+            'spec': {
+                'workflow': {'version': '1.0.0', 'pipeline': pipeline, 'max_retries': 3, 'retry_delay': 5},
+                'network': {'mac_address': f"00:40:8c:00:{index // 256 % 256:02x}:{index % 256:02x}", 'subnet': '10.0.8.0/22'},
+                'video': {'orientation': 'normal', 'zipstream_strength': 10},
+            },
+        },
+    }
+
+
+def from_scratch(path: str, **values) -> dict:
+    """ What every event did before the cache: read, compile, render and parse """
+    with open(path, 'rt') as f:
+        template = Template(f.read(), undefined=StrictUndefined)
+    return yaml.safe_load(template.render(**values))
+
+
+def benchmark(function, events: int, pipeline: str) -> float:
+    """ Returns the mean time of an event in milliseconds """
+    start_time = time.perf_counter()
+    for index in range(events):
+        function(**values(index, pipeline))
+    return (time.perf_counter() - start_time) / events * 1000
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path', type=str, default=TEMPLATE_PATH)
+    parser.add_argument('--events', type=int, default=500)
+    args = parser.parse_args()
+
+    cache = TemplateCache()
+    print(f"{'pipeline':<10} {'scratch':>10} {'cached':>10} {'skeleton':>10} {'speedup':>8}")
+    for pipeline in ('steps', 'all'):
+        compiled = cache.get(args.path)
+        assert compiled.build(**values(0, pipeline)) == from_scratch(args.path, **values(0, pipeline))
+        scratch = benchmark(lambda **v: from_scratch(args.path, **v), args.events, pipeline)
+        cached = benchmark(lambda **v: cache.get(args.path).render(**v), args.events, pipeline)
+        skeleton = benchmark(lambda **v: cache.get(args.path).build(**v), args.events, pipeline)
+        print(f"{pipeline:<10} {scratch:>8.3f}ms {cached:>8.3f}ms {skeleton:>8.3f}ms {scratch / skeleton:>7.1f}x")
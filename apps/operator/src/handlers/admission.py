@@ -22,12 +22,12 @@ def validate(body, spec, **kwargs):
     """
     # enforcing provision strategy validation
     provision_strategy = spec['workflow']['provision_strategy']
-    if provision_strategy == "resolve_mac_address":
+    if provision_strategy in ("resolve_mac_address", "announced_mac_address"):
         mac_address = spec['network'].get('mac_address')
         subnet = spec['network'].get('subnet')
 
         if mac_address is None or subnet is None:
-            raise kopf.AdmissionError("Must set mac_address and subnet if using 'resolve_mac_address' strategy")
+            raise kopf.AdmissionError(f"Must set mac_address and subnet if using '{provision_strategy}' strategy")
         
         if not is_valid_axis_serial_number(serial_number=mac_address):
             raise kopf.AdmissionError(
@@ -1,31 +1,113 @@
 import os
-import yaml
+import time
 
 import kopf
-from jinja2 import Template
-from kubernetes import client
+from kubernetes_asyncio.client.exceptions import ApiException
 
-from utilities.jinja import load_workflow_template
+from utilities import k8s
+from utilities.axis import spec_hash
+from utilities.jinja import CompiledTemplate, load_workflow_template
 
-def workflow(name, namespace, body, logger, patch):
+# Namespace the provisioning workflows are created in
+WORKFLOW_NAMESPACE = os.getenv("WORKFLOW_NAMESPACE", "argo")
+# Setting this annotation to a new value (e.g a timestamp) launches a workflow even if one was launched for the spec
+FORCE_ANNOTATION = 'axis.aquakube.io/force-provision'
+# Phases in which the workflow launched for the spec hash is in flight or has succeeded
+SETTLED_PHASES = ('provisioning', 'provisioned')
+# Seconds a new spec has to stay unchanged before the in flight workflow is superseded, so a burst of edits launches one workflow
+SUPERSEDE_DEBOUNCE = float(os.getenv("SUPERSEDE_DEBOUNCE", 10))
+# Argo shutdown strategy of a superseded workflow: Terminate stops it at once, Stop lets its exit handler (the notification) run
+SUPERSEDE_STRATEGY = os.getenv("SUPERSEDE_STRATEGY", "Terminate")
+SUPERSEDE_POLL_INTERVAL = 5
+SUPERSEDED_LABEL = 'axis.aquakube.io/superseded'
+FINISHED_WORKFLOW_PHASES = ('Succeeded', 'Failed', 'Error')
+# (namespace, name) -> (spec hash, time it was first seen) of the specs being debounced
+debouncing = {}
+
+
+def is_launched(body, digest) -> bool:
+    """
+    Whether a workflow was already launched for the spec hash and is in flight or has succeeded, and no re-run is forced
+    """
+    status = body.get('status') or {}
+    force = (body['metadata'].get('annotations') or {}).get(FORCE_ANNOTATION)
+    if force and force != status.get('forceToken'):
+        return False
+    return status.get('specHash') == digest and status.get('phase') in SETTLED_PHASES
+
+
+async def supersede(name, namespace, digest, active, logger):
+    """
+    Makes sure the in flight workflow of the axis is stopped before a workflow for a new spec is launched,
+    so the camera only runs one provisioning workflow at a time.
+    The new spec is debounced first, then the stale workflow is labelled as superseded (its outcome is no longer reported
+    on the axis) and shut down. kopf.TemporaryError is raised, and the handler retried with the latest spec,
+    while the spec is debounced and until the stale workflow has stopped.
     """
-    Create a workflow for provisioning
+    key = (namespace, name)
+    seen = debouncing.get(key)
+    if seen is None or seen[0] != digest:
+        seen = debouncing[key] = (digest, time.monotonic())
+    remaining = SUPERSEDE_DEBOUNCE - (time.monotonic() - seen[1])
+    if remaining > 0:
+        raise kopf.TemporaryError(f"Debouncing spec {digest[:12]} for {remaining:.1f}s before superseding workflow {active}", delay=remaining)
+
+    try:
+        stale = await k8s.api().get_custom_object(
+            group="argoproj.io", version="v1alpha1", namespace=WORKFLOW_NAMESPACE, plural="workflows", name=active
+        )
+    except ApiException as e:
+        if e.status != 404:
+            raise
+        stale = None
+
+    if stale is not None:
+        running = (stale.get('status') or {}).get('phase') not in FINISHED_WORKFLOW_PHASES
+        if SUPERSEDED_LABEL not in stale['metadata'].get('labels', {}):
+            logger.info(f"Superseding workflow {active} with a workflow for spec {digest[:12]}")
+            body = {'metadata': {'labels': {SUPERSEDED_LABEL: 'true'}}}
+            if running:
+                body['spec'] = {'shutdown': SUPERSEDE_STRATEGY}
+            await k8s.api().patch_custom_object(
+                group="argoproj.io", version="v1alpha1", namespace=WORKFLOW_NAMESPACE, plural="workflows", name=active, body=body
+            )
+        if running:
+            raise kopf.TemporaryError(f"Waiting for the superseded workflow {active} to stop", delay=SUPERSEDE_POLL_INTERVAL)
+    debouncing.pop(key, None)
+
+
+async def workflow(name, namespace, body, logger, patch):
     """
-    logger.info("Creating workflow")
+    Create a workflow for provisioning, unless one was already launched for the provisioning relevant fields of the spec.
+    A workflow still in flight for a previous spec is superseded first
+    """
+    digest = spec_hash(body['spec'])
+    if is_launched(body, digest):
+        status = body['status']
+        logger.info(f"Workflow {status.get('workflow')} for spec {digest[:12]} is {status['phase']}, not launching another")
+        debouncing.pop((namespace, name), None)
+        return
+
+    status = body.get('status') or {}
+    if status.get('phase') == 'provisioning' and status.get('workflow'):
+        await supersede(name, namespace, digest, status['workflow'], logger)
 
-    api = client.CustomObjectsApi()
+    logger.info(f"Creating workflow for spec {digest[:12]}")
 
-    template: Template = load_workflow_template()
+    template: CompiledTemplate = load_workflow_template()
 
     version = body['spec']['workflow']['version']
 
-    rendered_template = template.render(
+    workflow = template.build(
         name=name,
+        namespace=namespace,
+        pipeline=body['spec']['workflow'].get('pipeline', 'steps'),
         image=f"456087932636.dkr.ecr.us-west-2.amazonaws.com/kube-axis/workflow:{version}",
         google_webhook=os.getenv("GOOGLE_WEBHOOK"),
         slack_webhook=os.getenv("SLACK_WEBHOOK"),
-        firmware_allow_list=os.getenv("FIRMWARE_ALLOW_LIST"),
-        firmware_deny_list=os.getenv("FIRMWARE_DENY_LIST"),
+        firmware_allow_list=os.getenv("FIRMWARE_ALLOW_LIST", ""),
+        firmware_deny_list=os.getenv("FIRMWARE_DENY_LIST", ""),
+        lease_service_url=os.getenv("LEASE_SERVICE_URL", ""),
         resource={
             'apiVersion': body['apiVersion'],
             'kind': body['kind'],
@@ -37,8 +119,10 @@ def workflow(name, namespace, body, logger, patch):
             'spec': body['spec'],
         },
     )
-
-    workflow = yaml.safe_load(rendered_template)
+    workflow['metadata'].setdefault('annotations', {}).update({
+        'axis.aquakube.io/template-version': template.sha256,
+        'axis.aquakube.io/spec-hash': digest,
+    })
 
     kopf.label(
         objs=[workflow],
@@ -53,12 +137,17 @@ def workflow(name, namespace, body, logger, patch):
         nested='spec.template'
     )
 
-    api.create_namespaced_custom_object(
+    created = await k8s.api().create_custom_object(
         group="argoproj.io",
         version="v1alpha1",
-        namespace="argo",
+        namespace=WORKFLOW_NAMESPACE,
         plural="workflows",
         body=workflow,
     )
 
-    patch.status['phase'] = 'provisioning'
\ No newline at end of file
+    patch.status['phase'] = 'provisioning'
+    patch.status['specHash'] = digest
+    patch.status['workflow'] = created['metadata']['name']
+    force = (body['metadata'].get('annotations') or {}).get(FORCE_ANNOTATION)
+    if force:
+        patch.status['forceToken'] = force
\ No newline at end of file
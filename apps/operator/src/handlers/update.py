@@ -1,28 +1,52 @@
-from kubernetes import client
-from kubernetes.client.exceptions import ApiException
+from utilities.status import writer
+
+# Condition type of the AXIS resource reported for each step template of the workflow
+STEP_CONDITIONS = {
+    'axis-discover': 'Discovered',
+    'axis-provision': 'Provisioned',
+    'axis-configure': 'Configured',
+    'axis-verify': 'Verified',
+    'axis-all': 'Completed',
+}
+# Condition status of the phases of a workflow node
+NODE_PHASE_STATUS = {
+    'Succeeded': 'True',
+    'Failed': 'False',
+    'Error': 'False',
+}
+
+
+def axis_resource(body: dict) -> tuple:
+    """
+    Returns the (namespace, name) of the AXIS resource a workflow provisions.
+    Workflows created before they were labelled with the namespace carry it in their instance label
+    """
+    labels = body['metadata']['labels']
+    namespace = labels.get('axis.aquakube.io/namespace') or labels['app.kubernetes.io/instance'].split('.', 1)[0]
+    return namespace, labels['axis.aquakube.io/name']
 
 
 def status(
+    namespace,
     name,
-    status,
-    group="aquakube.io",
-    version="v1",
-    plural="axis",
+    status=None,
+    conditions=(),
     logger=None
 ):
     """
-    Update the CRs status to reflect workflow progress / results
-    TODO: define status schema
+    Update the CRs status to reflect workflow progress / results.
+    The update is queued and merged with the other updates of the CR made within the merge window into a single patch.
+    """
+    writer().update(namespace, name, status=status, conditions=conditions)
+
+
+def step_conditions(nodes: dict) -> list:
+    """
+    Returns the (type, status, reason, message) conditions of the steps of a workflow from its status.nodes
     """
-    api = client.CustomObjectsApi()
-    try:
-        api.patch_namespaced_custom_object_status(
-            group=group,
-            version=version,
-            namespace='axis',
-            plural=plural,
-            name=name,
-            body={'status': status}
-        )
-    except ApiException as e:
-        logger.exception(f"Failed to update axis status")
\ No newline at end of file
+    conditions = []
+    for node in (nodes or {}).values():
+        condition_type = STEP_CONDITIONS.get(node.get('templateName'))
+        if condition_type and node.get('phase'):
+            conditions.append((condition_type, NODE_PHASE_STATUS.get(node['phase'], 'Unknown'), node['phase'], node.get('message', '')))
+    return conditions
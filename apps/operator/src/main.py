@@ -2,18 +2,21 @@ import os
 import kopf
 
 from handlers import create, update, admission
+from utilities import k8s
+from utilities.status import writer
 from utilities.tunnel import ServiceTunnel
 
 
 @kopf.on.startup()
-def startup(logger, settings, **kwargs):
+async def startup(logger, settings, **kwargs):
     """
     Execute this handler when the operator starts.
     No call to the API server is made until this handler
     completes successfully.
     """
 
-    settings.execution.max_workers = 5
+    # the create and update handlers are async and share one pooled client, the workers only run the sync admission handlers
+    settings.execution.max_workers = k8s.CONCURRENCY
     settings.networking.request_timeout = 30
     settings.networking.connect_timeout = 10
     settings.persistence.finalizer = 'axis.aquakube.io/finalizer'
@@ -36,12 +39,24 @@ def startup(logger, settings, **kwargs):
             container_port=int(os.getenv("CONTAINER_PORT", 9443))
         )
 
+    await k8s.connect(concurrency=k8s.CONCURRENCY)
+
 
 @kopf.on.cleanup()
-def cleanup(logger, **kwargs):
+async def cleanup(logger, **kwargs):
+    await writer().drain()
+    await k8s.close()
     logger.info("im shutting down. Goodbye!")
 
 
+@kopf.on.probe(id='status_queue_depth')
+def status_queue_depth(**kwargs):
+    """
+    Status updates queued and not written yet, reported by the liveness endpoint
+    """
+    return writer().depth
+
+
 @kopf.on.validate('axis')
 def validateaxis(**kwargs):
     admission.validate(**kwargs)
@@ -54,29 +69,36 @@ def mutateaxis(**kwargs):
 
 @kopf.on.create('axis')
 @kopf.on.update('axis')
-def on_create(body, name, namespace, logger, patch, **kwargs):
+async def on_create(body, name, namespace, logger, patch, **kwargs):
     """
     For each axis, create a workflow to provision the axis.
     It's phase will be set to provisioning.
     """
-    create.workflow(name, namespace, body, logger, patch)
+    await create.workflow(name, namespace, body, logger, patch)
+
+
+@kopf.on.delete('axis', optional=True)
+async def on_delete(name, namespace, **kwargs):
+    writer().forget(namespace, name)
+    create.debouncing.pop((namespace, name), None)
 
 
 @kopf.on.field(
     'workflow',
     field='status.phase',
-    labels={'axis.aquakube.io/name': kopf.PRESENT},
+    labels={'axis.aquakube.io/name': kopf.PRESENT, create.SUPERSEDED_LABEL: kopf.ABSENT},
 )
-def on_update_workflow(old, new, body, logger, **kwargs):
+async def on_update_workflow(old, new, body, logger, **kwargs):
     """
     When the workflow is done, update the axis status depending
     on the status of the argo workflow
     """
-    axis_name = body['metadata']['labels']['axis.aquakube.io/name']
+    axis_namespace, axis_name = update.axis_resource(body)
 
     # when the workflow was running and is now succeeded
     if old == 'Running' and new == 'Succeeded':
         update.status(
+            namespace=axis_namespace,
             name=axis_name,
             status={ 'phase': 'provisioned' },
             logger=logger
@@ -85,7 +107,26 @@ def on_update_workflow(old, new, body, logger, **kwargs):
     # when the workflow was running and is now failed
     elif old == 'Running' and new == 'Failed':
         update.status(
+            namespace=axis_namespace,
             name=axis_name,
             status={ 'phase': 'failed_provisioning' },
             logger=logger
         )
+
+
+@kopf.on.field(
+    'workflow',
+    field='status.nodes',
+    labels={'axis.aquakube.io/name': kopf.PRESENT, create.SUPERSEDED_LABEL: kopf.ABSENT},
+)
+async def on_workflow_progress(new, body, logger, **kwargs):
+    """
+    Report the progress of the workflow steps as the conditions of the axis
+    """
+    axis_namespace, axis_name = update.axis_resource(body)
+    update.status(
+        namespace=axis_namespace,
+        name=axis_name,
+        conditions=update.step_conditions(new),
+        logger=logger
+    )
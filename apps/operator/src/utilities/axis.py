@@ -1,4 +1,10 @@
 import re
+import json
+import hashlib
+
+# Fields of spec.workflow that tune how a workflow runs rather than what it provisions, they are left out of the spec hash
+OPERATIONAL_WORKFLOW_FIELDS = ('pipeline', 'discovery_backend', 'discovery_workers', 'max_retries', 'retry_delay')
+
 
 def is_valid_axis_serial_number(serial_number: str) -> bool:
     """
@@ -16,4 +22,15 @@ def is_valid_axis_serial_number(serial_number: str) -> bool:
     if pattern.match(serial_number):
         return True
     else:
-        return False
\ No newline at end of file
+        return False
+
+
+def spec_hash(spec: dict) -> str:
+    """
+    Returns the sha256 of the provisioning relevant fields of an AXIS spec, serialized canonically (sorted keys, no whitespace),
+    so specs that would provision the camera the same way have the same hash whatever their key order or tuning
+    """
+    relevant = dict(spec)
+    relevant['workflow'] = {key: value for key, value in spec.get('workflow', {}).items() if key not in OPERATIONAL_WORKFLOW_FIELDS}
+    canonical = json.dumps(relevant, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode()).hexdigest()
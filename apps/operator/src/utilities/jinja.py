@@ -1,23 +1,214 @@
 import os
+import re
+import copy
+import logging
+import hashlib
+import threading
 
-from jinja2 import Template, StrictUndefined
+import yaml
+from jinja2 import Environment, Template, StrictUndefined, meta
+from jinja2.exceptions import UndefinedError
 
+logger = logging.getLogger(__name__)
 
-def load_template(path: str) -> Template:
+# Variables of the workflow template that select its structure ({% if %} blocks) rather than being injected into its values
+STRUCTURAL_VARIABLES = ('pipeline',)
+PLACEHOLDER = re.compile(r'@@(\w+)@@')
+
+
+def placeholder(variable: str) -> str:
+    return f"@@{variable}@@"
+
+
+def quoting(text: str) -> dict:
+    """ Returns the quote style ('"', "'" or None for a plain scalar) of the YAML scalars every placeholder of the text is in, by variable """
+    styles = {}
+    for line in text.splitlines():
+        quote = None
+        i = 0
+        while i < len(line):
+            match = PLACEHOLDER.match(line, i)
+            if match:
+                styles.setdefault(match.group(1), set()).add(quote)
+                i = match.end()
+                continue
+            char = line[i]
+            if quote == '"' and char == '\\':
+                i += 1
+            elif quote == "'" and line.startswith("''", i):
+                i += 1
+            elif quote and char == quote:
+                quote = None
+            elif quote is None and char in '"\'' and (i == 0 or line[i - 1] in ' [{,'):
+                quote = char
+            elif quote is None and char == '#' and (i == 0 or line[i - 1] == ' '):
+                break
+            i += 1
+    return styles
+
+
+def injectable(value: str, styles: set) -> bool:
+    """ Returns True if the value is read back as its own text in a scalar of each of the quote styles """
+    if not value.isprintable():
+        return False
+    if '"' in styles and ('"' in value or '\\' in value):
+        return False
+    return not ("'" in styles and "'" in value)
+
+
+class CompiledTemplate:
+    """
+    A jinja2 template of a Kubernetes object compiled once, identified by its path and the sha256 of its content.
+
+    render() renders the template and parses the YAML, like loading it from scratch does.
+    build() is the fast path: the template is rendered and parsed once for every combination of the structural variables,
+    with a placeholder in place of every other variable, and an object is built by copying that skeleton and injecting the values
+    into the strings that held a placeholder. The first object built from a skeleton is compared with the rendered one,
+    the fast path is disabled for a skeleton it does not reproduce, e.g. a variable used with a filter or as a non string value.
+
+    Rendering does not escape the values, so a value the YAML parser would read differently from its text (e.g a double quote
+    or a backslash in a double quoted scalar) is rendered instead of injected. Variables must be used in quoted scalars,
+    a template with a variable in a plain scalar is always rendered.
+    """
+
+    def __init__(self, path: str, source: str, sha256: str):
+        self.path = path
+        self.sha256 = sha256
+        self.template = Template(source, undefined=StrictUndefined)
+        # without the globals, so variables named like one (e.g namespace) are found too
+        environment = Environment()
+        environment.globals.clear()
+        self.variables = meta.find_undeclared_variables(environment.parse(source))
+        self.skeletons = {}
+        self._lock = threading.Lock()
+
+
+    def render(self, **values) -> dict:
+        return yaml.safe_load(self.template.render(**values))
+
+
+    def _skeleton(self, structure: dict) -> tuple:
+        """
+        Returns the skeleton of the structure, the (path, parts) of its strings with placeholders and the quote styles of the variables,
+        or None if it can not be built
+        """
+        injected = {variable: placeholder(variable) for variable in self.variables if variable not in structure}
+        text = self.template.render(**structure, **injected)
+        document = yaml.safe_load(text)
+        styles = quoting(text)
+        plain = sorted(variable for variable, quotes in styles.items() if None in quotes)
+        if plain:
+            logger.warning(f"Template {self.path} can not be built from a skeleton, {plain} are used in plain scalars")
+            return None
+        slots = []
+        found = set()
+
+        def walk(node, path):
+            items = node.items() if isinstance(node, dict) else enumerate(node) if isinstance(node, list) else ()
+            for key, value in items:
+                if isinstance(key, str) and PLACEHOLDER.search(key):
+                    raise ValueError(f"placeholder in the key {key}")
+                if isinstance(value, str) and PLACEHOLDER.search(value):
+                    # alternating literal text and variable names
+                    parts = PLACEHOLDER.split(value)
+                    found.update(parts[1::2])
+                    slots.append((path + (key,), parts))
+                else:
+                    walk(value, path + (key,))
+
+        try:
+            walk(document, ())
+        except ValueError as e:
+            logger.warning(f"Template {self.path} can not be built from a skeleton, {e}")
+            return None
+        if found != set(injected):
+            logger.warning(f"Template {self.path} can not be built from a skeleton, {sorted(set(injected) ^ found)} are not plain values")
+            return None
+        return document, slots, styles
+
+
+    def build(self, **values) -> dict:
+        """ Returns the object of the template with the values, see the class documentation """
+        structure = {variable: values[variable] for variable in STRUCTURAL_VARIABLES if variable in self.variables}
+        key = tuple(sorted(structure.items()))
+        with self._lock:
+            if key not in self.skeletons:
+                self.skeletons[key] = {'skeleton': self._skeleton(structure), 'verified': False}
+            entry = self.skeletons[key]
+        if entry['skeleton'] is None:
+            return self.render(**values)
+
+        document, slots, styles = entry['skeleton']
+        if not all(injectable(str(values.get(variable, '')), quotes) for variable, quotes in styles.items()):
+            return self.render(**values)
+        obj = copy.deepcopy(document)
+        for path, parts in slots:
+            parent = obj
+            for key in path[:-1]:
+                parent = parent[key]
+            try:
+                parent[path[-1]] = ''.join(part if i % 2 == 0 else str(values[part]) for i, part in enumerate(parts))
+            except KeyError as e:
+                raise UndefinedError(f"'{e.args[0]}' is undefined")
+
+        if not entry['verified']:
+            if obj != self.render(**values):
+                logger.warning(f"Template {self.path} built from a skeleton differs from the rendered template, rendering it from now on")
+                entry['skeleton'] = None
+                return self.render(**values)
+            entry['verified'] = True
+        return obj
+
+
+class TemplateCache:
     """
-    Loads a jinja2 template from a file
+    Compiled templates keyed by path. A template is only read again when the stat of its file changes
+    (which also catches a ConfigMap mount swapping its symlink), and only compiled again when the sha256 of its content changes.
     """
-    with open(path, 'rt') as f:
-        return Template(f.read(), undefined=StrictUndefined)
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+
+    def get(self, path: str) -> CompiledTemplate:
+        stat = os.stat(path)
+        signature = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry and entry[0] == signature:
+                return entry[1]
+
+            with open(path, 'rb') as f:
+                source = f.read()
+            sha256 = hashlib.sha256(source).hexdigest()
+            if entry and entry[1].sha256 == sha256:
+                compiled = entry[1]
+            else:
+                compiled = CompiledTemplate(path, source.decode(), sha256)
+                logger.info(f"Compiled template {path} version {sha256[:12]}")
+            self._entries[path] = (signature, compiled)
+            return compiled
 
 
-def load_workflow_template() -> Template:
+templates = TemplateCache()
+
+
+def load_template(path: str) -> CompiledTemplate:
     """
-    Loads the workflow template for provisioning
+    Loads a jinja2 template from a file, compiled once and reloaded when the file changes
     """
+    return templates.get(path)
+
+
+def workflow_template_path() -> str:
     if os.getenv("ENVIRONMENT", "dev") == "dev":
-        path = './apps/operator/kubernetes/provision.yaml'
-    else:
-        path = '/usr/app/kubernetes/provision.yaml'
+        return './apps/operator/kubernetes/provision.yaml'
+    return '/usr/app/kubernetes/provision.yaml'
 
-    return load_template(path)
+
+def load_workflow_template() -> CompiledTemplate:
+    """
+    Loads the workflow template for provisioning
+    """
+    return load_template(workflow_template_path())
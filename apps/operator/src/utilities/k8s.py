@@ -0,0 +1,118 @@
+import os
+import asyncio
+import logging
+
+from kubernetes_asyncio import client, config
+from kubernetes_asyncio.config.config_exception import ConfigException
+
+logger = logging.getLogger(__name__)
+
+# Kubernetes API requests the handlers may have in flight at once, the connection pool is sized to match
+CONCURRENCY = int(os.getenv('OPERATOR_CONCURRENCY', 32))
+
+
+class KubernetesClient:
+    """
+    Long lived asynchronous Kubernetes API client shared by every handler.
+    Requests reuse the keep-alive connections of a single pool and at most `concurrency` of them are in flight at once,
+    so a burst of events waits on the client instead of on a handful of executor threads blocked on HTTP calls.
+    """
+
+    def __init__(self, api_client: client.ApiClient, concurrency: int = CONCURRENCY):
+        self.api_client = api_client
+        self.custom_objects = client.CustomObjectsApi(api_client)
+        self.concurrency = concurrency
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.in_flight = 0
+
+
+    @classmethod
+    async def connect(cls, concurrency: int = CONCURRENCY, configuration: client.Configuration = None) -> 'KubernetesClient':
+        """ Returns a client configured from the service account of the pod, or from the kube config outside the cluster """
+        if configuration is None:
+            configuration = client.Configuration()
+            try:
+                config.load_incluster_config(client_configuration=configuration)
+            except ConfigException:
+                await config.load_kube_config(client_configuration=configuration)
+        configuration.connection_pool_maxsize = concurrency
+        return cls(client.ApiClient(configuration), concurrency)
+
+
+    async def request(self, method, **kwargs):
+        """ Awaits an API method once fewer than `concurrency` requests are in flight """
+        async with self.semaphore:
+            self.in_flight += 1
+            try:
+                return await method(**kwargs)
+            finally:
+                self.in_flight -= 1
+
+
+    async def create_custom_object(self, group: str, version: str, namespace: str, plural: str, body: dict) -> dict:
+        return await self.request(
+            self.custom_objects.create_namespaced_custom_object,
+            group=group, version=version, namespace=namespace, plural=plural, body=body
+        )
+
+
+    async def get_custom_object(self, group: str, version: str, namespace: str, plural: str, name: str) -> dict:
+        return await self.request(
+            self.custom_objects.get_namespaced_custom_object,
+            group=group, version=version, namespace=namespace, plural=plural, name=name
+        )
+
+
+    async def patch_custom_object(self, group: str, version: str, namespace: str, plural: str, name: str, body: dict) -> dict:
+        """ Patches the object with a JSON merge patch """
+        return await self.request(
+            self.custom_objects.patch_namespaced_custom_object,
+            group=group, version=version, namespace=namespace, plural=plural, name=name, body=body,
+            _content_type='application/merge-patch+json'
+        )
+
+
+    async def get_custom_object_status(self, group: str, version: str, namespace: str, plural: str, name: str) -> dict:
+        return await self.request(
+            self.custom_objects.get_namespaced_custom_object_status,
+            group=group, version=version, namespace=namespace, plural=plural, name=name
+        )
+
+
+    async def patch_custom_object_status(self, group: str, version: str, namespace: str, plural: str, name: str, body: dict) -> dict:
+        """ Patches the status with a JSON merge patch, the client would otherwise send a dict as a JSON patch """
+        return await self.request(
+            self.custom_objects.patch_namespaced_custom_object_status,
+            group=group, version=version, namespace=namespace, plural=plural, name=name, body=body,
+            _content_type='application/merge-patch+json'
+        )
+
+
+    async def close(self):
+        await self.api_client.close()
+
+
+_client: KubernetesClient = None
+
+
+async def connect(concurrency: int = CONCURRENCY, configuration: client.Configuration = None) -> KubernetesClient:
+    """ Creates the shared client, on startup """
+    global _client
+    _client = await KubernetesClient.connect(concurrency=concurrency, configuration=configuration)
+    logger.info(f"Connected the shared Kubernetes API client with a concurrency of {concurrency}")
+    return _client
+
+
+def api() -> KubernetesClient:
+    """ Returns the shared client """
+    if _client is None:
+        raise Exception("The Kubernetes API client is not connected, connect() is called on startup")
+    return _client
+
+
+async def close():
+    """ Closes the connections of the shared client, on cleanup """
+    global _client
+    if _client is not None:
+        await _client.close()
+        _client = None
@@ -0,0 +1,174 @@
+import os
+import random
+import asyncio
+import logging
+from datetime import datetime, timezone
+
+from kubernetes_asyncio.client.exceptions import ApiException
+
+from utilities import k8s
+
+logger = logging.getLogger(__name__)
+
+# Status updates of a resource made within the window are merged into one patch
+STATUS_MERGE_WINDOW = float(os.getenv('STATUS_MERGE_WINDOW', 1.0))
+# Attempts of a patch that conflicts or is throttled, and the backoff between them in seconds
+STATUS_MAX_ATTEMPTS = 6
+STATUS_BACKOFF = 0.5
+STATUS_MAX_BACKOFF = 30.0
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+
+
+def merge(status: dict, update: dict) -> dict:
+    """ Merges a status update into a status, nested objects are merged and everything else is replaced """
+    merged = dict(status)
+    for key, value in update.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def now() -> str:
+    return datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+class StatusWriter:
+    """
+    Writes the status of the AXIS resources, coalescing the updates of a resource.
+
+    Updates are queued per resource and the ones made within the merge window are merged into a single patch.
+    Conditions are merged by type: a patch replaces the whole conditions array, so the writer keeps the last written status
+    and resourceVersion of every resource and patches with the resourceVersion as a precondition.
+    A conflict (409) means the resource changed since, its status is read again and the patch retried.
+    Throttling (429) and server errors are retried with exponential backoff, honouring Retry-After.
+    At most one patch of a resource is in flight, updates queued meanwhile go into the next patch.
+    """
+
+    def __init__(self, group: str = 'aquakube.io', version: str = 'v1', plural: str = 'axis',
+                 window: float = STATUS_MERGE_WINDOW, attempts: int = STATUS_MAX_ATTEMPTS):
+        self.group = group
+        self.version = version
+        self.plural = plural
+        self.window = window
+        self.attempts = attempts
+        # (namespace, name) -> {'status': merged status, 'conditions': {type: condition}, 'updates': count}
+        self.pending = {}
+        self.tasks = {}
+        # (namespace, name) -> (resourceVersion, status) as last read or written
+        self.known = {}
+        self.patches = 0
+        self.updates = 0
+
+
+    @property
+    def depth(self) -> int:
+        """ Updates queued and not written yet """
+        return sum(batch['updates'] for batch in self.pending.values())
+
+
+    def update(self, namespace: str, name: str, status: dict = None, conditions: list = ()):
+        """
+        Queues a status update of the resource. conditions are (type, status, reason, message) tuples,
+        the transition and update times are set by the writer.
+        """
+        key = (namespace, name)
+        batch = self.pending.setdefault(key, {'status': {}, 'conditions': {}, 'updates': 0})
+        batch['status'] = merge(batch['status'], status or {})
+        for condition_type, condition_status, reason, message in conditions:
+            batch['conditions'][condition_type] = {'type': condition_type, 'status': condition_status, 'reason': reason, 'message': message}
+        batch['updates'] += 1
+        self.updates += 1
+        if key not in self.tasks:
+            self.tasks[key] = asyncio.get_running_loop().create_task(self._flush(key))
+
+
+    async def _flush(self, key: tuple):
+        try:
+            while key in self.pending:
+                await asyncio.sleep(self.window)
+                batch = self.pending.pop(key)
+                await self._write(key, batch)
+        finally:
+            self.tasks.pop(key, None)
+
+
+    async def _read(self, key: tuple):
+        resource = await k8s.api().get_custom_object_status(self.group, self.version, key[0], self.plural, key[1])
+        self.known[key] = (resource['metadata']['resourceVersion'], resource.get('status') or {})
+
+
+    def _patch(self, key: tuple, batch: dict) -> dict:
+        resource_version, current = self.known[key]
+        status = dict(batch['status'])
+        if batch['conditions']:
+            timestamp = now()
+            conditions = {condition['type']: condition for condition in current.get('conditions') or []}
+            for condition_type, condition in batch['conditions'].items():
+                previous = conditions.get(condition_type, {})
+                transitioned = previous.get('status') != condition['status']
+                conditions[condition_type] = {
+                    **condition,
+                    'lastTransitionTime': timestamp if transitioned else previous.get('lastTransitionTime', timestamp),
+                    'lastUpdateTime': timestamp,
+                }
+            status['conditions'] = list(conditions.values())
+        return {'metadata': {'resourceVersion': resource_version}, 'status': status}
+
+
+    async def _write(self, key: tuple, batch: dict):
+        namespace, name = key
+        for attempt in range(1, self.attempts + 1):
+            try:
+                if key not in self.known:
+                    await self._read(key)
+                body = self._patch(key, batch)
+                resource = await k8s.api().patch_custom_object_status(self.group, self.version, namespace, self.plural, name, body)
+                self.known[key] = (resource['metadata']['resourceVersion'], resource.get('status') or {})
+                self.patches += 1
+                logger.info(
+                    f"Patched the status of {namespace}/{name} with {batch['updates']} updates, "
+                    f"{self.depth} updates queued, {self.patches} patches for {self.updates} updates"
+                )
+                return
+            except ApiException as e:
+                if e.status == 404:
+                    logger.warning(f"{namespace}/{name} no longer exists, dropping {batch['updates']} status updates")
+                    self.known.pop(key, None)
+                    return
+                if e.status == 409:
+                    # the resource changed since it was last read, merge with its current status
+                    self.known.pop(key, None)
+                    continue
+                if e.status not in RETRYABLE_STATUSES or attempt == self.attempts:
+                    logger.error(f"Failed to update the status of {namespace}/{name}, dropping {batch['updates']} updates: {e.status} {e.reason}")
+                    return
+                retry_after = (e.headers or {}).get('Retry-After')
+                delay = float(retry_after) if retry_after and retry_after.isdigit() else min(STATUS_BACKOFF * 2 ** (attempt - 1), STATUS_MAX_BACKOFF)
+                delay *= random.uniform(1, 1.25)
+                logger.warning(f"Status patch of {namespace}/{name} got {e.status}, retrying in {delay:.1f}s (attempt {attempt}/{self.attempts})")
+                await asyncio.sleep(delay)
+        logger.error(f"Failed to update the status of {namespace}/{name} after {self.attempts} attempts, dropping {batch['updates']} updates")
+
+
+    def forget(self, namespace: str, name: str):
+        """ Drops the last known status of a deleted resource """
+        self.known.pop((namespace, name), None)
+
+
+    async def drain(self):
+        """ Waits for the queued updates to be written, on shutdown """
+        while self.tasks:
+            await asyncio.gather(*list(self.tasks.values()), return_exceptions=True)
+
+
+_writer: StatusWriter = None
+
+
+def writer() -> StatusWriter:
+    """ Returns the status writer shared by the handlers """
+    global _writer
+    if _writer is None:
+        _writer = StatusWriter()
+    return _writer
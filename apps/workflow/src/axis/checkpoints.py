@@ -0,0 +1,116 @@
+import time
+import json
+import asyncio
+import hashlib
+import logging
+
+from utilities.state import save
+
+logger = logging.getLogger()
+
+
+class RetryPolicy:
+    """
+    How many times a configure operation is attempted and how long to wait between attempts.
+    The delay grows by the backoff factor after every failed attempt, up to the max delay, in seconds.
+    """
+
+    def __init__(self, attempts: int = 3, delay: float = 5, backoff: float = 1, max_delay: float = 60):
+        self.attempts = max(attempts, 1)
+        self.delay = delay
+        self.backoff = backoff
+        self.max_delay = max_delay
+
+
+    def delay_before(self, attempt: int) -> float:
+        """ Returns the delay before the attempt following the failed attempt """
+        return min(self.delay * self.backoff ** (attempt - 1), self.max_delay)
+
+
+class Checkpoints:
+    """
+    The configure operations that have completed, recorded under configure.checkpoints in the workflow state
+    with a fingerprint of the camera and of the inputs they were run with.
+
+    An operation whose fingerprint matches its checkpoint has already been applied and is skipped, so retries and re-runs
+    resume from the first incomplete operation. Changing an input (e.g the orientation) changes the fingerprint and
+    runs the operation again. Every checkpoint is saved to the state file as soon as it is recorded, so the checkpoints of
+    an interrupted run are in the state artifact the pod uploads. A retried configure pod reads that artifact (see the
+    retryStrategy of axis-configure in provision.yaml), checkpoints are lost if the pod is killed before uploading it.
+    """
+
+    def __init__(self, resource: dict, state: dict, persist: bool = True):
+        self.state = state
+        self.persist = persist
+        self.checkpoints = state.setdefault('configure', {}).setdefault('checkpoints', {})
+        self.identity = {
+            'name': resource['metadata']['name'],
+            'mac_address': resource['spec']['network'].get('mac_address'),
+        }
+
+
+    def fingerprint(self, operation: str, inputs: dict) -> str:
+        payload = json.dumps({**self.identity, 'operation': operation, 'inputs': inputs}, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+    def completed(self, operation: str, inputs: dict) -> bool:
+        checkpoint = self.checkpoints.get(operation)
+        return checkpoint is not None and checkpoint['fingerprint'] == self.fingerprint(operation, inputs)
+
+
+    def complete(self, operation: str, inputs: dict, attempts: int):
+        self.checkpoints[operation] = {
+            'fingerprint': self.fingerprint(operation, inputs),
+            'completed_at': time.time(),
+            'attempts': attempts,
+        }
+        if self.persist:
+            save(state=self.state)
+
+
+    def pending(self, operations: dict) -> list:
+        """ Returns the names of the operations, a mapping of name to inputs, that have not completed with their inputs """
+        return [name for name, inputs in operations.items() if not self.completed(name, inputs)]
+
+
+async def retry(name: str, operation, policy: RetryPolicy):
+    """
+    Awaits operation(attempt), a coroutine function, and returns the number of the attempt that succeeded along with its result.
+    A failed attempt is retried according to the retry policy, unless the error is not retryable (e.g rejected credentials
+    or an open circuit breaker) in which case it is raised immediately.
+    """
+    for attempt in range(1, policy.attempts + 1):
+        try:
+            return attempt, await operation(attempt)
+        except Exception as e:
+            if not getattr(e, 'retryable', True):
+                logger.error(f"Operation '{name}' failed on attempt {attempt} with an error that retrying can not fix")
+                raise e
+            if attempt == policy.attempts:
+                logger.error(f"Operation '{name}' failed on attempt {attempt} of {policy.attempts}")
+                raise e
+            delay = policy.delay_before(attempt)
+            logger.warning(f"Operation '{name}' failed on attempt {attempt} of {policy.attempts}, retrying in {delay} seconds: {e}")
+            await asyncio.sleep(delay)
+
+
+async def run_operation(checkpoints: Checkpoints, name: str, inputs: dict, operation, policy: RetryPolicy, snapshot=None, refresh=None):
+    """
+    Runs operation(snapshot), a coroutine function, unless it has already completed with the same inputs.
+    A failed operation is retried according to its retry policy. If refresh is provided it is awaited before every retry
+    for a new snapshot, so a retry works from the current configuration of the device instead of a stale one.
+    A failure to refresh counts as a failed attempt.
+    """
+    if checkpoints.completed(name, inputs):
+        logger.info(f"Skipping '{name}', it already completed with the same inputs")
+        return
+
+    async def attempt(number: int):
+        nonlocal snapshot
+        if number > 1 and refresh:
+            snapshot = await refresh()
+        await operation(snapshot)
+
+    attempts, _ = await retry(name, attempt, policy)
+    checkpoints.complete(name, inputs, attempts=attempts)
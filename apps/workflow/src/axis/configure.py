@@ -1,13 +1,19 @@
 import os
-import time
 import json
+import math
+import time
+import asyncio
 import logging
 from xml.etree import ElementTree
 
-import boto3
-
-from utilities.vapix import VAPIX
-from utilities.command import ping
+from utilities.timeouts import AdaptiveTimeouts
+from utilities.firmware_cache import FirmwareCache
+from utilities.throttle import TokenBucket, ThrottledReader
+from utilities.vapix import AsyncVAPIX, CircuitOpenError, DeviceUnreachableError, DeviceError, MalformedResponseError
+from axis.snapshot import Snapshot, parse_parameters
+from axis.checkpoints import Checkpoints, RetryPolicy, retry, run_operation
+from utilities.reachability import Reachability
+from utilities.wait import poll_async, time_left
 
 logger = logging.getLogger()
 
@@ -18,61 +24,146 @@ DEFAULT_TEXT_OVERLAY = "%D %X"
 PRODUCTION_AXIS_FIRMWARE_FILENAME = 'M3058-PLVE_10_12_166.bin'
 S3_FIRMWARE_BUCKET = 'aquakube-axis-firmware'
 PRODUCTION_FIRMWARE_RELEASE = '10.12.166'
+MAX_CONCURRENT_REQUESTS = 4  # max number of cgi requests in flight to a single camera
+CAMERA_TILT_ORIENTATIONS = {'ceiling': '-90', 'wall': '0', 'desk': '90'}
+FORMAT_JOB_TIMEOUT = 240  # seconds
+# Seconds from the end of a firmware upload until the device must report the new firmware, and to see it go down to reboot
+REBOOT_DEADLINE = 240
+# Seconds kept at the end of the pod's deadline to save and upload the state, the reboot wait gives up before then
+STEP_DEADLINE_MARGIN = 20
+REBOOT_DOWN_TIMEOUT = 60
+# Retry policies of the configure operations that differ from the default policy (spec.workflow.max_retries and retry_delay)
+RETRY_POLICIES = {
+    # an upgrade reboots the device, a second attempt is only worth it once the device has settled
+    'check_firmware': RetryPolicy(attempts=2, delay=30),
+    # the snapshot is a handful of reads every operation depends on, a transient error must not fail the whole step
+    'load_snapshot': RetryPolicy(attempts=3, delay=1, backoff=2),
+    # formatting and mounting the SD card is flaky while the card is busy, back off between attempts
+    'disk_check': RetryPolicy(attempts=5, delay=5, backoff=2, max_delay=60),
+    # parameter and overlay writes are cheap and idempotent, transient failures are retried quickly
+    'allow_anonymous_viewers': RetryPolicy(attempts=3, delay=1, backoff=2),
+    'configure_recordings_retention_policy': RetryPolicy(attempts=3, delay=1, backoff=2),
+    'enable_snmp': RetryPolicy(attempts=3, delay=1, backoff=2),
+    'configure_textoverlays': RetryPolicy(attempts=3, delay=1, backoff=2),
+}
 
 
 def configure(resource: dict, state: dict):
     """
     Configures the axis device
     """
-    camera = camera = VAPIX(
+    asyncio.run(configure_async(resource, state))
+
+
+async def configure_async(resource: dict, state: dict):
+    """
+    Configures the axis device, issuing the independent configuration calls concurrently.
+    The number of requests in flight to the camera is capped by MAX_CONCURRENT_REQUESTS.
+    The current configuration is read up front so only the settings that differ from the resource are written,
+    the differences are recorded in the state.
+
+    Every operation records a checkpoint in the state once it has completed and is retried on its own according to
+    its retry policy, so a failing operation does not re-issue the ones that already succeeded and a re-run of the step
+    resumes from the operations that have not completed.
+    """
+    camera = AsyncVAPIX(
         name=resource['metadata']['name'],
         host=state['ip_address'],
         username=state['username'],
-        password=state['password'] 
+        password=state['password'],
+        max_concurrency=MAX_CONCURRENT_REQUESTS,
+        timeouts=AdaptiveTimeouts.from_state(state)
     )
+    checkpoints = Checkpoints(resource, state)
+    default_policy = RetryPolicy(attempts=resource['spec']['workflow']['max_retries'], delay=resource['spec']['workflow']['retry_delay'])
+    video = resource['spec']['video']
+
+    # operation name -> (inputs, operation(snapshot)), the inputs are fingerprinted in the checkpoints
+    operations = {
+        'allow_anonymous_viewers': ({}, lambda snapshot: allow_anonymous_viewers(camera, snapshot)),
+        'configure_camera_orientation': ({'orientation': video['orientation']}, lambda snapshot: configure_camera_orientation(camera, snapshot, orientation=video['orientation'])),
+        'configure_recordings_retention_policy': ({'days': 365}, lambda snapshot: configure_recordings_retention_policy(camera, snapshot, days=365)),
+        'enable_snmp': ({}, lambda snapshot: enable_snmp(camera, snapshot)),
+        'configure_ntp_client': ({}, lambda snapshot: configure_ntp_client(camera, snapshot)),
+        'disk_check': ({'filesystem': DEFAULT_FILESYSTEM_FORMAT}, lambda snapshot: disk_check(camera, waits=state.setdefault('waits', []))),
+        'set_zipstream_gop_settings': ({}, lambda snapshot: set_zipstream_gop_settings(camera, snapshot)),
+        'set_zipstream_strength': ({'strength': video['zipstream_strength']}, lambda snapshot: set_zipstream_strength(camera, snapshot, strength=video['zipstream_strength'])),
+        'configure_textoverlays': ({'text': DEFAULT_TEXT_OVERLAY}, lambda snapshot: configure_textoverlays(camera, snapshot)),
+    }
+
+    try:
+        # A firmware upgrade reboots the device, so it must complete before anything else is configured
+        if resource['spec']['workflow']['ignore_firmware_version'] is False:
+            await run_operation(
+                checkpoints, 'check_firmware', {'release': PRODUCTION_FIRMWARE_RELEASE},
+                lambda snapshot: check_firmware(camera, reboots=state.setdefault('reboots', {})),
+                policy=RETRY_POLICIES.get('check_firmware', default_policy)
+            )
 
-    max_retries = resource['spec']['workflow']['max_retries']
-    retry_delay = resource['spec']['workflow']['retry_delay']
-    for _ in range(max_retries):
+        pending = checkpoints.pending({name: inputs for name, (inputs, _) in operations.items()})
+        if not pending:
+            logger.info(f"{camera.name} [{camera.host}] -  Every configure operation has already completed")
+            return
+        logger.info(f"{camera.name} [{camera.host}] -  Running {len(pending)} of {len(operations)} configure operations: {', '.join(pending)}")
+
+        _, snapshot = await retry(
+            'load_snapshot',
+            lambda attempt: Snapshot.load(camera),
+            policy=RETRY_POLICIES.get('load_snapshot', default_policy),
+        )
         try:
-            allow_anonymous_viewers(camera)
-            configure_camera_orientation(camera, orientation=resource['spec']['video']['orientation'])
-            configure_recordings_retention_policy(camera, days=365)
-            enable_snmp(camera)
-
-            if resource['spec']['workflow']['ignore_firmware_version'] is False:
-                check_firmware(camera)
-
-            configure_ntp_client(camera)
-            disk_check(camera)
-            set_zipstream_gop_settings(camera)
-            set_zipstream_strength(camera, strength=resource['spec']['video']['zipstream_strength'])
-            configure_textoverlays(camera)
-        except Exception as e:
-            logger.exception(f"{camera.name} Failed configuration on attempt { ( _ + 1 )} of {max_retries}")
-            # if max retries are met raise an exception with the traceback so the workflow will fail and the user can be notified of the issue
-            if (_ + 1) == max_retries:
-                raise e
-            time.sleep(retry_delay)
-        else:
-            logger.info(f"{camera.name} Successfully configured on attempt { ( _ + 1 )} of {max_retries}")
-            break
-
-
-def allow_anonymous_viewers(camera: VAPIX):
+            await run_concurrently(*(
+                run_operation(
+                    checkpoints, name, operations[name][0], operations[name][1],
+                    policy=RETRY_POLICIES.get(name, default_policy),
+                    snapshot=snapshot,
+                    refresh=lambda: snapshot.reload(camera)
+                )
+                for name in pending
+            ))
+        finally:
+            state['configure']['diff'] = snapshot.diff
+            logger.info(f"{camera.name} [{camera.host}] -  {len(snapshot.diff)} settings differed from the desired configuration")
+        logger.info(f"{camera.name} Successfully configured")
+    finally:
+        # record how many connections and digest challenges were reused so it can be reported
+        state.setdefault('vapix', {})['configure'] = camera.statistics()
+        state['vapix']['timeouts'] = camera.timeouts.to_state()
+        camera.close()
+
+
+async def run_concurrently(*operations):
+    """
+    Runs the configuration operations concurrently and waits for all of them to finish.
+    If any of the operations failed, the first failure is raised once every operation has settled.
+    """
+    results = await asyncio.gather(*operations, return_exceptions=True)
+    errors = [result for result in results if isinstance(result, BaseException)]
+    for error in errors[1:]:
+        logger.error(f"Configuration operation also failed: {error}")
+    if errors:
+        raise errors[0]
+
+
+async def allow_anonymous_viewers(camera: AsyncVAPIX, snapshot: Snapshot):
     """ 
     Must allow anonymous viewers so live streams can be viewed on C2 UI.
     """
-    response = camera._parameter_management(method='GET', params={'action': 'update', 'System.BoaProtViewer': 'anonymous', 'Network.RTSP.ProtViewer': 'anonymous'})
+    parameters = snapshot.changed_parameters('allow_anonymous_viewers', {'System.BoaProtViewer': 'anonymous', 'Network.RTSP.ProtViewer': 'anonymous'})
+    if not parameters:
+        logger.info(f"{camera.name} [{camera.host}] -  Already allowing anonymous viewers")
+        return
+
+    response = await camera.update_parameters(parameters, owner='allow_anonymous_viewers')
 
-    if not response or not response.ok:
-        raise Exception(f"{camera.name} [{camera.host}] -  Failed to allow anonymous viewers, stream will not be accessable on C2 UI..")
+    if not response.ok:
+        raise Exception(f"{camera.name} [{camera.host}] -  Failed to allow anonymous viewers, stream will not be accessable on C2 UI.. {response.error}")
     
     logger.debug(f"{camera.name} [{camera.host}] Allow anonymous RTSP viewers response: {response.text}")
     logger.info(f"{camera.name} [{camera.host}] -  Allowing anonymous viewers")
 
 
-def configure_camera_orientation(camera: VAPIX, orientation: str):
+async def configure_camera_orientation(camera: AsyncVAPIX, snapshot: Snapshot, orientation: str):
     """
     The camera orientation setting affects how view modes and the pan/tilt/zoom functionality are working.
     Wall mounting eliminates views modes [3] Double Panorama, [4] Quad View, [9] Corner Left, [10] Corner Right, [11] Double Corner
@@ -82,161 +173,250 @@ def configure_camera_orientation(camera: VAPIX, orientation: str):
         0 = Select this option if the camera is mounted on a wall.
         90 = Select this option if the camera is mounted on a desk or similar.
     """
-    mapping = {'-90': 'ceiling', '0': 'wall', '90': 'desk'}
-    response = camera._parameter_management(method='GET', params={'action': 'list', 'group': 'ImageSource.I0.CameraTiltOrientation'})
-
-    if not response or not response.ok:
+    if snapshot.parameters is None:
         raise Exception(f"{camera.name} [{camera.host}] -  Failed get camera orientation.")
-    
-    logger.debug(f"{camera.name} [{camera.host}] List camera orientation response: {response.text}")
-    _orientation = mapping.get(response.text.strip().split('=')[-1])
+
+    mapping = {value: key for key, value in CAMERA_TILT_ORIENTATIONS.items()}
+    _orientation = mapping.get(snapshot.parameters.get('ImageSource.I0.CameraTiltOrientation'))
     logger.info(f"{camera.name} [{camera.host}] -  Camera orientation configured as {_orientation} mount")
     if _orientation != orientation:
-        set_camera_orientation(camera, orientation)
-
+        snapshot.record('configure_camera_orientation', 'ImageSource.I0.CameraTiltOrientation', _orientation, orientation)
+        await set_camera_orientation(camera, orientation)
 
 
-def set_camera_orientation(camera: VAPIX, orientation: str):
+async def set_camera_orientation(camera: AsyncVAPIX, orientation: str):
     """
     Orientation is specified in devices.py,
     Users are prompted to update orientation to ensure the settings are correct
     """
     logger.info(f"{camera.name} [{camera.host}] -  Updating oritentation to '{orientation}' mount")
-    response = camera._parameter_management(
-        method='GET',
-        params={
-            'action': 'update',
-            'group': 'ImageSource.I0.CameraTiltOrientation',
-            'ImageSource.I0.CameraTiltOrientation': orientation,
-        },
-    )
+    response = await camera.update_parameters({'ImageSource.I0.CameraTiltOrientation': CAMERA_TILT_ORIENTATIONS[orientation]}, owner='set_camera_orientation')
 
-    if not response or not response.ok:
-        raise Exception(f"{camera.name} [{camera.host}] -  Failed to update camera orientation to {orientation}.")
+    if not response.ok:
+        raise Exception(f"{camera.name} [{camera.host}] -  Failed to update camera orientation to {orientation}. {response.error}")
 
     logger.debug(f"{camera.name} [{camera.host}] Set camera orientation response: {response.text}")
     logger.info(f"{camera.name} [{camera.host}] -  Successfully updated orientation as {orientation} mount")
 
 
-def configure_recordings_retention_policy(camera: VAPIX, days=365):
+async def configure_recordings_retention_policy(camera: AsyncVAPIX, snapshot: Snapshot, days=365):
     """ 
     During provisioning process we need to extend the retention policy from the default 7 days max age.
 
     Note: Recordings will be deleted earlier if the disk becomes full. Clean up policy is set to fifo.
     """
-    response = camera._parameter_management(method='GET', params={'action': 'update', 'Storage.S0.CleanupMaxAge': days})
+    parameters = snapshot.changed_parameters('configure_recordings_retention_policy', {'Storage.S0.CleanupMaxAge': days})
+    if not parameters:
+        logger.info(f"{camera.name} [{camera.host}] -  Retention policy is already {days} days")
+        return
 
-    if not response or not response.ok:
-        raise Exception(f"{camera.name} [{camera.host}] -  Failed to extend retention polict to {days} days..")
+    response = await camera.update_parameters(parameters, owner='configure_recordings_retention_policy')
+
+    if not response.ok:
+        raise Exception(f"{camera.name} [{camera.host}] -  Failed to extend retention polict to {days} days.. {response.error}")
 
     logger.debug(f"{camera.name} [{camera.host}] Extending retention policy (clean up max age = {days} days)  response: {response.text}")
     logger.info(f"{camera.name} [{camera.host}] -  Extended retention policy to {days} days")
 
 
-def enable_snmp(camera: VAPIX):
+async def enable_snmp(camera: AsyncVAPIX, snapshot: Snapshot):
     """ Enables SNMP so the device can be monitored from zabbix """
-    response = camera._parameter_management(method='GET', params={'action': 'update', 'SNMP.Enabled': 'yes', 'SNMP.V1': 'yes', 'SNMP.V2c': 'yes', 'SNMP.V3': 'no', 'SNMP.V1ReadCommunity': 'public'})
+    parameters = snapshot.changed_parameters('enable_snmp', {'SNMP.Enabled': 'yes', 'SNMP.V1': 'yes', 'SNMP.V2c': 'yes', 'SNMP.V3': 'no', 'SNMP.V1ReadCommunity': 'public'})
+    if not parameters:
+        logger.info(f"{camera.name} [{camera.host}] -  SNMP is already enabled")
+        return
+
+    response = await camera.update_parameters(parameters, owner='enable_snmp')
 
-    if not response or not response.ok:
-        raise Exception(f"{camera.name} [{camera.host}] -  Failed to enable SNMP")
+    if not response.ok:
+        raise Exception(f"{camera.name} [{camera.host}] -  Failed to enable SNMP. {response.error}")
 
     logger.debug(f"{camera.name} [{camera.host}] Enabling SNMP  response: {response.text}")
     logger.info(f"{camera.name} [{camera.host}] -  Enabled SNMP")
 
 
-def check_firmware(camera: VAPIX):
+def firmware_lists() -> tuple:
+    """ Returns the firmware versions of FIRMWARE_ALLOW_LIST and FIRMWARE_DENY_LIST, comma separated lists passed by the operator """
+    def versions(key):
+        return {version.strip() for version in (os.getenv(key) or '').split(',') if version.strip() and version.strip() != 'None'}
+    return versions('FIRMWARE_ALLOW_LIST'), versions('FIRMWARE_DENY_LIST')
+
+
+def needs_firmware_upgrade(version: str) -> bool:
     """
-    Axis cameras should all run the same produciton firmware release version.
-    If firmware is out of date then firmware will be upgraded and perform a system reboot.
+    Returns True if a camera running the firmware version must be upgraded to the production release.
+    Cameras on the production release or on a version of the allow list keep their firmware,
+    a version of the deny list is always upgraded.
     """
-    response = camera._firmware_management(method='GET', params={'apiVersion': '1.0', 'context': 'FO Configuration Management', 'method': 'status'})
-    if response.ok:
-        result = response.json()
-        logger.debug(f"{camera.name} [{camera.host}] Check firmware response: {response.text}")
-        active_firmware_version = result.get('data', {}).get('activeFirmwareVersion')
-        if active_firmware_version != PRODUCTION_FIRMWARE_RELEASE:
-            print(
-                f"{camera.name} [{camera.host}] -  Firmware version {active_firmware_version} is out of date with production release version {PRODUCTION_FIRMWARE_RELEASE}"
-            )
-            logger.info(f"{camera.name} [{camera.host}] -  Updating firmware from {active_firmware_version} to {PRODUCTION_FIRMWARE_RELEASE}. This could take a couple minutes..")
-            upgrade_firmware(camera)
-        else:
-            logger.info(f"{camera.name} [{camera.host}] -  Firmware is up to date on version {active_firmware_version}")
-    else:
-        raise Exception(f"{camera.name} [{camera.host}] -  Something went wrong with firmware check..")
+    allow, deny = firmware_lists()
+    if version in deny:
+        return True
+    return version != PRODUCTION_FIRMWARE_RELEASE and version not in allow
 
 
-def download_file_from_s3(s3_bucket: str, filename: str) -> str:
-    """ Downloads the file from an s3 bucket if it does not already exist """
-    cwd = os.getcwd()
-    firmware = f'{cwd}/{filename}'
-    if not os.path.isfile(firmware):
-        s3 = boto3.client('s3')
-        s3.download_file(s3_bucket, filename, firmware)
-    return firmware
+async def active_firmware_version(camera: AsyncVAPIX) -> str:
+    """ Returns the firmware version the camera is running """
+    response = await camera._firmware_management(method='GET', params={'apiVersion': '1.0', 'context': 'FO Configuration Management', 'method': 'status'})
+    result = camera.parse(response, "checking firmware")
+    logger.debug(f"{camera.name} [{camera.host}] Check firmware response: {response.text}")
+    return result.get('data', {}).get('activeFirmwareVersion')
+
+
+async def camera_model(camera: AsyncVAPIX) -> str:
+    """ Returns the product number of the camera, e.g M3058-PLVE """
+    response = await camera._parameter_management(method='GET', params={'action': 'list', 'group': 'Brand.ProdNbr'})
+    camera.check(response, "getting the product number")
+    return parse_parameters(response.text).get('Brand.ProdNbr', 'unknown')
+
+
+async def check_firmware(camera: AsyncVAPIX, bandwidth: TokenBucket = None, reboots: dict = None):
+    """
+    Axis cameras should all run the same produciton firmware release version, or a version of the firmware allow list.
+    If firmware is out of date then firmware will be upgraded and perform a system reboot.
+    The upload can be limited by a bandwidth token bucket shared with the other uploads over the same link.
+    How long the reboot took is recorded in reboots, see record_reboot.
+    """
+    version = await active_firmware_version(camera)
+    if needs_firmware_upgrade(version):
+        print(
+            f"{camera.name} [{camera.host}] -  Firmware version {version} is out of date with production release version {PRODUCTION_FIRMWARE_RELEASE}"
+        )
+        logger.info(f"{camera.name} [{camera.host}] -  Updating firmware from {version} to {PRODUCTION_FIRMWARE_RELEASE}. This could take a couple minutes..")
+        await upgrade_firmware(camera, bandwidth=bandwidth, reboots=reboots, previous_version=version)
+    else:
+        logger.info(f"{camera.name} [{camera.host}] -  Firmware is up to date on version {version}")
 
 
-def upgrade_firmware(camera: VAPIX):
+async def upgrade_firmware(camera: AsyncVAPIX, bandwidth: TokenBucket = None, reboots: dict = None, previous_version: str = None):
     """
     Upgrades the firmware to production release. 
-    After an upgrade the device will be rebooted and the method waits for the device to come back online before returning.
+    After an upgrade the device will be rebooted and the method waits for the device to report the new firmware before returning.
+    The image is streamed to the device from the firmware cache, or from S3 while it is being cached.
     Security level: admin
     """
-    firmware = download_file_from_s3(s3_bucket=S3_FIRMWARE_BUCKET, filename=PRODUCTION_AXIS_FIRMWARE_FILENAME)
-    payload = open(firmware, 'rb')
-    response = camera._upgrade_firmware(data=payload)
-    if response and response.ok:
-        logger.info(response.text)
-        if 'Error' in response.text:
-            raise Exception(f"{camera.name} [{camera.host}] -  Error when updating firmware. {response.text}")
-        logger.info(f"{camera.name} [{camera.host}] -  Successfully upgraded firmware to {PRODUCTION_FIRMWARE_RELEASE}")
-        logger.info(
-            f"{camera.name} [{camera.host}] -  Waiting for device to come back online after reboot on successfull upgrade to {PRODUCTION_FIRMWARE_RELEASE}"
+    if PRODUCTION_FIRMWARE_RELEASE in firmware_lists()[1]:
+        raise Exception(f"{camera.name} [{camera.host}] -  Production release {PRODUCTION_FIRMWARE_RELEASE} is on the firmware deny list, it will not be installed")
+    model = await camera_model(camera)
+    cache = FirmwareCache()
+    with cache.open(bucket=S3_FIRMWARE_BUCKET, filename=PRODUCTION_AXIS_FIRMWARE_FILENAME) as payload:
+        response = await camera._upgrade_firmware(data=ThrottledReader(payload, bandwidth) if bandwidth else payload)
+    camera.check(response, "upgrading firmware")
+    logger.info(response.text)
+    if 'Error' in response.text:
+        raise Exception(f"{camera.name} [{camera.host}] -  Error when updating firmware. {response.text}")
+    logger.info(f"{camera.name} [{camera.host}] -  Successfully upgraded firmware to {PRODUCTION_FIRMWARE_RELEASE}")
+    logger.info(
+        f"{camera.name} [{camera.host}] -  Waiting for device to come back online after reboot on successfull upgrade to {PRODUCTION_FIRMWARE_RELEASE}"
+    )
+    timings = await wait_on_reboot(camera, expected_version=PRODUCTION_FIRMWARE_RELEASE, deadline=reboot_deadline())
+    if reboots is not None:
+        record_reboot(reboots, model=model, firmware=PRODUCTION_FIRMWARE_RELEASE, previous_firmware=previous_version, timings=timings)
+
+
+def reboot_deadline() -> float:
+    """
+    Returns REBOOT_DEADLINE, or the time left in the pod less STEP_DEADLINE_MARGIN if that is shorter,
+    so a reboot that takes too long fails the operation (and saves its checkpoints) instead of the pod being killed.
+    """
+    left = time_left()
+    if left is None:
+        return REBOOT_DEADLINE
+    return max(min(REBOOT_DEADLINE, left - STEP_DEADLINE_MARGIN), 0)
+
+
+async def wait_on_reboot(camera: AsyncVAPIX, expected_version: str, deadline: float = REBOOT_DEADLINE, down_timeout: float = REBOOT_DOWN_TIMEOUT) -> dict:
+    """
+    Tracks the reboot of the device after a firmware upgrade. The device must go down, come back up and report the
+    expected activeFirmwareVersion in the firmwaremanagement.cgi status, which is only answered once the VAPIX services are up
+    (the device answers probes well before that). The status is polled with backoff until the deadline, in seconds.
+
+    If the device was seen going down and then reports another firmware version, the upgrade did not apply and an exception is
+    raised right away. Returns how many seconds after the upload the device went down, came back up and was ready.
+    """
+    start_time = time.monotonic()
+    elapsed = lambda: time.monotonic() - start_time
+    reachability = Reachability()
+    try:
+        try:
+            down = await reachability.wait_for(camera.host, up=False, timeout=down_timeout, backoff=1)
+        except Exception:
+            logger.warning(f"{camera.name} [{camera.host}] -  Device was not seen going down within {down_timeout} seconds, it may have rebooted between probes")
+            down = None
+        await reachability.wait_until_up(camera.host, timeout=max(deadline - elapsed(), 0))
+        up = elapsed()
+    finally:
+        reachability.close()
+
+    # the device is expected to miss status requests while its services start, so they must not open its circuit breaker
+    status = AsyncVAPIX(name=camera.name, host=camera.host, username=camera.username, password=camera.password, timeout=(3.05, 10), circuit_breaker=False)
+    async def reports_expected_version() -> bool:
+        try:
+            version = await active_firmware_version(status)
+        except (DeviceUnreachableError, DeviceError, MalformedResponseError) as e:
+            logger.debug(f"{camera.name} [{camera.host}] -  Firmware status is not available yet: {e}")
+            return False
+        if version != expected_version and down is not None:
+            raise Exception(f"{camera.name} [{camera.host}] -  Device rebooted on firmware {version} instead of {expected_version}")
+        return version == expected_version
+
+    try:
+        await poll_async(
+            reports_expected_version,
+            timeout=max(deadline - elapsed(), 0),
+            name=f"{camera.name} [{camera.host}] to report firmware {expected_version}",
+            interval=2,
+            max_interval=15
         )
-        wait_on_reboot(host=camera.host, threshold=10)
-        check_firmware(camera)
-    else:
-        raise Exception(f"{camera.name} [{camera.host}] -  Something went wrong with firmware upgrade..")
+    finally:
+        status.close()
+
+    timings = {'down': round(down, 3) if down is not None else None, 'up': round(up, 3), 'ready': round(elapsed(), 3)}
+    logger.info(
+        f"{camera.name} [{camera.host}] -  Device went down after {timings['down']} seconds, came back up after {timings['up']} seconds "
+        f"and reported firmware {expected_version} after {timings['ready']} seconds"
+    )
+    return timings
 
 
-def wait_on_reboot(host: str, threshold=20):
-    """ Returns when successful ping count is greater then threshold """
-    count = 0
-    while count <= threshold:
-        online = ping(host)
-        count += 1 if online else 0
-        time.sleep(1)
+def record_reboot(reboots: dict, model: str, firmware: str, previous_firmware: str, timings: dict):
+    """ Records how long a reboot onto the firmware took, aggregated for every model and firmware pair """
+    entry = reboots.setdefault(f"{model} {firmware}", {'model': model, 'firmware': firmware, 'count': 0, 'ready_mean': 0, 'ready_max': 0, 'samples': []})
+    entry['samples'].append({**timings, 'previous_firmware': previous_firmware})
+    entry['count'] += 1
+    entry['ready_mean'] = round(sum(sample['ready'] for sample in entry['samples']) / entry['count'], 3)
+    entry['ready_max'] = max(entry['ready_max'], timings['ready'])
 
 
-def configure_ntp_client(camera: VAPIX):
+async def configure_ntp_client(camera: AsyncVAPIX, snapshot: Snapshot):
     """
     Configures the axis cam to synchronize its internal clock and date by using NTP.
     If NTP is not configured properly then RTSP timeouts will occur and live streams can become unreliable.
     """
+    configuration = {'enabled': True, 'serversSource': 'static', 'staticServers': ['time.nist.gov']}
+    current = snapshot.ntp or {}
+    changes = {key: value for key, value in configuration.items() if current.get(key) != value}
+    if not changes:
+        logger.info(f"{camera.name} [{camera.host}] -  NTP client is already configured")
+        return
+    for key, value in changes.items():
+        snapshot.record('configure_ntp_client', key, current.get(key), value)
+
     payload = json.dumps(
         {
             'apiVersion': '1.0',
             'context': 'FO Configuration Management',
             'method': 'setNTPClientConfiguration',
-            'params': {'enabled': True, 'serversSource': 'static', 'staticServers': ['time.nist.gov']},
+            'params': configuration,
         }
     )
-    response = camera._ntp_client(data=payload)
-    if not response or not response.ok:
-        raise Exception(f"{camera.name} [{camera.host}] - Something went wrong when configuring NTP client..this could cause RTSP timeouts on live streams")
-    try:
-        logger.debug(f"{camera.name} [{camera.host}] Configure NTP Client response: {response.text}")
-        result = response.json()
-        error = result.get('error')
-        if error:
-            raise Exception(f"{camera.name} [{camera.host}] -  Error {error.get('code')} when configuring NTP client. {error.get('message')}")
-        else:
-            logger.info(f"{camera.name} [{camera.host}] -  Successfully configured NTP client")
-    except json.decoder.JSONDecodeError:
-        raise Exception(f"{camera.name} [{camera.host}] Failed to decode VAPIX NTP client configuration response, possible malformed response from axis client..")
-
-
-def disk_check(camera: VAPIX):
+    response = await camera._ntp_client(data=payload)
+    logger.debug(f"{camera.name} [{camera.host}] Configure NTP Client response: {response.text}")
+    # a misconfigured NTP client could cause RTSP timeouts on live streams
+    camera.parse(response, "configuring NTP client")
+    logger.info(f"{camera.name} [{camera.host}] -  Successfully configured NTP client")
+
+
+async def disk_check(camera: AsyncVAPIX, waits: list = None):
     """
     Performs a check for SD card and reports back what it found.
     If the SD card was not formatted with ext4, prompt the user if the disk should be formatted.
@@ -245,13 +425,9 @@ def disk_check(camera: VAPIX):
     SD cards can be formatted with ext4 or vfat. 
     Using ext4 is recommended to reduce the risk of data loss if the card is ejected and after abrupt power cycling
     """
-    response = camera._list_disks(params={'diskid': 'all'})
-
-    if not response or not response.ok:
-        raise Exception(f'{camera.name} [{camera.host}] -  Something went wrong... Failed to list disks')
-
+    response = await camera._list_disks(params={'diskid': 'all'})
     logger.debug(f"{camera.name} [{camera.host}] Disk check response: {response.text}")
-    root = ElementTree.fromstring(response.content)
+    root = camera.parse_xml(response, "listing disks")
     disk = root.find('disks').find('disk')
 
     status = disk.get('status')
@@ -263,16 +439,14 @@ def disk_check(camera: VAPIX):
     if filesystem != DEFAULT_FILESYSTEM_FORMAT and status != 'disconnected':
         logger.info(f"Reformat SD card to {DEFAULT_FILESYSTEM_FORMAT} filesystem")
         logger.warning("IMPORTANT: Any data present on the disk is lost when the disk is formatted.")
-        format_disk(camera, disk_id=disk.get('diskid'))
+        await format_disk(camera, disk_id=disk.get('diskid'), waits=waits)
 
 
-def mount_disk(camera: VAPIX, action, disk_id):
+async def mount_disk(camera: AsyncVAPIX, action, disk_id):
     """ Mount/Unmount when formatting SD Card """
-    response = camera._disk_mount(params={'action': action, 'diskid': disk_id})
-    if not response:
-        raise Exception(f"{camera.name} [{camera.host}] - Error on request to {action} disk")
+    response = await camera._disk_mount(params={'action': action, 'diskid': disk_id})
     logger.debug(f"{camera.name} [{camera.host}] Disk mount response: {response.text}")
-    root = ElementTree.fromstring(response.content)
+    root = camera.parse_xml(response, f"requesting to {action} disk")
     job = root.find('job')
     result = job.get('result') if isinstance(job, ElementTree.Element) else None
     if result == 'OK':
@@ -281,19 +455,16 @@ def mount_disk(camera: VAPIX, action, disk_id):
         raise Exception(f"{camera.name} [{camera.host}] -  Failed to {action} disk")
 
 
-def format_disk(camera: VAPIX, disk_id):
+async def format_disk(camera: AsyncVAPIX, disk_id, waits: list = None):
     """ Formats the SD card to the default fileystem format specified """
-    response = camera._format_disk(params={'diskid': disk_id, 'filesystem': DEFAULT_FILESYSTEM_FORMAT})
-    if response and response.status_code == 403:
+    response = await camera._format_disk(params={'diskid': disk_id, 'filesystem': DEFAULT_FILESYSTEM_FORMAT})
+    if response.status_code == 403:
         # Need to unmount disk if this error is thrown and try again.
-        mount_disk(camera, action='unmount', disk_id=disk_id)
-        response = camera._format_disk(params={'diskid': disk_id, 'filesystem': DEFAULT_FILESYSTEM_FORMAT})
-
-    if not response:
-        raise Exception(f"{camera.name} [{camera.host}] -  Error on request to format disk to {DEFAULT_FILESYSTEM_FORMAT}")
+        await mount_disk(camera, action='unmount', disk_id=disk_id)
+        response = await camera._format_disk(params={'diskid': disk_id, 'filesystem': DEFAULT_FILESYSTEM_FORMAT})
 
     logger.debug(f"{camera.name} [{camera.host}] Disk format response: {response.text}")
-    root = ElementTree.fromstring(response.content)
+    root = camera.parse_xml(response, f"requesting to format disk to {DEFAULT_FILESYSTEM_FORMAT}")
     job = root.find('job')
     result = job.get('result') if isinstance(job, ElementTree.Element) else None
 
@@ -301,47 +472,66 @@ def format_disk(camera: VAPIX, disk_id):
         raise Exception((f"{camera.name} [{camera.host}] -  Error attempting to format to {DEFAULT_FILESYSTEM_FORMAT}"))
 
     logger.info(f"{camera.name} [{camera.host}] -  Formatting to {DEFAULT_FILESYSTEM_FORMAT}")
-    wait_on_disk_format_job_to_complete(camera, disk_id=disk_id, job_id=job.get('jobid'))
-    mount_disk(camera, action='mount', disk_id=disk_id)
+    await wait_on_disk_format_job_to_complete(camera, disk_id=disk_id, job_id=job.get('jobid'), waits=waits)
+    await mount_disk(camera, action='mount', disk_id=disk_id)
 
 
-def wait_on_disk_format_job_to_complete(camera: VAPIX, disk_id, job_id):
-    """ Waits for the job to complete before returing """
-    done = False
-    while not done:
-        response = camera._job_progress(params={'jobid': job_id, 'diskid': disk_id})
+async def wait_on_disk_format_job_to_complete(camera: AsyncVAPIX, disk_id, job_id, waits: list = None):
+    """ Waits for the job to complete before returing, the job progress is polled with backoff until it reaches 100% """
+    async def job_completed() -> bool:
+        try:
+            response = await camera._job_progress(params={'jobid': job_id, 'diskid': disk_id})
+        except CircuitOpenError:
+            raise
+        except DeviceUnreachableError:
+            # a busy camera may miss a progress request while formatting, only a camera that is gone fails the wait
+            return False
         logger.debug(f"{camera.name} [{camera.host}] Job progress response: {response.text}")
-        root = ElementTree.fromstring(response.content)
+        root = camera.parse_xml(response, f"checking progress of format job {job_id}")
         job = root.find('job')
         result = job.get('result') if isinstance(job, ElementTree.Element) else None
-        if result == 'OK':
-            percentage = job.get('progress')
-            logger.info(f"{camera.name} [{camera.host}] -  Progress {percentage}%")
-            done = True if percentage == "100" else time.sleep(5)
-        elif result == 'ERROR':
+        if result == 'ERROR':
             raise Exception(f"{camera.name} [{camera.host}] -  Error attempting to format to {DEFAULT_FILESYSTEM_FORMAT}")
+        if result == 'OK':
+            logger.info(f"{camera.name} [{camera.host}] -  Progress {job.get('progress')}%")
+            return job.get('progress') == "100"
+        return False
+
+    await poll_async(
+        job_completed,
+        timeout=FORMAT_JOB_TIMEOUT,
+        name=f"{camera.name} [{camera.host}] format job {job_id}",
+        # the job progress used to be polled every 5 seconds
+        baseline=lambda elapsed: math.ceil(elapsed / 5) * 5,
+        waits=waits,
+        interval=1,
+        max_interval=5
+    )
     logger.info(f"{camera.name} [{camera.host}] -  Succesfully formatted filesystem {DEFAULT_FILESYSTEM_FORMAT}")
 
 
-def set_zipstream_gop_settings(camera: VAPIX):
+async def set_zipstream_gop_settings(camera: AsyncVAPIX, snapshot: Snapshot):
     """ 
     Update GOP to dynamic and set max gop length to fps.
     This updates for all channels.
     """
-    response = camera._set_zipstream_gop(params={'schemaversion': '1', 'gopmode': 'dynamic', 'maxgoplength': '15'})
-    if response and response.ok:
-        logger.debug(f"{camera.name} [{camera.host}] Set zipstream gop response: {response.text}")
-        root = ElementTree.fromstring(response.content)
-        for child in root:
-            if 'Success' in child.tag:
-                logger.info(f"{camera.name} [{camera.host}] -  Successfully configured dynmaic GOP")
-            if 'Error' in child.tag:
-                raise Exception(f"{camera.name} [{camera.host}] -  Failed to update GOP settings")
-    else:
-        raise Exception(f"{camera.name} [{camera.host}] -  Failed to update GOP settings")
-
-
-def set_zipstream_strength(camera: VAPIX, strength: int):
+    current = [(channel.get('mode'), channel.get('maxgoplength')) for channel in snapshot.gop or []]
+    if current and all(channel == ('dynamic', '15') for channel in current):
+        logger.info(f"{camera.name} [{camera.host}] -  Dynamic GOP is already configured")
+        return
+    snapshot.record('set_zipstream_gop_settings', 'gop', current or None, ('dynamic', '15'))
+
+    response = await camera._set_zipstream_gop(params={'schemaversion': '1', 'gopmode': 'dynamic', 'maxgoplength': '15'})
+    logger.debug(f"{camera.name} [{camera.host}] Set zipstream gop response: {response.text}")
+    root = camera.parse_xml(response, "updating GOP settings")
+    for child in root:
+        if 'Success' in child.tag:
+            logger.info(f"{camera.name} [{camera.host}] -  Successfully configured dynmaic GOP")
+        if 'Error' in child.tag:
+            raise DeviceError(f"{camera.name} [{camera.host}] -  Failed to update GOP settings")
+
+
+async def set_zipstream_strength(camera: AsyncVAPIX, snapshot: Snapshot, strength: int):
     """
     Zipstream strength 30 or higher with dynamic GOP is recommended,
     for cameras that are connected to the cloud and,
@@ -352,41 +542,40 @@ def set_zipstream_strength(camera: VAPIX, strength: int):
     strength: string
         - off, 10, 20, 30, 40, 50
     """
-    response = camera._set_zipstream_strength(params={'schemaversion': '1', 'strength': str(strength)})
-    if response and response.ok:
-        logger.debug(f"{camera.name} [{camera.host}] Set zipstream strength response: {response.text}")
-        root = ElementTree.fromstring(response.content)
-        for child in root:
-            if 'Success' in child.tag:
-                logger.info(f"{camera.name} [{camera.host}] -  Successfully set zipstream strength to {strength}")
-            if 'Error' in child.tag:
-                raise Exception(f"{camera.name} [{camera.host}] -  Failed to update zipstream strength")
-    else:
-        raise Exception(f'{camera.name} [{camera.host}] Something went wrong... Failed to set zipstream strength')
-
-
-def configure_textoverlays(camera: VAPIX):
+    current = [channel.get('value') for channel in snapshot.strength or []]
+    if current and all(value == str(strength) for value in current):
+        logger.info(f"{camera.name} [{camera.host}] -  Zipstream strength is already {strength}")
+        return
+    snapshot.record('set_zipstream_strength', 'strength', current or None, str(strength))
+
+    response = await camera._set_zipstream_strength(params={'schemaversion': '1', 'strength': str(strength)})
+    logger.debug(f"{camera.name} [{camera.host}] Set zipstream strength response: {response.text}")
+    root = camera.parse_xml(response, "setting zipstream strength")
+    for child in root:
+        if 'Success' in child.tag:
+            logger.info(f"{camera.name} [{camera.host}] -  Successfully set zipstream strength to {strength}")
+        if 'Error' in child.tag:
+            raise DeviceError(f"{camera.name} [{camera.host}] -  Failed to update zipstream strength")
+
+
+async def configure_textoverlays(camera: AsyncVAPIX, snapshot: Snapshot):
     """ Checks for the textoverlay on every channel.  If channel is missing overlay then it is added. """
-    payload = json.dumps({"apiVersion": "1.0", "context": "FO Configuration Managememnt", "method": "list", "params": {}})
-    response = camera._text_overlay(data=payload)
-    if response and response.ok:
-        logger.debug(f"{camera.name} [{camera.host}] List textoverlay response: {response.text}")
-        result = response.json()
-        error = result.get('error')
-        if error:
-            raise Exception(f"{camera.name} [{camera.host}] -  Error {error.get('code')} when finding textoverlays. {error.get('message')}")
-        overlays = result.get('data', {}).get('textOverlays')
+    overlays = snapshot.overlays
+    if overlays is not None:
         logger.info(f"{camera.name} [{camera.host}] -  Found {len(overlays)} overlays")
         channels = {overlay.get('camera') for overlay in overlays if overlay.get('text') == DEFAULT_TEXT_OVERLAY}
+        missing = []
         for channel in range(1, 13):
             if channel in channels:
                 logger.info(f"{camera.name} [{camera.host}] -  Already has text overlay set for camera channel {channel}")
             else:
-                add_text_overlay(camera, channel)
+                snapshot.record('configure_textoverlays', f'channel {channel}', None, DEFAULT_TEXT_OVERLAY)
+                missing.append(add_text_overlay(camera, channel))
+        await run_concurrently(*missing)
     else:
         raise Exception(f"{camera.name} [{camera.host}] -  Problem finding text overlays..")
 
-def add_text_overlay(camera: VAPIX, channel):
+async def add_text_overlay(camera: AsyncVAPIX, channel):
     """ Adds a timestamp textoverlay to every channel. """
     payload = json.dumps(
         {
@@ -396,16 +585,7 @@ def add_text_overlay(camera: VAPIX, channel):
             "params": {"camera": channel, "text": DEFAULT_TEXT_OVERLAY, "position": "topLeft", "textColor": "white"},
         }
     )
-    response = camera._text_overlay(data=payload)
-    if response and response.ok:
-        logger.debug(f"{camera.name} [{camera.host}] Add textoverlay response: {response.text}")
-        result = response.json()
-        error = result.get('error')
-        if error:
-            raise Exception(
-                f"{camera.name} [{camera.host}] -  Error {error.get('code')} when adding textoverlay to camera channel {channel}. {error.get('message')}"
-            )
-        else:
-            logger.info(f"{camera.name} [{camera.host}] -  Successfully added text overlay for channel {channel}")
-    else:
-        raise Exception(f"{camera.name} [{camera.host}] -  Problem adding text overlay to camera channel {channel}")
+    response = await camera._text_overlay(data=payload)
+    logger.debug(f"{camera.name} [{camera.host}] Add textoverlay response: {response.text}")
+    camera.parse(response, f"adding textoverlay to camera channel {channel}")
+    logger.info(f"{camera.name} [{camera.host}] -  Successfully added text overlay for channel {channel}")
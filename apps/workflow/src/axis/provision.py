@@ -2,11 +2,22 @@ import json
 import time
 import logging
 
-from utilities.vapix import VAPIX
-from utilities.command import resolve_ip_address, is_reachable
+from utilities.timeouts import AdaptiveTimeouts
+from utilities.vapix import VAPIX, AuthenticationError, DeviceUnreachableError, DeviceError, MalformedResponseError
+from utilities.reachability import wait_until_up
+from utilities.leases import wait_for_ip_address
+from utilities.announcements import search
+from utilities.discovery import resolve_ip_address, discovery_options
+from utilities.wait import poll
 
 logger = logging.getLogger(__name__)
 
+# Seconds to resolve the new DHCP assigned ip address of a camera that was not on DHCP, and the shares of that deadline
+# the lease service and the announcement search may use at most, so scanning always gets the rest of it
+DHCP_RESOLVE_TIMEOUT = 120
+DHCP_LEASE_WAIT_SHARE = 0.5
+DHCP_ANNOUNCEMENT_SEARCH_SHARE = 0.25
+
 
 def provision(resource: dict, state: dict) -> str:
     """
@@ -17,97 +28,142 @@ def provision(resource: dict, state: dict) -> str:
         name=resource['metadata']['name'],
         host=state['ip_address'],
         username='root',
-        password='admin'
+        password='admin',
+        timeouts=AdaptiveTimeouts.from_state(state)
     )
 
-    # update credentials for following steps
-    state['username'] = camera.username
-    state['password'] = camera.password
-
-    logger.info(f"Attempting to provision AXIS camera {camera.name} - {camera.host}")
-
-    # We need to create the initial root admin user to allow log-in access on the device.
-    # The username must be root and the role must be Administrator with PTZ control. 
-    # Please note that this user can only be created once and can not be deleted.
-    if is_missing_initial_admin_user(camera):
-        logger.info(f"AXIS camera {camera.name} is missing initial admin user. Creating...")
-        create_axis_user(
-            camera,
-            username=camera.username,
-            password=camera.password
-        )
-
-    # Verify that we have root access to the device
-    if not has_root_access(camera):
-        raise Exception(f"Cannot provision AXIS camera {camera.name} as the workflow could not achieve root access privileges")
-
-    # Assign static ip address and hostname if network mode is 'static'
-    if resource['spec']['network']['mode'] == 'static':
-        # enable static IPv4 configuration
-        assign_static_hostname(camera)
-        assign_static_ipv4_address(
-            camera,
-            static_ip_address=resource['spec']['network']['static_ip_address'],
-            router_ip_address=resource['spec']['network']['router_ip_address']
-        )
-
-        # if the ip address is changing, we need to wait for the camera to respond at the new ip address
-        if state['ip_address'] != resource['spec']['network']['static_ip_address']:
-            logger.info(f"Attempting to resolve the AXIS camera {camera.name} at the new static ip address '{resource['spec']['network']['static_ip_address']}'")
-            is_reachable(
-                ip_address=resource['spec']['network']['static_ip_address'],
-                timeout=60
+    try:
+        # update credentials for following steps
+        state['username'] = camera.username
+        state['password'] = camera.password
+
+        logger.info(f"Attempting to provision AXIS camera {camera.name} - {camera.host}")
+
+        # We need to create the initial root admin user to allow log-in access on the device.
+        # The username must be root and the role must be Administrator with PTZ control. 
+        # Please note that this user can only be created once and can not be deleted.
+        if is_missing_initial_admin_user(camera):
+            logger.info(f"AXIS camera {camera.name} is missing initial admin user. Creating...")
+            create_axis_user(
+                camera,
+                username=camera.username,
+                password=camera.password
             )
 
-        # Update state to reflect the new static ip address because the camera will now be
-        # responding on this ip since it was just assigned.
-        state['ip_address'] = resource['spec']['network']['static_ip_address']
-        # Update the camera host to reflect the static ip address so future configure requests are successful
-        camera.host = state['ip_address']
+        # Verify that we have root access to the device, retrying with the same credentials can not help
+        if not has_root_access(camera):
+            raise AuthenticationError(f"Cannot provision AXIS camera {camera.name} as the workflow could not achieve root access privileges")
+
+        # Assign static ip address and hostname if network mode is 'static'
+        if resource['spec']['network']['mode'] == 'static':
+            # enable static IPv4 configuration
+            assign_static_hostname(camera)
+            assign_static_ipv4_address(
+                camera,
+                static_ip_address=resource['spec']['network']['static_ip_address'],
+                router_ip_address=resource['spec']['network']['router_ip_address']
+            )
 
-    # Enable DHCP address and hostname configuration if network mode is 'dhcp'
-    elif resource['spec']['network']['mode'] == 'dhcp':
-        # fetch initial network information
-        data = get_network_info(camera)
-        # Enable DHCP configuration
-        enable_hostname_configuration_via_dchp(camera)
-        enable_ipv4_address_configuration_via_dhcp(camera)
-
-        # If the camera was not on dhcp initially, the assigend dhcp ip address may not immediately be available after enabling dhcp configuration
-        mode = None
-        for device in data['devices']:
-            if device['name'] == 'eth0':
-                mode = device['IPv4']['configurationMode']
-                if mode != 'dhcp':
-                    logger.info(f"Attemping to resolve the new DHCP assigned ip address for AXIS camera '{camera.name}'")
-                    now = time.time()
-                    while time.time() - now < 120:
-                        resolved_ip_address = resolve_ip_address(
-                            mac_address = resource['spec']['network']['mac_address'],
-                            subnet = resource['spec']['network']['subnet']
-                        )
-                        # check if we can resolve the new dhcp ip address
-                        # if resolved, update the state and break out of the loop
-                        if resolved_ip_address != camera.host:
-                            state['ip_address'] = resolved_ip_address
-                            camera.host = state['ip_address']
-                            break
-                        else:
-                            logger.info(f"Discovered the The DHCP assigned ip address for AXIS camera '{camera.name}' has not been assigned or responded yet. Will attempt to resolve the new dhcp address in 5 seconds...")
-        else:
-            # Update state to reflect the new DHCP ip address because the camera will now be
+            # if the ip address is changing, we need to wait for the camera to respond at the new ip address
+            if state['ip_address'] != resource['spec']['network']['static_ip_address']:
+                logger.info(f"Attempting to resolve the AXIS camera {camera.name} at the new static ip address '{resource['spec']['network']['static_ip_address']}'")
+                wait_until_up(
+                    host=resource['spec']['network']['static_ip_address'],
+                    timeout=60
+                )
+
+            # Update state to reflect the new static ip address because the camera will now be
             # responding on this ip since it was just assigned.
-            logger.info(f"AXIS camera '{camera.name}' was already on DHCP and should not have changed ip address. will attempt to resolve the camera again though.")
-            state['ip_address'] = resolve_ip_address(
-                mac_address = resource['spec']['network']['mac_address'],
-                subnet = resource['spec']['network']['subnet']
-            )
-            if state['ip_address'] != camera.host:
-                logger.warning(f"AXIS camera '{camera.name}' unexpectedly changed ip address from '{camera.host}' to '{state['ip_address']}'")
-            # Update the camera host to reflect the dhcp ip address so future configure requests are successful
+            state['ip_address'] = resource['spec']['network']['static_ip_address']
+            # Update the camera host to reflect the static ip address so future configure requests are successful
             camera.host = state['ip_address']
 
-    logger.info(f"Successfully provisioned AXIS camera {camera.name} - {camera.host}")
+        # Enable DHCP address and hostname configuration if network mode is 'dhcp'
+        elif resource['spec']['network']['mode'] == 'dhcp':
+            # fetch initial network information
+            data = get_network_info(camera)
+            # Enable DHCP configuration
+            enable_hostname_configuration_via_dchp(camera)
+            enable_ipv4_address_configuration_via_dhcp(camera)
+
+            # If the camera was not on dhcp initially, the assigend dhcp ip address may not immediately be available after enabling dhcp configuration
+            mode = None
+            for device in data['devices']:
+                if device['name'] == 'eth0':
+                    mode = device['IPv4']['configurationMode']
+                    if mode != 'dhcp':
+                        logger.info(f"Attemping to resolve the new DHCP assigned ip address for AXIS camera '{camera.name}'")
+                        now = time.time()
+                        deadline = time.monotonic() + DHCP_RESOLVE_TIMEOUT
+                        remaining = lambda: max(deadline - time.monotonic(), 0)
+                        # the lease service sees the DHCP acknowledgement or the first ARP from the new ip address,
+                        # the subnet is only scanned if the lease service is not available or did not see it in time
+                        resolved_ip_address = wait_for_ip_address(
+                            mac_address=resource['spec']['network']['mac_address'],
+                            exclude_ip_address=camera.host,
+                            since=now,
+                            timeout=DHCP_RESOLVE_TIMEOUT * DHCP_LEASE_WAIT_SHARE
+                        )
+                        if resolved_ip_address:
+                            logger.info(f"Lease service saw AXIS camera '{camera.name}' at the new DHCP assigned ip address '{resolved_ip_address}'")
+                        elif discovery_options(resource)['announcements']:
+                            # AXIS cameras announce themselves once they have their DHCP lease
+                            resolved_ip_address = search(
+                                mac_address=resource['spec']['network']['mac_address'],
+                                subnet=resource['spec']['network']['subnet'],
+                                exclude_ip_address=camera.host,
+                                timeout=min(DHCP_RESOLVE_TIMEOUT * DHCP_ANNOUNCEMENT_SEARCH_SHARE, remaining())
+                            )
+                        if not resolved_ip_address:
+                            def new_ip_address():
+                                try:
+                                    ip_address = resolve_ip_address(
+                                        mac_address = resource['spec']['network']['mac_address'],
+                                        subnet = resource['spec']['network']['subnet'],
+                                        **discovery_options(resource, last_known_ip_address=camera.host)
+                                    )
+                                except Exception as e:
+                                    logger.info(f"The DHCP assigned ip address for AXIS camera '{camera.name}' could not be resolved yet: {e}")
+                                    return None
+                                # the camera may still answer at its previous ip address until the DHCP lease is applied
+                                return ip_address if ip_address != camera.host else None
+                            try:
+                                resolved_ip_address = poll(
+                                    new_ip_address,
+                                    timeout=remaining(),
+                                    name=f"the DHCP assigned ip address of AXIS camera '{camera.name}'",
+                                    waits=state.setdefault('waits', []),
+                                    interval=1,
+                                    max_interval=10
+                                )
+                            except Exception as e:
+                                raise Exception(
+                                    f"Could not resolve a new DHCP assigned ip address for AXIS camera '{camera.name}' "
+                                    f"(previously '{camera.host}') within {DHCP_RESOLVE_TIMEOUT} seconds"
+                                ) from e
+                        state['ip_address'] = resolved_ip_address
+                        camera.host = state['ip_address']
+            else:
+                # Update state to reflect the new DHCP ip address because the camera will now be
+                # responding on this ip since it was just assigned.
+                logger.info(f"AXIS camera '{camera.name}' was already on DHCP and should not have changed ip address. will attempt to resolve the camera again though.")
+                state['ip_address'] = resolve_ip_address(
+                    mac_address = resource['spec']['network']['mac_address'],
+                    subnet = resource['spec']['network']['subnet'],
+                    **discovery_options(resource, last_known_ip_address=camera.host)
+                )
+                if state['ip_address'] != camera.host:
+                    logger.warning(f"AXIS camera '{camera.name}' unexpectedly changed ip address from '{camera.host}' to '{state['ip_address']}'")
+                # Update the camera host to reflect the dhcp ip address so future configure requests are successful
+                camera.host = state['ip_address']
+
+        logger.info(f"Successfully provisioned AXIS camera {camera.name} - {camera.host}")
+    finally:
+        # record how many connections and digest challenges were reused so it can be reported
+        state.setdefault('vapix', {})['provision'] = camera.statistics()
+        # later steps start from the timeouts learned from the response times of the camera
+        state['vapix']['timeouts'] = camera.timeouts.to_state()
+        camera.close()
     return state
 
 
@@ -123,20 +179,31 @@ def get_network_info(camera: VAPIX) -> dict:
         }
     )
     response = camera._network_settings(data=payload)
-    if not response or not response.ok:
-        raise Exception(f"{camera.name} [{camera.host}] - Something went wrong when fetching network information..")
-
-    result = response.json()
-    error = result.get('error')
-    if error:
-        raise Exception(f"{camera.name} [{camera.host}] -  Error {error.get('code')} when getting network information. {error.get('message')}")
-    else:
-        logger.info(f"{camera.name} [{camera.host}] -  Successfully fetched network information")
-        return result.get('data')
+    result = camera.parse(response, "getting network information")
+    logger.info(f"{camera.name} [{camera.host}] -  Successfully fetched network information")
+    return result.get('data')
 
 
-
-def is_missing_initial_admin_user(camera: VAPIX):
+def answers_network_info(camera: VAPIX) -> bool:
+    """
+    Readiness predicate, returns True once the AXIS camera answers getNetworkInfo at its host
+    and reports the host as one of its IPv4 addresses, so network configuration changes have been applied.
+    Rejected credentials are raised, waiting longer can not fix them.
+    """
+    try:
+        data = get_network_info(camera)
+    except (DeviceUnreachableError, DeviceError, MalformedResponseError) as e:
+        logger.debug(f"{camera.name} [{camera.host}] -  Not ready: {e}")
+        return False
+    addresses = [
+        address.get('address')
+        for device in (data or {}).get('devices', [])
+        for address in device.get('IPv4', {}).get('addresses', [])
+    ]
+    return not addresses or camera.host in addresses
+
+
+def is_missing_initial_admin_user(camera: VAPIX) -> bool:
     """
     Returns True if camera is missing the initial root admin user. False otherwise.
     NOTE: if the camera is missing the initial root admin user,
@@ -214,15 +281,8 @@ def assign_static_ipv4_address(camera: VAPIX, static_ip_address: str, router_ip_
         }
     )
     response = camera._network_settings(data=payload)
-    if not response or not response.ok:
-        raise Exception(f"{camera.name} [{camera.host}] - Something went wrong when assigning a static IP..")
-
-    result = response.json()
-    error = result.get('error')
-    if error:
-        raise Exception(f"{camera.name} [{camera.host}] -  Error {error.get('code')} when assigning static IPv4 address. {error.get('message')}")
-    else:
-        logger.info(f"{camera.name} [{camera.host}] -  Successfully assigned static IPv4 address of {static_ip_address}")
+    camera.parse(response, "assigning static IPv4 address")
+    logger.info(f"{camera.name} [{camera.host}] -  Successfully assigned static IPv4 address of {static_ip_address}")
 
 
 def assign_static_hostname(camera: VAPIX):
@@ -241,15 +301,8 @@ def assign_static_hostname(camera: VAPIX):
         }
     )
     response = camera._network_settings(data=payload)
-    if not response or not response.ok:
-        raise Exception(f"{camera.name} [{camera.host}] - Something went wrong when assigning static hostname '{camera.name}'..")
-
-    result = response.json()
-    error = result.get('error')
-    if error:
-        raise Exception(f"{camera.name} [{camera.host}] -  Error {error.get('code')} when assigning static hostname '{camera.name}'. {error.get('message')}")
-    else:
-        logger.info(f"{camera.name} [{camera.host}] -  Successfully assigned static hostname '{camera.name}'")
+    camera.parse(response, f"assigning static hostname '{camera.name}'")
+    logger.info(f"{camera.name} [{camera.host}] -  Successfully assigned static hostname '{camera.name}'")
 
 
 def enable_hostname_configuration_via_dchp(camera: VAPIX):
@@ -268,15 +321,8 @@ def enable_hostname_configuration_via_dchp(camera: VAPIX):
         }
     )
     response = camera._network_settings(data=payload)
-    if not response or not response.ok:
-        raise Exception(f"{camera.name} [{camera.host}] - Something went wrong when enabling hostname configuration via DHCP..")
-
-    result = response.json()
-    error = result.get('error')
-    if error:
-        raise Exception(f"{camera.name} [{camera.host}] -  Error {error.get('code')} when enabling automatic hostname assignment via DHCP. {error.get('message')}")
-    else:
-        logger.info(f"{camera.name} [{camera.host}] -  Successfully enabled automatic hostname assignment on device")
+    camera.parse(response, "enabling automatic hostname assignment via DHCP")
+    logger.info(f"{camera.name} [{camera.host}] -  Successfully enabled automatic hostname assignment on device")
 
 
 def enable_ipv4_address_configuration_via_dhcp(camera: VAPIX):
@@ -296,12 +342,5 @@ def enable_ipv4_address_configuration_via_dhcp(camera: VAPIX):
         }
     )
     response = camera._network_settings(data=payload)
-    if not response or not response.ok:
-        raise Exception(f"{camera.name} [{camera.host}] - Something went wrong when enabling IPv4 address configuraiton via DHCP..")
-
-    result = response.json()
-    error = result.get('error')
-    if error:
-        raise Exception(f"{camera.name} [{camera.host}] -  Error {error.get('code')} when enabing DHCP address configuration. {error.get('message')}")
-    else:
-        logger.info(f"{camera.name} [{camera.host}] -  Successfully enabled IPv4 address configuration via DHCP")
+    camera.parse(response, "enabling DHCP address configuration")
+    logger.info(f"{camera.name} [{camera.host}] -  Successfully enabled IPv4 address configuration via DHCP")
@@ -0,0 +1,201 @@
+import os
+import json
+import time
+import asyncio
+import logging
+
+from axis.configure import (
+    PRODUCTION_FIRMWARE_RELEASE,
+    active_firmware_version,
+    check_firmware,
+    firmware_lists,
+    needs_firmware_upgrade,
+)
+from utilities.state import save
+from utilities.throttle import TokenBucket
+from utilities.timeouts import AdaptiveTimeouts
+from utilities.vapix import AsyncVAPIX
+
+logger = logging.getLogger(__name__)
+
+# Defaults of the rollout policy, overridable with the ROLLOUT_* environment variables
+DEFAULT_CANARIES = 1
+DEFAULT_MAX_CONCURRENCY = 4
+DEFAULT_MAX_SITE_CONCURRENCY = 2
+DEFAULT_SITE_UPLINK_MBPS = 20
+DEFAULT_MAX_ERROR_RATE = 0.2
+
+
+class RolloutPolicy:
+    """
+    How a firmware rollout is scheduled.
+
+    canaries: cameras upgraded on their own first, the rollout stops if any of them fails
+    max_concurrency: cameras upgraded at the same time across every site, this is also the size of a wave
+    max_site_concurrency: cameras upgraded at the same time on a single site
+    site_uplink_mbps: bandwidth shared by the uploads to the cameras of a site, in megabits per second
+    max_error_rate: the rollout stops once the share of failed upgrades is above it
+    """
+
+    def __init__(self, canaries: int = DEFAULT_CANARIES, max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+                 max_site_concurrency: int = DEFAULT_MAX_SITE_CONCURRENCY, site_uplink_mbps: float = DEFAULT_SITE_UPLINK_MBPS,
+                 max_error_rate: float = DEFAULT_MAX_ERROR_RATE):
+        self.canaries = canaries
+        self.max_concurrency = max(max_concurrency, 1)
+        self.max_site_concurrency = max(max_site_concurrency, 1)
+        self.site_uplink_mbps = site_uplink_mbps
+        self.max_error_rate = max_error_rate
+
+
+    @classmethod
+    def from_env(cls) -> 'RolloutPolicy':
+        return cls(
+            canaries=int(os.getenv('ROLLOUT_CANARIES', DEFAULT_CANARIES)),
+            max_concurrency=int(os.getenv('ROLLOUT_MAX_CONCURRENCY', DEFAULT_MAX_CONCURRENCY)),
+            max_site_concurrency=int(os.getenv('ROLLOUT_MAX_SITE_CONCURRENCY', DEFAULT_MAX_SITE_CONCURRENCY)),
+            site_uplink_mbps=float(os.getenv('ROLLOUT_SITE_UPLINK_MBPS', DEFAULT_SITE_UPLINK_MBPS)),
+            max_error_rate=float(os.getenv('ROLLOUT_MAX_ERROR_RATE', DEFAULT_MAX_ERROR_RATE)),
+        )
+
+
+def load_inventory(path: str) -> list:
+    """
+    Loads the cameras of a rollout from a JSON file, a list of objects with a name, host and optionally
+    username, password (defaulting to the provisioned root credentials) and site (defaulting to 'default').
+    """
+    with open(path) as f:
+        cameras = json.load(f)
+    return [
+        {
+            'name': camera['name'],
+            'host': camera['host'],
+            'username': camera.get('username', 'root'),
+            'password': camera.get('password', 'admin'),
+            'site': camera.get('site', 'default'),
+        }
+        for camera in cameras
+    ]
+
+
+def plan(cameras: list, policy: RolloutPolicy) -> list:
+    """
+    Splits the cameras into waves, the canaries first and then waves of max_concurrency cameras.
+    Cameras of different sites are interleaved so every wave spreads its uploads over as many uplinks as possible.
+    """
+    sites = {}
+    for camera in cameras:
+        sites.setdefault(camera['site'], []).append(camera)
+    interleaved = []
+    while any(sites.values()):
+        for site in list(sites):
+            if sites[site]:
+                interleaved.append(sites[site].pop(0))
+
+    canaries, rest = interleaved[:policy.canaries], interleaved[policy.canaries:]
+    waves = [canaries] if canaries else []
+    waves += [rest[i:i + policy.max_concurrency] for i in range(0, len(rest), policy.max_concurrency)]
+    return waves
+
+
+class Rollout:
+    """
+    Upgrades the firmware of a fleet of cameras to the production release in waves.
+
+    The canaries are upgraded first and the rollout stops if any of them fails. The following waves are upgraded
+    with at most max_concurrency cameras at a time, max_site_concurrency of them on the same site, and the uploads to a site
+    share its uplink bandwidth. The rollout stops before the next wave once the error rate is above max_error_rate.
+    Cameras that already run the release or a version of the firmware allow list are skipped, a release on the deny list is refused.
+    Progress is kept in the state (one entry per camera) and saved after every camera.
+    """
+
+    def __init__(self, cameras: list, policy: RolloutPolicy, state: dict, on_progress=None):
+        self.cameras = cameras
+        self.policy = policy
+        self.state = state
+        self.on_progress = on_progress
+        # a rollout resumed from its state only upgrades the cameras that have not succeeded or been skipped
+        self.progress = state.setdefault('rollout', {'release': PRODUCTION_FIRMWARE_RELEASE, 'cameras': {}})
+        for camera in cameras:
+            self.progress['cameras'].setdefault(camera['name'], {'phase': 'Pending', 'site': camera['site']})
+        self.semaphore = asyncio.Semaphore(policy.max_concurrency)
+        self.site_semaphores = {}
+        self.site_bandwidth = {}
+        for camera in cameras:
+            self.site_semaphores.setdefault(camera['site'], asyncio.Semaphore(policy.max_site_concurrency))
+            self.site_bandwidth.setdefault(camera['site'], TokenBucket(rate=policy.site_uplink_mbps * 1e6 / 8))
+
+
+    def count(self, *phases) -> int:
+        return sum(1 for camera in self.progress['cameras'].values() if camera['phase'] in phases)
+
+
+    def error_rate(self) -> float:
+        attempted = self.count('Succeeded', 'Failed')
+        return self.count('Failed') / attempted if attempted else 0
+
+
+    def report(self, name: str, **entry):
+        self.progress['cameras'][name].update(entry)
+        finished = self.count('Succeeded', 'Failed', 'Skipped')
+        logger.info(
+            f"Rollout of {self.progress['release']}: {finished}/{len(self.cameras)} finished, "
+            f"{self.count('Succeeded')} succeeded, {self.count('Failed')} failed, {self.count('Skipped')} skipped"
+        )
+        save(state=self.state)
+        if self.on_progress:
+            self.on_progress(finished, len(self.cameras))
+
+
+    async def upgrade(self, camera: dict):
+        if self.progress['cameras'][camera['name']]['phase'] in ('Succeeded', 'Skipped'):
+            return
+
+        async with self.semaphore, self.site_semaphores[camera['site']]:
+            vapix = AsyncVAPIX(name=camera['name'], host=camera['host'], username=camera['username'], password=camera['password'], timeouts=AdaptiveTimeouts())
+            start_time = time.monotonic()
+            self.report(camera['name'], phase='Running')
+            try:
+                version = await active_firmware_version(vapix)
+                if not needs_firmware_upgrade(version):
+                    self.report(camera['name'], phase='Skipped', reason=f'already on {version}')
+                    return
+                await check_firmware(vapix, bandwidth=self.site_bandwidth[camera['site']], reboots=self.progress.setdefault('reboots', {}))
+                self.report(camera['name'], phase='Succeeded', previous_version=version, duration=round(time.monotonic() - start_time, 3))
+            except Exception as e:
+                logger.error(f"{camera['name']} [{camera['host']}] -  Firmware upgrade failed: {e}")
+                self.report(camera['name'], phase='Failed', error=str(e), duration=round(time.monotonic() - start_time, 3))
+            finally:
+                vapix.close()
+
+
+    async def run(self) -> dict:
+        if PRODUCTION_FIRMWARE_RELEASE in firmware_lists()[1]:
+            raise Exception(f"Production release {PRODUCTION_FIRMWARE_RELEASE} is on the firmware deny list, it will not be rolled out")
+        # a resumed run starts over from the cameras that have not succeeded or been skipped,
+        # the outcome of the previous run must not stop this one or fail it once it succeeds
+        self.progress.pop('stopped', None)
+        for camera in self.progress['cameras'].values():
+            if camera['phase'] in ('Running', 'Failed', 'Cancelled'):
+                camera['phase'] = 'Pending'
+        waves = plan(self.cameras, self.policy)
+        for number, wave in enumerate(waves, start=1):
+            canary = number == 1 and self.policy.canaries > 0
+            logger.info(f"Starting {'canary ' if canary else ''}wave {number}/{len(waves)}: {', '.join(camera['name'] for camera in wave)}")
+            await asyncio.gather(*(self.upgrade(camera) for camera in wave))
+
+            failed = sum(1 for camera in wave if self.progress['cameras'][camera['name']]['phase'] == 'Failed')
+            if (canary and failed) or self.error_rate() > self.policy.max_error_rate:
+                reason = 'a canary failed' if canary and failed else f"the error rate {self.error_rate():.0%} is above {self.policy.max_error_rate:.0%}"
+                logger.error(f"Stopping the rollout after wave {number}/{len(waves)}, {reason}")
+                for camera in self.progress['cameras'].values():
+                    if camera['phase'] == 'Pending':
+                        camera['phase'] = 'Cancelled'
+                self.progress['stopped'] = reason
+                break
+        save(state=self.state)
+        return self.progress
+
+
+def rollout(cameras: list, policy: RolloutPolicy, state: dict, on_progress=None) -> dict:
+    """ Runs a firmware rollout of the cameras and returns its progress, see Rollout """
+    return asyncio.run(Rollout(cameras, policy, state, on_progress=on_progress).run())
@@ -0,0 +1,145 @@
+import json
+import asyncio
+import logging
+from xml.etree import ElementTree
+
+from utilities.vapix import AsyncVAPIX
+
+logger = logging.getLogger()
+
+
+class Snapshot:
+    """
+    The current configuration of the AXIS device, read once at the start of configure.
+    The configure operations compare their desired settings against the snapshot so only the settings
+    that actually differ are written to the device. Every difference is recorded in `diff`.
+
+    A part of the snapshot is None if it could not be read, in which case every setting in it is treated as changed.
+    """
+
+    def __init__(self, parameters: dict = None, ntp: dict = None, gop: list = None, strength: list = None, overlays: list = None):
+        self.parameters = parameters
+        self.ntp = ntp
+        self.gop = gop
+        self.strength = strength
+        self.overlays = overlays
+        self.diff = []
+
+
+    @classmethod
+    async def load(cls, camera: AsyncVAPIX) -> 'Snapshot':
+        """ Reads the parameters, NTP, zipstream and text overlay configuration of the device concurrently """
+        parameters, ntp, gop, strength, overlays = await asyncio.gather(
+            get_parameters(camera),
+            get_ntp_configuration(camera),
+            get_zipstream_gop(camera),
+            get_zipstream_strength(camera),
+            get_text_overlays(camera),
+        )
+        logger.info(f"{camera.name} [{camera.host}] -  Read configuration snapshot with {len(parameters or {})} parameters")
+        return cls(parameters=parameters, ntp=ntp, gop=gop, strength=strength, overlays=overlays)
+
+
+    async def reload(self, camera: AsyncVAPIX) -> 'Snapshot':
+        """ Reads the configuration again, e.g before retrying a failed operation. The differences recorded so far are kept """
+        snapshot = await Snapshot.load(camera)
+        snapshot.diff = self.diff
+        return snapshot
+
+
+    def record(self, operation: str, setting: str, current, desired):
+        """ Records a setting that differs from the desired state and will be written """
+        logger.info(f"{operation} - '{setting}' will be changed from '{current}' to '{desired}'")
+        difference = {'operation': operation, 'setting': setting, 'current': current, 'desired': desired}
+        # a retried operation records the settings it did not manage to write again
+        if not any(d['operation'] == operation and d['setting'] == setting for d in self.diff):
+            self.diff.append(difference)
+
+
+    def changed_parameters(self, operation: str, desired: dict) -> dict:
+        """ Returns the desired parameters whose current value differs from the desired value """
+        current = self.parameters or {}
+        changes = {key: str(value) for key, value in desired.items() if current.get(key) != str(value)}
+        for key, value in changes.items():
+            self.record(operation, key, current.get(key), value)
+        return changes
+
+
+def parse_parameters(text: str) -> dict:
+    """
+    Parses a param.cgi list response. Each line is formatted as root.Group.Param=value
+    """
+    parameters = {}
+    for line in text.splitlines():
+        key, separator, value = line.strip().partition('=')
+        if separator:
+            parameters[key.removeprefix('root.')] = value
+    return parameters
+
+
+async def get_parameters(camera: AsyncVAPIX) -> dict:
+    """ Lists every parameter of the device """
+    response = await camera._parameter_management(method='GET', params={'action': 'list'})
+    if not response or not response.ok or response.text.startswith('# Error'):
+        logger.warning(f"{camera.name} [{camera.host}] -  Failed to list parameters, every parameter will be written")
+        return None
+    return parse_parameters(response.text)
+
+
+async def get_ntp_configuration(camera: AsyncVAPIX) -> dict:
+    """ Gets the NTP client configuration """
+    payload = json.dumps({'apiVersion': '1.0', 'context': 'FO Configuration Management', 'method': 'getNTPInfo'})
+    response = await camera._ntp_client(data=payload)
+    try:
+        result = response.json() if response and response.ok else {}
+    except json.decoder.JSONDecodeError:
+        result = {}
+    data = result.get('data')
+    if not data:
+        logger.warning(f"{camera.name} [{camera.host}] -  Failed to get NTP client configuration, it will be written")
+        return None
+    return data.get('NTPClient', data)
+
+
+def parse_zipstream(content: bytes, attribute: str) -> list:
+    """ Returns the attributes of every element in a zipstream response that has the attribute, one per video channel """
+    root = ElementTree.fromstring(content)
+    if any('Error' in element.tag for element in root.iter()):
+        return None
+    return [dict(element.attrib) for element in root.iter() if attribute in element.attrib] or None
+
+
+async def get_zipstream_gop(camera: AsyncVAPIX) -> list:
+    """ Gets the zipstream GOP mode and maximum GOP length of every video channel """
+    response = await camera._get_zipstream_gop(params={'schemaversion': '1'})
+    try:
+        return parse_zipstream(response.content, 'mode') if response and response.ok else None
+    except ElementTree.ParseError:
+        return None
+
+
+async def get_zipstream_strength(camera: AsyncVAPIX) -> list:
+    """ Gets the zipstream strength of every video channel """
+    response = await camera._get_zipstream_strength(params={'schemaversion': '1'})
+    try:
+        return parse_zipstream(response.content, 'value') if response and response.ok else None
+    except ElementTree.ParseError:
+        return None
+
+
+async def get_text_overlays(camera: AsyncVAPIX) -> list:
+    """ Lists the text overlays of every channel """
+    payload = json.dumps({"apiVersion": "1.0", "context": "FO Configuration Managememnt", "method": "list", "params": {}})
+    response = await camera._text_overlay(data=payload)
+    if not response or not response.ok:
+        return None
+    logger.debug(f"{camera.name} [{camera.host}] List textoverlay response: {response.text}")
+    try:
+        result = response.json()
+    except json.decoder.JSONDecodeError:
+        return None
+    if result.get('error'):
+        error = result['error']
+        logger.warning(f"{camera.name} [{camera.host}] -  Error {error.get('code')} when finding textoverlays. {error.get('message')}")
+        return None
+    return result.get('data', {}).get('textOverlays')
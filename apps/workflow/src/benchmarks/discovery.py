@@ -0,0 +1,74 @@
+"""
+Compares the time to discover a camera with a single serial sweep of the subnet against a sharded parallel sweep.
+The ARP sweep is replaced with a simulated network where every window of ARP requests takes a fixed amount of time to answer,
+so the benchmark can be run anywhere without root privileges or a camera.
+
+Run from the src directory:
+    python3 -m benchmarks.discovery
+"""
+import time
+import argparse
+import ipaddress
+
+from utilities import arp, discovery
+
+TARGET_MAC_ADDRESS = '00:40:8c:1a:2b:3c'
+
+
+def simulated_network(target_ip_address: str, window_latency: float, reply_latency: float):
+    """
+    Returns a stand in for arp.arp_sweep where only the target ip address answers.
+    Each window of requests costs `window_latency` seconds, a sweep that doesn't find the target waits `reply_latency` seconds for late replies.
+    """
+    def arp_sweep(subnet, ip_address=None, mac_address=None, hosts=None, concurrency=64, timeout=2.0, cancel=None):
+        hosts = hosts if hosts is not None else [str(host) for host in ipaddress.ip_network(subnet, strict=False).hosts()]
+        for i in range(0, len(hosts), concurrency):
+            if cancel is not None and cancel.is_set():
+                return {}
+            time.sleep(window_latency)
+            if target_ip_address in hosts[i:i + concurrency]:
+                return {target_ip_address: TARGET_MAC_ADDRESS}
+        time.sleep(min(timeout, reply_latency))
+        return {}
+    return arp_sweep
+
+
+def benchmark(subnet: str, target_ip_address: str, hint: str, workers: int, window_latency: float, reply_latency: float) -> tuple:
+    """ Returns the serial and sharded sweep time in seconds """
+    arp.arp_sweep = simulated_network(target_ip_address, window_latency, reply_latency)
+    arp.resolve_from_neighbour_table = lambda mac_address, subnet: None
+    shard_subnet = discovery.shard_subnet
+
+    # serial: the whole subnet as a single shard scanned by a single worker
+    discovery.shard_subnet = lambda subnet, hints=(): [ipaddress.ip_network(subnet, strict=False)]
+    start_time = time.time()
+    assert discovery.resolve_ip_address(TARGET_MAC_ADDRESS, subnet, workers=1) == target_ip_address
+    serial = time.time() - start_time
+
+    discovery.shard_subnet = shard_subnet
+    start_time = time.time()
+    assert discovery.resolve_ip_address(TARGET_MAC_ADDRESS, subnet, workers=workers, hints=[hint]) == target_ip_address
+    sharded = time.time() - start_time
+    return serial, sharded
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=discovery.DEFAULT_DISCOVERY_WORKERS)
+    parser.add_argument('--window-latency', type=float, default=0.005, help='Simulated seconds for a window of ARP requests to be answered')
+    parser.add_argument('--reply-latency', type=float, default=0.05, help='Simulated seconds a sweep waits for late replies')
+    args = parser.parse_args()
+
+    scenarios = [
+        # subnet, camera ip address, last known ip address / dhcp range
+        ('10.0.9.0/24', '10.0.9.200', '10.0.9.180'),
+        ('10.0.8.0/22', '10.0.11.20', '10.0.11.100-10.0.11.200'),
+        ('10.0.0.0/20', '10.0.14.7', '10.0.14.30'),
+        ('10.0.0.0/20', '10.0.14.7', None),
+        ('10.0.0.0/16', '10.0.200.50', '10.0.200.10'),
+    ]
+
+    print(f"{'subnet':<16} {'camera':<14} {'hint':<26} {'serial':>9} {'sharded':>9} {'speedup':>8}")
+    for subnet, target_ip_address, hint in scenarios:
+        serial, sharded = benchmark(subnet, target_ip_address, hint, args.workers, args.window_latency, args.reply_latency)
+        print(f"{subnet:<16} {target_ip_address:<14} {str(hint):<26} {serial:>8.3f}s {sharded:>8.3f}s {serial / sharded:>7.1f}x")
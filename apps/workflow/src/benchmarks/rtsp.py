@@ -0,0 +1,195 @@
+"""
+Probes a local stand in for the RTSP server of a camera with the in process RTSP probe of the verify step and prints the stream metrics
+and the verification failures. The stand in serves a synthetic H.264 stream over interleaved TCP (SPS with the requested resolution,
+an IDR every GOP length frames and slices in between, fragmented as FU-A), paced at the requested fps, behind digest authentication.
+
+Run from the src directory:
+    python3 -m benchmarks.rtsp
+"""
+import os
+import time
+import base64
+import struct
+import hashlib
+import argparse
+import threading
+import socketserver
+
+from steps.verify import STREAM_URL, check_stream
+from utilities.rtsp import probe
+
+USERNAME = 'root'
+PASSWORD = 'admin'
+REALM = 'AXIS_ACCC8E000000'
+NONCE = '0123456789abcdef'
+MTU = 1400
+
+
+class BitWriter:
+    """ Writes the bits and exp-Golomb codes of an H.264 RBSP """
+
+    def __init__(self):
+        self.bits = []
+
+
+    def write(self, value: int, count: int):
+        self.bits += [(value >> i) & 1 for i in reversed(range(count))]
+
+
+    def ue(self, value: int):
+        value += 1
+        self.write(0, value.bit_length() - 1)
+        self.write(value, value.bit_length())
+
+
+    def rbsp(self) -> bytes:
+        self.bits.append(1)
+        self.bits += [0] * (-len(self.bits) % 8)
+        return bytes(int(''.join(map(str, self.bits[i:i + 8])), 2) for i in range(0, len(self.bits), 8))
+
+
+def synthetic_sps(width: int, height: int) -> bytes:
+    """ Returns a baseline profile SPS NAL unit of a frame of width x height pixels, multiples of 16 """
+    writer = BitWriter()
+    writer.write(66, 8)  # profile_idc
+    writer.write(0, 8)  # constraint flags
+    writer.write(31, 8)  # level_idc
+    writer.ue(0)  # seq_parameter_set_id
+    writer.ue(0)  # log2_max_frame_num_minus4
+    writer.ue(2)  # pic_order_cnt_type
+    writer.ue(1)  # max_num_ref_frames
+    writer.write(0, 1)  # gaps_in_frame_num_value_allowed_flag
+    writer.ue(width // 16 - 1)
+    writer.ue(height // 16 - 1)
+    writer.write(1, 1)  # frame_mbs_only_flag
+    writer.write(1, 1)  # direct_8x8_inference_flag
+    writer.write(0, 1)  # frame_cropping_flag
+    writer.write(0, 1)  # vui_parameters_present_flag
+    return bytes([0x67]) + writer.rbsp()
+
+
+def packetize(nal: bytes) -> list:
+    """ Splits a NAL unit into FU-A fragments (RFC 6184) when it does not fit in a packet """
+    if len(nal) <= MTU:
+        return [nal]
+    indicator = (nal[0] & 0xe0) | 28
+    chunks = [nal[1 + i:1 + i + MTU] for i in range(0, len(nal) - 1, MTU)]
+    return [
+        bytes([indicator, (0x80 if i == 0 else 0) | (0x40 if i == len(chunks) - 1 else 0) | (nal[0] & 0x1f)]) + chunk
+        for i, chunk in enumerate(chunks)
+    ]
+
+
+class StandInHandler(socketserver.StreamRequestHandler):
+
+    def send_response(self, cseq: str, status: str = '200 OK', headers: dict = None, body: bytes = b''):
+        lines = [f"RTSP/1.0 {status}", f"CSeq: {cseq}"] + [f"{key}: {value}" for key, value in (headers or {}).items()]
+        if body:
+            lines.append(f"Content-Length: {len(body)}")
+        self.wfile.write(('\r\n'.join(lines) + '\r\n\r\n').encode() + body)
+
+
+    def authorized(self, method: str, headers: dict) -> bool:
+        authorization = headers.get('authorization', '')
+        if not authorization.startswith('Digest'):
+            return False
+        fields = dict(part.strip().split('=', 1) for part in authorization[len('Digest '):].split(','))
+        fields = {key: value.strip('"') for key, value in fields.items()}
+        ha1 = hashlib.md5(f"{USERNAME}:{REALM}:{PASSWORD}".encode()).hexdigest()
+        ha2 = hashlib.md5(f"{method}:{fields['uri']}".encode()).hexdigest()
+        return fields.get('response') == hashlib.md5(f"{ha1}:{NONCE}:{ha2}".encode()).hexdigest()
+
+
+    def handle(self):
+        width, height = self.server.resolution
+        sps = synthetic_sps(width, height)
+        while True:
+            request_line = self.rfile.readline().decode().strip()
+            if not request_line:
+                return
+            method, url, _ = request_line.split(' ')
+            headers = {}
+            while line := self.rfile.readline().decode().strip():
+                key, _, value = line.partition(':')
+                headers[key.strip().lower()] = value.strip()
+            cseq = headers['cseq']
+
+            if method != 'OPTIONS' and not self.authorized(method, headers):
+                self.send_response(cseq, '401 Unauthorized', {'WWW-Authenticate': f'Digest realm="{REALM}", nonce="{NONCE}", stale="FALSE"'})
+            elif method == 'OPTIONS':
+                self.send_response(cseq, headers={'Public': 'OPTIONS, DESCRIBE, SETUP, PLAY, TEARDOWN'})
+            elif method == 'DESCRIBE':
+                sdp = (
+                    "v=0\r\no=- 0 0 IN IP4 127.0.0.1\r\ns=Session streamed with GStreamer\r\nt=0 0\r\n"
+                    "m=video 0 RTP/AVP 96\r\nc=IN IP4 0.0.0.0\r\na=rtpmap:96 H264/90000\r\n"
+                    f"a=fmtp:96 packetization-mode=1;sprop-parameter-sets={base64.b64encode(sps).decode()},aM48gA==\r\n"
+                    "a=control:stream=0\r\n"
+                )
+                self.send_response(cseq, headers={'Content-Base': f"{url.split('?')[0]}/", 'Content-Type': 'application/sdp'}, body=sdp.encode())
+            elif method == 'SETUP':
+                self.send_response(cseq, headers={'Transport': 'RTP/AVP/TCP;unicast;interleaved=0-1', 'Session': '12345678;timeout=60'})
+            elif method == 'PLAY':
+                self.send_response(cseq, headers={'Session': '12345678', 'RTP-Info': f"url={url}/stream=0;seq=0;rtptime=0"})
+                self.stream()
+                return
+            elif method == 'TEARDOWN':
+                self.send_response(cseq)
+                return
+
+
+    def stream(self):
+        """ Streams synthetic frames paced at the fps until the client goes away """
+        fps, gop_length, frame_size = self.server.fps, self.server.gop_length, self.server.frame_size
+        sequence = 0
+        start_time = time.monotonic()
+        # a camera starts a stream with an IDR after some delay
+        time.sleep(self.server.keyframe_delay)
+        for number in range(1_000_000):
+            keyframe = number % gop_length == 0
+            nal = bytes([0x65 if keyframe else 0x41]) + os.urandom(frame_size * (4 if keyframe else 1))
+            units = packetize(nal)
+            try:
+                for i, unit in enumerate(units):
+                    marker = 0x80 if i == len(units) - 1 else 0
+                    packet = struct.pack('!BBHII', 0x80, marker | 96, sequence & 0xffff, number * 90000 // fps & 0xffffffff, 0x1234) + unit
+                    self.wfile.write(b'$' + struct.pack('!BH', 0, len(packet)) + packet)
+                    sequence += 1
+                self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                return
+            time.sleep(max(start_time + self.server.keyframe_delay + (number + 1) / fps - time.monotonic(), 0))
+
+
+class StandInServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address: tuple, resolution: tuple, fps: int, gop_length: int, frame_size: int, keyframe_delay: float):
+        super().__init__(address, StandInHandler)
+        self.resolution = resolution
+        self.fps = fps
+        self.gop_length = gop_length
+        self.frame_size = frame_size
+        self.keyframe_delay = keyframe_delay
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--resolution', type=str, default='720x720', help='Resolution coded in the SPS of the stand in stream')
+    parser.add_argument('--fps', type=int, default=15)
+    parser.add_argument('--gop-length', type=int, default=15)
+    parser.add_argument('--frame-size', type=int, default=2000, help='Bytes of a slice, an IDR is 4 times larger')
+    parser.add_argument('--keyframe-delay', type=float, default=0.2, help='Seconds before the first IDR is sent')
+    parser.add_argument('--sample-duration', type=float, default=3.0)
+    args = parser.parse_args()
+
+    server = StandInServer(('127.0.0.1', 0), tuple(map(int, args.resolution.split('x'))), args.fps, args.gop_length, args.frame_size, args.keyframe_delay)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = STREAM_URL.format(ip_address='127.0.0.1').replace(':554', f':{server.server_address[1]}')
+
+    metrics = probe(url, username=USERNAME, password=PASSWORD, sample_duration=args.sample_duration)
+    for key, value in metrics.items():
+        print(f"{key:>24}: {value}")
+    failures = check_stream(metrics)
+    print(f"{'failures':>24}: {failures or 'none'}")
+    server.shutdown()
@@ -3,12 +3,29 @@ import time
 import os
 import json
 import sys
+import signal
 import logging
 import argparse
 from ast import literal_eval
 
 from steps import discover, provision, configure, verify, notify
 from utilities.logger import setup_logger
+from utilities.state import load, save
+
+logger = logging.getLogger()
+
+# The provisioning pipeline in execution order. Running with --command=all executes
+# every step in one process and only checkpoints the state once at the end, on failure or when the pod is terminated.
+PIPELINE = {
+    'discover': discover.run,
+    'provision': provision.run,
+    'configure': configure.run,
+    'verify': verify.run,
+}
+
+# Per step results are written here so argo can expose them as output parameters
+STEP_RESULTS_DIRECTORY = '/tmp/steps'
+
 
 def required_env(key) -> str:
     """
@@ -18,31 +35,111 @@ def required_env(key) -> str:
     value = os.getenv(key)
     if value is None:
         raise Exception(f'{key} is a required environment variable. Cannot be None')
-    
-    return value
 
+    return value
 
-def execute_step(step_function, *args, **kwargs):
-    try:
-        step_function(*args, **kwargs)
-    except Exception as e:
-
-        state = {}
-
-        if os.path.exists('/tmp/state.json'):
-            with open('/tmp/state.json', 'r') as f:
-                state = json.loads(f.read())
 
-        state['error'] = f"""
+def record_error(state: dict, e: Exception) -> dict:
+    """
+    Records the exception that failed the workflow into the state so it can be reported in the notify step.
+    """
+    state['error'] = f"""
 AXIS provisioning failed due to an exception.
 exception: {e}
         """
+    return state
+
+
+def report_step(name: str, phase: str):
+    """
+    Writes the phase of a step (Succeeded, Failed, Skipped) to a file that argo collects as an output parameter.
+    """
+    os.makedirs(STEP_RESULTS_DIRECTORY, exist_ok=True)
+    with open(f'{STEP_RESULTS_DIRECTORY}/{name}', 'w') as f:
+        f.write(phase)
+
+
+def report_progress(completed: int, total: int):
+    """
+    Reports self progress to argo when progress reporting is enabled for the pod.
+    """
+    progress_file = os.getenv('ARGO_PROGRESS_FILE')
+    if progress_file:
+        with open(progress_file, 'w') as f:
+            f.write(f'{completed}/{total}')
+
+
+def on_termination(handler):
+    """
+    Installs a SIGTERM handler that calls the handler with the error to record and exits.
+    Kubernetes sends SIGTERM when the pod exceeds its activeDeadlineSeconds or is deleted, so the state can still be saved.
+    """
+    def terminate(signum, frame):
+        logger.error(f"Received signal {signum}, saving the state before exiting")
+        handler(Exception(f"The workflow pod was terminated (signal {signum}), it exceeded its deadline or was deleted"))
+        sys.exit(128 + signum)
 
-        with open('/tmp/state.json', 'w') as f:
-            f.write(json.dumps(state))
+    signal.signal(signal.SIGTERM, terminate)
 
+
+def execute_step(step_function, resource: dict):
+    """
+    Executes a single step of the pipeline. The state is loaded from and saved to the state artifact.
+    """
+    state = load() if os.path.exists('/tmp/state.json') else {}
+    # steps update the state in place, what they recorded so far is saved if the pod is terminated
+    on_termination(lambda e: save(state=record_error(state, e)))
+
+    try:
+        state = step_function(resource, state)
+    except Exception as e:
+        save(state=record_error(state, e))
         raise e
 
+    save(state=state)
+
+
+def execute_pipeline(resource: dict):
+    """
+    Executes every step of the pipeline in a single process. The state is kept in memory between steps
+    and is only saved to the state artifact once the pipeline has completed, a step has failed or the pod is terminated.
+    Each step result is recorded in the state and reported to argo.
+    """
+    state = {'steps': {}}
+    names = list(PIPELINE)
+    current = {}
+
+    def fail(index: int, start_time: float, e: Exception):
+        """ Records the step as failed and the following steps as skipped, and saves the state """
+        name = names[index]
+        state['steps'][name] = {'phase': 'Failed', 'duration': round(time.time() - start_time, 3)}
+        report_step(name, 'Failed')
+        for skipped in names[index + 1:]:
+            state['steps'][skipped] = {'phase': 'Skipped'}
+            report_step(skipped, 'Skipped')
+        save(state=record_error(state, e))
+
+    on_termination(lambda e: fail(current['index'], current['start_time'], e))
+
+    for index, name in enumerate(names):
+        logger.info(f"Running step '{name}' ({index + 1}/{len(names)})")
+        start_time = time.time()
+        current.update(index=index, start_time=start_time)
+
+        try:
+            state = PIPELINE[name](resource, state)
+        except Exception as e:
+            fail(index, start_time, e)
+            raise e
+
+        state['steps'][name] = {'phase': 'Succeeded', 'duration': round(time.time() - start_time, 3)}
+        report_step(name, 'Succeeded')
+        report_progress(index + 1, len(names))
+        logger.info(f"Step '{name}' succeeded in {state['steps'][name]['duration']} seconds")
+
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    save(state=state)
+
 
 if __name__ == "__main__":
     """
@@ -52,28 +149,46 @@ if __name__ == "__main__":
     logger = logging.getLogger()
 
     parser = argparse.ArgumentParser()
-    parser.add_argument('--command', type=str, required=True, help='Command to run: discover, provision, verify')
+    parser.add_argument('--command', type=str, required=True, help='Command to run: all, discover, provision, configure, verify, notify, leases, rollout')
     args = parser.parse_args()
-    
-    commands = ['discover', 'provision', 'configure', 'verify', 'notify']
+
+    commands = ['all', *PIPELINE, 'notify', 'leases', 'rollout']
 
     if args.command not in commands:
         logger.error('Command must be one of: %s', ', '.join(commands))
         exit(1)
 
-    resource = literal_eval(required_env('RESOURCE'))
+    if args.command == 'leases':
+        # long running site wide lease service, it is not tied to a resource
+        from utilities import leases
+        leases.serve(
+            subnets=required_env('SUBNETS').split(','),
+            backend=os.getenv('DISCOVERY_BACKEND', 'arp'),
+            port=int(os.getenv('LEASE_SERVICE_PORT', leases.DEFAULT_LEASE_SERVICE_PORT)),
+            interval=float(os.getenv('LEASE_SCAN_INTERVAL', leases.DEFAULT_LEASE_SCAN_INTERVAL)),
+        )
+        exit(0)
+
+    if args.command == 'rollout':
+        # fleet wide firmware rollout of the cameras in the inventory, it is not tied to a resource
+        from axis.rollout import RolloutPolicy, load_inventory, rollout
+        state = load() if os.path.exists('/tmp/state.json') else {}
+        progress = rollout(
+            cameras=load_inventory(required_env('ROLLOUT_INVENTORY')),
+            policy=RolloutPolicy.from_env(),
+            state=state,
+            on_progress=report_progress
+        )
+        failed = [name for name, camera in progress['cameras'].items() if camera['phase'] == 'Failed']
+        exit(1 if failed or progress.get('stopped') else 0)
 
-    if args.command == 'discover':
-        execute_step(discover.run, resource)
-    
-    elif args.command == 'provision':
-        execute_step(provision.run, resource)
+    resource = literal_eval(required_env('RESOURCE'))
 
-    elif args.command == 'configure':
-        execute_step(configure.run, resource)
+    if args.command == 'all':
+        execute_pipeline(resource)
 
-    elif args.command == 'verify':
-        execute_step(verify.run, resource)
+    elif args.command in PIPELINE:
+        execute_step(PIPELINE[args.command], resource)
 
     elif args.command == 'notify':
         notify.run(resource)
@@ -1,15 +1,50 @@
-import time
 import logging
 
 from axis.configure import configure
-from utilities.state import load
+from axis.provision import answers_network_info
+from utilities.vapix import VAPIX
+from utilities.timeouts import AdaptiveTimeouts
+from utilities.wait import poll
 
 logger = logging.getLogger()
 
+# configure used to sleep this long for provisioning changes to sink in before starting, in seconds
+PROVISIONING_SETTLE_DELAY = 15
+READINESS_TIMEOUT = 120
 
-def run(resource: dict):
+
+def wait_until_ready(resource: dict, state: dict):
+    """
+    Waits until the AXIS device answers getNetworkInfo at its provisioned ip address. Transient issues can occur
+    right after the network interface configuration mode is changed, so configure only starts once the device is ready.
+    """
+    camera = VAPIX(
+        name=resource['metadata']['name'],
+        host=state['ip_address'],
+        username=state['username'],
+        password=state['password'],
+        timeout=5,
+        # the device is expected to miss requests while it applies the provisioned network configuration
+        circuit_breaker=False,
+        timeouts=AdaptiveTimeouts.from_state(state)
+    )
+    try:
+        poll(
+            lambda: answers_network_info(camera),
+            timeout=READINESS_TIMEOUT,
+            name=f"AXIS camera '{camera.name}' to answer at '{camera.host}'",
+            baseline=PROVISIONING_SETTLE_DELAY,
+            waits=state.setdefault('waits', [])
+        )
+    finally:
+        state.setdefault('vapix', {})['timeouts'] = camera.timeouts.to_state()
+        camera.close()
+
+
+def run(resource: dict, state: dict) -> dict:
     """
     Configure the AXIS device with the provided video stream settings.
     """
-    time.sleep(15) # noop sleep to wait for provisioning changes to sink in.  transient issues can occure when network interface configuration mode is changed
-    configure(resource, state=load())
\ No newline at end of file
+    wait_until_ready(resource, state)
+    configure(resource, state=state)
+    return state
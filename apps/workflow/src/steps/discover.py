@@ -1,9 +1,7 @@
 import logging
-import logging
 
 from utilities.axis import is_valid_axis_serial_number
-from utilities.command import resolve_ip_address, resolve_mac_address
-from utilities.state import save
+from utilities.discovery import resolve_ip_address, resolve_mac_address, discovery_options
 
 logger = logging.getLogger(__name__)
 
@@ -17,11 +15,13 @@ def discover(resource: dict) -> str:
     ip_address = None
     mac_address = None
 
-    # Resolve the AXIS camera via the provided MAC address
-    if resource['spec']['workflow']['provision_strategy'] == 'resolve_mac_address':
+    # Resolve the AXIS camera via the provided MAC address, 'announced_mac_address' asks the camera to announce itself
+    # over SSDP and Bonjour before the subnet is scanned (see discovery_options)
+    if resource['spec']['workflow']['provision_strategy'] in ('resolve_mac_address', 'announced_mac_address'):
         ip_address = resolve_ip_address(
             mac_address = resource['spec']['network']['mac_address'],
-            subnet = resource['spec']['network']['subnet']
+            subnet = resource['spec']['network']['subnet'],
+            **discovery_options(resource)
         )
         mac_address = resource['spec']['network']['mac_address']
     # Resolve the AXIS camera via the provided IP address
@@ -29,7 +29,8 @@ def discover(resource: dict) -> str:
         ip_address = resource['spec']['network']['dhcp_ip_address']
         mac_address = resolve_mac_address(
             ip_address = resource['spec']['network']['dhcp_ip_address'],
-            subnet = resource['spec']['network']['subnet']
+            subnet = resource['spec']['network']['subnet'],
+            **discovery_options(resource)
         )
 
     # Validate the mac address is a valid axis serial number
@@ -40,10 +41,11 @@ def discover(resource: dict) -> str:
     return ip_address
 
 
-def run(resource: dict):
+def run(resource: dict, state: dict) -> dict:
     """
     Attempts to discover the AXIS device given a MAC adress or IP address specified in the resource.
     If an AXIS camera is successfully discovered the state of the workflow is updated with the AXIS cameras IP address.
     If the AXIS camera cannot be discovered, an exception is raised and the workflow should exit to notify phase.
     """
-    save(state={'ip_address': discover(resource)})
+    state['ip_address'] = discover(resource)
+    return state
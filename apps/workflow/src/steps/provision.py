@@ -1,13 +1,12 @@
 import logging
 
 from axis.provision import provision
-from utilities.state import save, load
 
 logger = logging.getLogger()
 
 
-def run(resource: dict):
+def run(resource: dict, state: dict) -> dict:
     """
     Provisions the AXIS device with the provided network settings.
     """
-    save(state=provision(resource, state=load()))
\ No newline at end of file
+    return provision(resource, state=state)
@@ -1,44 +1,118 @@
-import os
+import asyncio
 import logging
 
-from utilities.state import load
-from utilities.command import run_command, is_reachable
-from utilities.vapix import VAPIX
+from axis.snapshot import get_zipstream_gop, get_zipstream_strength
+from utilities.frames import FRAME_WIDTH, FRAME_HEIGHT, decode_jpegs, frame_quality, frame_thresholds
+from utilities.rtsp import probe
+from utilities.vapix import AsyncVAPIX
+from utilities.timeouts import AdaptiveTimeouts
 
 logger = logging.getLogger(__name__)
 
+STREAM_URL = 'rtsp://{ip_address}:554/axis-media/media.amp?resolution=720x720&FPS=15&h264profile=high&videobitratemode=vbr&videocodec=h264&camera=1'
+# Bounds the probed stream has to be within, latencies in seconds from the start of the probe
+STREAM_THRESHOLDS = {
+    'max_connect_latency': 2.0,
+    'max_time_to_first_keyframe': 5.0,
+    'min_fps_ratio': 0.8,
+    'min_bitrate_kbps': 32,
+    'max_packets_lost': 0,
+}
+# JPEG snapshots sampled for the frame quality checks
+FRAME_SAMPLES = 5
+FRAME_INTERVAL = 0.5
 
-def get_sample_image(ip_address: str):
-    """
-    Gets a sample image from the AXIS device at the provided ip_address
-    """
 
-    logger.info("Getting sample image from AXIS device")
+def check_stream(metrics: dict, thresholds: dict = STREAM_THRESHOLDS) -> list:
+    """ Returns the failures of the probed stream metrics against the thresholds and the requested resolution and fps """
+    failures = []
+    if metrics['connect_latency'] > thresholds['max_connect_latency']:
+        failures.append(f"connect latency {metrics['connect_latency']}s is above {thresholds['max_connect_latency']}s")
+    if metrics['time_to_first_keyframe'] is None or metrics['time_to_first_keyframe'] > thresholds['max_time_to_first_keyframe']:
+        failures.append(f"time to first keyframe {metrics['time_to_first_keyframe']}s is above {thresholds['max_time_to_first_keyframe']}s")
+    requested = metrics['requested']
+    if requested['resolution'] and metrics['resolution'] != requested['resolution']:
+        failures.append(f"resolution {metrics['resolution']} is not the requested {requested['resolution']}")
+    if requested['fps'] and metrics['fps'] < requested['fps'] * thresholds['min_fps_ratio']:
+        failures.append(f"{metrics['fps']} fps is below {thresholds['min_fps_ratio']:.0%} of the requested {requested['fps']} fps")
+    if metrics['bitrate_kbps'] < thresholds['min_bitrate_kbps']:
+        failures.append(f"bitrate {metrics['bitrate_kbps']} kbps is below {thresholds['min_bitrate_kbps']} kbps")
+    if metrics['packets_lost'] > thresholds['max_packets_lost']:
+        failures.append(f"{metrics['packets_lost']} RTP packets were lost")
+    return failures
+
+
+def check_zipstream(gop: list, strength: list, metrics: dict, expected_strength: int) -> list:
+    """ Returns the failures of the zipstream settings, and of the GOP lengths observed in the stream against the maximum GOP length """
+    failures = []
+    if not gop or any(channel.get('mode') != 'dynamic' for channel in gop):
+        failures.append(f"zipstream GOP mode is {[channel.get('mode') for channel in gop or []]}, expected dynamic")
+    if not strength or any(channel.get('value') != str(expected_strength) for channel in strength):
+        failures.append(f"zipstream strength is {[channel.get('value') for channel in strength or []]}, expected {expected_strength}")
+    max_gop_length = max((int(channel['maxgoplength']) for channel in gop or [] if channel.get('maxgoplength', '').isdigit()), default=None)
+    if max_gop_length and metrics['gop_lengths'] and max(metrics['gop_lengths']) > max_gop_length:
+        failures.append(f"observed GOP length {max(metrics['gop_lengths'])} is above the maximum GOP length {max_gop_length}")
+    return failures
 
-    pipeline = f"""
-    ffmpeg \
-        -y \
-        -i \
-        'rtsp://{ip_address}:554/axis-media/media.amp?resolution=720x720&FPS=15&h264profile=high&videobitratemode=vbr&videocodec=h264&camera=1' \
-        -vframes 1 \
-        /tmp/output.png
-    """
 
-    run_command(pipeline)
+async def sample_frames(camera: AsyncVAPIX, count: int = FRAME_SAMPLES, interval: float = FRAME_INTERVAL) -> list:
+    """ Requests count JPEG snapshots of the first video channel, interval seconds apart """
+    images = []
+    for i in range(count):
+        if i:
+            await asyncio.sleep(interval)
+        response = await camera._get_image(params={'resolution': f'{FRAME_WIDTH}x{FRAME_HEIGHT}', 'camera': 1})
+        images.append(camera.check(response, 'requesting a JPEG snapshot').content)
+    return images
 
-    if not os.path.exists('/tmp/output.png'):
-        raise Exception(f"Could not create sample image from AXIS device at IP address: {ip_address}")
 
+async def inspect(camera: AsyncVAPIX) -> tuple:
+    """ Reads the zipstream settings and samples the frames concurrently """
+    try:
+        return await asyncio.gather(get_zipstream_gop(camera), get_zipstream_strength(camera), sample_frames(camera))
+    finally:
+        camera.close()
 
-def run(resource: dict):
 
-    state = load()
+def run(resource: dict, state: dict) -> dict:
+    """
+    Verifies the video stream of the camera: plays the RTSP stream in process and checks its connect latency,
+    time to first keyframe, resolution, fps, bitrate and packet loss against the thresholds,
+    and that the zipstream settings are applied and the observed GOP lengths stay within the maximum GOP length.
+    JPEG snapshots are checked for black, washed out, featureless (covered lens), frozen and blurred frames.
+    The metrics, thresholds and failures are recorded under verify in the state.
+    """
+    name = resource['metadata']['name']
+    ip_address = state['ip_address']
+    username, password = state.get('username', 'root'), state.get('password', 'admin')
+    timeouts = AdaptiveTimeouts.from_state(state)
+    camera = AsyncVAPIX(name=name, host=ip_address, username=username, password=password, timeouts=timeouts)
 
-    camera = VAPIX(
-        name=resource['metadata']['name'],
-        host=state['ip_address'],
-        username='root',
-        password='admin'
+    logger.info(f"{name} [{ip_address}] -  Probing the video stream")
+    metrics = probe(STREAM_URL.format(ip_address=ip_address), username=username, password=password)
+    logger.info(
+        f"{name} [{ip_address}] -  Stream {metrics['resolution']} at {metrics['fps']} fps and {metrics['bitrate_kbps']} kbps, "
+        f"first keyframe after {metrics['time_to_first_keyframe']}s, GOP lengths {metrics['gop_lengths']}"
+    )
+    gop, strength, images = asyncio.run(inspect(camera))
+    quality = frame_quality(decode_jpegs(images), frame_thresholds(resource['spec']['video'].get('frame_thresholds')))
+    logger.info(
+        f"{name} [{ip_address}] -  Frames with mean luminance {quality['mean_luminance']}, "
+        f"frame difference {quality['frame_difference']} and focus {quality['focus']}"
     )
 
-    # TODO: add camera verification logic here
+    failures = check_stream(metrics) + check_zipstream(gop, strength, metrics, resource['spec']['video']['zipstream_strength']) + quality['failures']
+    state['verify'] = {
+        'stream': metrics,
+        'thresholds': STREAM_THRESHOLDS,
+        'zipstream': {'gop': gop, 'strength': strength},
+        'frames': quality,
+        'failures': failures,
+    }
+    state.setdefault('vapix', {})['timeouts'] = timeouts.to_state()
+
+    if failures:
+        raise Exception(f"{name} [{ip_address}] -  Verification failed: {'; '.join(failures)}")
+    logger.info(f"{name} [{ip_address}] -  Verification passed")
+
+    return state
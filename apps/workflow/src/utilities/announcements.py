@@ -0,0 +1,124 @@
+import re
+import time
+import socket
+import struct
+import logging
+import ipaddress
+import selectors
+import threading
+
+from utilities.arp import normalize_mac_address
+
+logger = logging.getLogger(__name__)
+
+# AXIS devices announce themselves with UPnP/SSDP and Bonjour (mDNS) on these multicast groups
+SSDP_GROUP = ('239.255.255.250', 1900)
+MDNS_GROUP = ('224.0.0.251', 5353)
+ANNOUNCEMENT_GROUPS = {'ssdp': SSDP_GROUP, 'mdns': MDNS_GROUP}
+# How long discovery searches for an announcement before falling back to scanning, in seconds
+ANNOUNCEMENT_SEARCH_TIMEOUT = 3.0
+
+# The serial number of an AXIS device is its MAC address, it is part of the SSDP USN (uuid:Upnp-BasicDevice-1_0-ACCC8E1A2B3C)
+# and of the Bonjour service instance name (AXIS M3045-V - ACCC8E1A2B3C) and TXT record (macaddress=ACCC8E1A2B3C)
+AXIS_SERIAL_NUMBER_PATTERN = re.compile(rb'(?:00408c|accc8e)[0-9a-f]{6}', re.IGNORECASE)
+
+SSDP_SEARCH = (
+    'M-SEARCH * HTTP/1.1\r\n'
+    f'HOST: {SSDP_GROUP[0]}:{SSDP_GROUP[1]}\r\n'
+    'MAN: "ssdp:discover"\r\n'
+    'MX: 1\r\n'
+    'ST: upnp:rootdevice\r\n'
+    '\r\n'
+).encode('ascii')
+
+
+def mdns_query(service: str = '_axis-video._tcp.local') -> bytes:
+    """
+    Builds an mDNS PTR query for the service. Queries sent from a port other than 5353 are answered
+    directly to the sender (legacy unicast), so no multicast membership is required to read the answers.
+    """
+    header = struct.pack('!HHHHHH', 0, 0, 1, 0, 0, 0)
+    name = b''.join(bytes([len(label)]) + label.encode('ascii') for label in service.split('.')) + b'\x00'
+    # PTR record, IN class with the unicast response bit set
+    return header + name + struct.pack('!HH', 12, 0x8001)
+
+
+def parse_announcement(data: bytes) -> str:
+    """ Returns the serial number (MAC address) of the AXIS device an SSDP or mDNS packet is about, or None """
+    match = AXIS_SERIAL_NUMBER_PATTERN.search(data)
+    return normalize_mac_address(match.group(0).decode('ascii')) if match else None
+
+
+def listen(on_announcement, stop: threading.Event):
+    """
+    Passively listens for SSDP and Bonjour announcements until the stop event is set.
+    `on_announcement(serial_number, ip_address, protocol)` is called for every packet sent by an AXIS device,
+    the ip address is the sender of the announcement which is the device itself.
+    """
+    selector = selectors.DefaultSelector()
+    for protocol, (group, port) in ANNOUNCEMENT_GROUPS.items():
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(('', port))
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton(group) + socket.inet_aton('0.0.0.0'))
+        selector.register(sock, selectors.EVENT_READ, protocol)
+
+    logger.info(f"Listening for {', '.join(ANNOUNCEMENT_GROUPS)} announcements")
+    try:
+        while not stop.is_set():
+            for key, _ in selector.select(timeout=1):
+                data, (ip_address, _) = key.fileobj.recvfrom(65535)
+                serial_number = parse_announcement(data)
+                if serial_number:
+                    on_announcement(serial_number, ip_address, key.data)
+    finally:
+        for key in list(selector.get_map().values()):
+            key.fileobj.close()
+        selector.close()
+
+
+def search(mac_address: str, subnet: str = None, exclude_ip_address: str = None, timeout: float = ANNOUNCEMENT_SEARCH_TIMEOUT) -> str:
+    """
+    Asks the AXIS devices to announce themselves with an SSDP M-SEARCH and an mDNS query, and returns the ip address
+    of the device with the serial number (MAC address) as soon as it answers. The queries are repeated every second.
+    Returns None if the device did not answer from the subnet, at an ip address other than `exclude_ip_address`, within the timeout.
+    """
+    mac_address = normalize_mac_address(mac_address)
+    network = ipaddress.ip_network(subnet, strict=False) if subnet else None
+    start_time = time.time()
+    deadline = time.monotonic() + timeout
+
+    ssdp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    mdns = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    selector = selectors.DefaultSelector()
+    selector.register(ssdp, selectors.EVENT_READ)
+    selector.register(mdns, selectors.EVENT_READ)
+    try:
+        next_query = 0
+        while (remaining := deadline - time.monotonic()) > 0:
+            if time.monotonic() >= next_query:
+                try:
+                    ssdp.sendto(SSDP_SEARCH, SSDP_GROUP)
+                    mdns.sendto(mdns_query(), MDNS_GROUP)
+                except OSError as e:
+                    logger.warning(f"Failed to send announcement queries: {e}")
+                    return None
+                next_query = time.monotonic() + 1
+
+            for key, _ in selector.select(timeout=min(remaining, max(next_query - time.monotonic(), 0))):
+                data, (ip_address, _) = key.fileobj.recvfrom(65535)
+                if parse_announcement(data) != mac_address or ip_address == exclude_ip_address:
+                    continue
+                if network and ipaddress.ip_address(ip_address) not in network:
+                    continue
+                logger.info(f"AXIS device '{mac_address}' announced itself at IP address '{ip_address}' in {time.time() - start_time:.3f} seconds")
+                return ip_address
+    finally:
+        selector.close()
+        ssdp.close()
+        mdns.close()
+
+    logger.info(f"AXIS device '{mac_address}' did not announce itself within {timeout} seconds")
+    return None
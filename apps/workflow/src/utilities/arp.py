@@ -0,0 +1,132 @@
+import time
+import logging
+import ipaddress
+import threading
+
+from scapy.all import ARP, Ether, AsyncSniffer, sendp, conf
+
+logger = logging.getLogger(__name__)
+
+BROADCAST_MAC_ADDRESS = 'ff:ff:ff:ff:ff:ff'
+
+
+def normalize_mac_address(mac_address: str) -> str:
+    """
+    Normalizes a MAC address written as 00408c1a2b3c, 00:40:8c:1a:2b:3c or 00-40-8C-1A-2B-3C to 00:40:8c:1a:2b:3c
+    """
+    digits = mac_address.replace(':', '').replace('-', '').replace('.', '').lower()
+    return ':'.join(digits[i:i + 2] for i in range(0, len(digits), 2))
+
+
+def read_neighbour_table(path: str = '/proc/net/arp') -> dict:
+    """
+    Reads the kernels neighbour table and returns the complete entries as a mapping of IP address to MAC address.
+    Reading the table costs nothing on the network, but entries may be stale and should be confirmed before being trusted.
+    """
+    neighbours = {}
+    try:
+        with open(path, 'r') as f:
+            lines = f.readlines()[1:]
+    except OSError:
+        logger.debug(f"Neighbour table {path} is not available")
+        return neighbours
+
+    for line in lines:
+        columns = line.split()
+        # IP address, HW type, Flags, HW address, Mask, Device. Flags 0x0 is an incomplete entry
+        if len(columns) >= 4 and columns[2] != '0x0' and columns[3] != '00:00:00:00:00:00':
+            neighbours[columns[0]] = normalize_mac_address(columns[3])
+    return neighbours
+
+
+def interface_for(subnet: str) -> str:
+    """ Returns the network interface that routes to the subnet """
+    network = ipaddress.ip_network(subnet, strict=False)
+    return conf.route.route(str(network.network_address + 1))[0]
+
+
+def arp_sweep(subnet: str, ip_address: str = None, mac_address: str = None, hosts: list = None, concurrency: int = 64, timeout: float = 2.0, cancel: threading.Event = None) -> dict:
+    """
+    Broadcasts ARP requests to the hosts of the subnet and returns the replies as a mapping of IP address to MAC address.
+    Requests are sent in windows of `concurrency` hosts. If a target ip_address or mac_address is provided
+    the sweep stops sending and returns as soon as the target answers, otherwise it waits `timeout` seconds for replies
+    after the last window has been sent. Setting the `cancel` event stops the sweep early.
+    This must be run as root and on the same layer 2 network as the devices.
+    """
+    cancel = cancel or threading.Event()
+    mac_address = normalize_mac_address(mac_address) if mac_address else None
+    hosts = hosts if hosts is not None else [str(host) for host in ipaddress.ip_network(subnet, strict=False).hosts()]
+    iface = interface_for(subnet)
+    replies = {}
+    found = threading.Event()
+    started = threading.Event()
+
+    def on_reply(packet):
+        reply = packet[ARP]
+        ip, mac = reply.psrc, normalize_mac_address(reply.hwsrc)
+        replies[ip] = mac
+        if ip == ip_address or mac == mac_address:
+            found.set()
+
+    sniffer = AsyncSniffer(
+        iface=iface,
+        filter='arp',
+        lfilter=lambda packet: ARP in packet and packet[ARP].op == 2,
+        prn=on_reply,
+        store=False,
+        started_callback=started.set,
+    )
+    sniffer.start()
+    # replies can only be captured once the sniffer socket is open
+    started.wait(timeout=1)
+    try:
+        for i in range(0, len(hosts), concurrency):
+            if found.is_set() or cancel.is_set():
+                break
+            window = hosts[i:i + concurrency]
+            sendp([Ether(dst=BROADCAST_MAC_ADDRESS) / ARP(pdst=host) for host in window], iface=iface, verbose=False)
+            # give the window a moment to answer before sending the next one
+            found.wait(timeout=0.05)
+
+        deadline = time.monotonic() + timeout
+        while not found.is_set() and not cancel.is_set() and time.monotonic() < deadline:
+            found.wait(timeout=min(0.05, max(deadline - time.monotonic(), 0)))
+    finally:
+        if sniffer.running:
+            sniffer.stop()
+
+    logger.debug(f"ARP sweep of {len(hosts)} hosts on subnet {subnet} received {len(replies)} replies")
+    return replies
+
+
+def resolve_from_neighbour_table(mac_address: str, subnet: str) -> str:
+    """
+    Returns the ip address of the MAC address if the kernel neighbour table has an entry for it on the subnet
+    and the entry is confirmed by a single ARP request, otherwise None.
+    """
+    mac_address = normalize_mac_address(mac_address)
+    network = ipaddress.ip_network(subnet, strict=False)
+
+    for ip, mac in read_neighbour_table().items():
+        if mac == mac_address and ipaddress.ip_address(ip) in network:
+            replies = arp_sweep(subnet, mac_address=mac_address, hosts=[ip], timeout=0.5)
+            if replies.get(ip) == mac_address:
+                return ip
+    return None
+
+
+def resolve_mac_address(ip_address: str, subnet: str, timeout: float = 2.0) -> str:
+    """
+    This will return the mac address for the device if it is found on the network.
+    If the device is not found, an exception will be thrown.
+
+    Only the IP address itself is asked for its MAC address instead of sweeping the subnet.
+    """
+    start_time = time.time()
+    replies = arp_sweep(subnet, ip_address=ip_address, hosts=[ip_address], timeout=timeout)
+    mac = replies.get(ip_address)
+    if mac:
+        logger.info(f"Resolved IP address '{ip_address}' to MAC address '{mac}' in {time.time() - start_time:.3f} seconds")
+        return mac
+
+    raise Exception(f"Could not resolve IP '{ip_address}' to mac address on subnet: {subnet}")
@@ -1,47 +1,17 @@
 import os
 import time
+import signal
 import logging
-import platform
+import selectors
+import threading
 import subprocess
+from contextlib import closing
 import xml.etree.ElementTree as ET
 
 logger = logging.getLogger(__name__)
 
-def ping(host: str):
-    """
-    Returns True or False with success of ping
-    """
-    param = '-n' if platform.system().lower() == 'windows' else '-c'
-    command = ['ping', param, '1', host]
-    return subprocess.call(command, stdout=open(os.devnull, 'wb')) == 0
-
-
-def fast_ping(host):
-    '''
-    Floods the host with ping messages
-    concurrently that will timeout quickly.
-    Useful for quickly checking if device is up,
-    routable, and network is in optimal state.
-
-    Linux Docs: https://linux.die.net/man/8/ping
-    -f => flood the pings. Cocurrent
-    -n => numeric output only
-    -W => Wait time in seconds for each ping
-    -w => absolute timeout in seconds
-    -c => how many pings to send
-
-    returns:
-        bool => true if status code of 0, false otherwise
-        None => if exception occurs
-    '''
-    try:
-        command = ['ping', '-n', '-f', '-W 3', '-w 5', '-c 5', host]
-        status_code = subprocess.call(command, stdout=open(os.devnull, 'wb'))
-        return status_code == 0
-    except:
-        logger.exception('Failed to execute fast ping')
-
-    return None
+# Seconds between checks of the cancel event of a streamed command that produces no output
+CANCEL_POLL_INTERVAL = 0.1
 
 
 def run_command(command: str, timeout=60) -> str:
@@ -51,13 +21,19 @@ def run_command(command: str, timeout=60) -> str:
         command,
         shell=True,
         stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE
+        stderr=subprocess.PIPE,
+        start_new_session=True
     )
 
-    stdout, stderr = process.communicate()
+    try:
+        stdout, stderr = process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        terminate(process)
+        raise Exception(f"Command timed out after {timeout} seconds: {command}")
+
     stderr = stderr.decode("utf-8")
     stdout = stdout.decode("utf-8")
-    exit_code = process.wait(timeout=timeout)
+    exit_code = process.returncode
 
     logger.debug(f"Command exited with code: {exit_code}")
     logger.debug(f"Command stdout: {stdout}")
@@ -68,21 +44,129 @@ def run_command(command: str, timeout=60) -> str:
     return stdout
 
 
-def is_reachable(ip_address, timeout: int = 60) -> bool:
+def terminate(process: subprocess.Popen, grace_period: float = 2):
     """
-    Attempts to reach out to the AXIS device at the provided ip_address via ICMP ping.
-    If it fails after the provided timeout, provided in seconds, an exception will be thrown indicating the device is unreachable.
+    Terminates the process group of a command started in its own session, so children (e.g sudo nmap) are stopped too.
+    The group is killed if it has not exited after the grace period.
     """
-    response = False
-    start_time = time.time()
+    if process.poll() is not None:
+        return
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(timeout=grace_period)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+    except ProcessLookupError:
+        pass
 
-    while not response:
-        response = ping(ip_address)
 
-        if time.time() - start_time > timeout:
-            raise Exception(f'AXIS Device at ip address: {ip_address} did not respond to pings')
+def stream_command(command: str, timeout=60, cancel: threading.Event = None):
+    """
+    Runs the shell command and yields its stdout in chunks as soon as they are produced.
+    The command is terminated if it runs longer than the timeout, provided in seconds, or if the caller stops consuming the output early.
+    It is also terminated once the cancel event is set, the output then simply ends.
+    An exception is raised if the command exits with a non zero exit code.
+    """
+    logger.info(f"Streaming shell command: {command}")
+
+    process = subprocess.Popen(
+        command,
+        shell=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        start_new_session=True
+    )
+    deadline = time.monotonic() + timeout
+    stderr = b''
+    selector = selectors.DefaultSelector()
+    selector.register(process.stdout, selectors.EVENT_READ)
+    selector.register(process.stderr, selectors.EVENT_READ)
 
-    return True
+    try:
+        while selector.get_map():
+            if cancel is not None and cancel.is_set():
+                logger.info(f"Cancelled shell command: {command}")
+                return
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise Exception(f"Command timed out after {timeout} seconds: {command}")
+            # wake up regularly to notice the cancel event while the command is silent
+            for key, _ in selector.select(timeout=remaining if cancel is None else min(remaining, CANCEL_POLL_INTERVAL)):
+                chunk = os.read(key.fd, 65536)
+                if not chunk:
+                    selector.unregister(key.fileobj)
+                elif key.fileobj is process.stdout:
+                    yield chunk
+                else:
+                    stderr += chunk
+
+        exit_code = process.wait(timeout=max(deadline - time.monotonic(), 0))
+        logger.debug(f"Command exited with code: {exit_code}")
+        if exit_code != 0:
+            raise Exception(stderr.decode("utf-8") or f"Command exited with code {exit_code}: {command}")
+    except subprocess.TimeoutExpired:
+        raise Exception(f"Command timed out after {timeout} seconds: {command}")
+    finally:
+        selector.close()
+        terminate(process)
+        process.stdout.close()
+        process.stderr.close()
+
+
+class HostIndex:
+    """
+    MAC address <-> IP address index of the hosts that answered a network sweep.
+    A single sweep can be used to resolve both directions or several devices without rescanning the subnet.
+    """
+
+    def __init__(self):
+        self.mac_addresses = {}
+        self.ip_addresses = {}
+
+    def add(self, ip_address: str, mac_address: str):
+        ip_address, mac_address = ip_address.lower(), mac_address.lower()
+        self.mac_addresses[ip_address] = mac_address
+        self.ip_addresses[mac_address] = ip_address
+
+    def ip_address(self, mac_address: str) -> str:
+        return self.ip_addresses.get(mac_address.lower())
+
+    def mac_address(self, ip_address: str) -> str:
+        return self.mac_addresses.get(ip_address.lower())
+
+    def __len__(self):
+        return len(self.mac_addresses)
+
+
+def nmap_sweep(subnet: str, stop=None, timeout=60, cancel: threading.Event = None) -> HostIndex:
+    """
+    Ping sweeps the subnet with nmap and returns an index of every host that answered with its MAC and IP address.
+    The XML output is parsed incrementally as nmap produces it. If a stop(ip_address, mac_address) predicate is provided,
+    nmap is stopped as soon as a host satisfies it and the hosts found so far are returned.
+    nmap is also stopped once the cancel event is set (e.g another shard found the device), returning the hosts found so far.
+
+    This function must be run as root and on the same direct layer 2 network as the devices.
+    """
+    nmap_discover_command = f"sudo nmap --host-timeout 30 --max-retries 0 -sP -n -oX - {subnet}"
+    parser = ET.XMLPullParser(events=('end',))
+    index = HostIndex()
+
+    with closing(stream_command(nmap_discover_command, timeout=timeout, cancel=cancel)) as output:
+        for chunk in output:
+            parser.feed(chunk)
+            for _, element in parser.read_events():
+                if element.tag != 'host':
+                    continue
+                addresses = {a.get('addrtype'): a.get('addr') for a in element.findall('address')}
+                element.clear()
+                if addresses.get('mac') and addresses.get('ipv4'):
+                    index.add(ip_address=addresses['ipv4'], mac_address=addresses['mac'])
+                    logger.debug(f"Nmap discovered host '{addresses['ipv4']}' with MAC address '{addresses['mac']}'")
+                    if stop and stop(addresses['ipv4'].lower(), addresses['mac'].lower()):
+                        return index
+
+    return index
 
 
 def resolve_ip_address(mac_address: str, subnet: str) -> str:
@@ -91,30 +175,21 @@ def resolve_ip_address(mac_address: str, subnet: str) -> str:
     If the device is not found, an exception will be thrown.
 
     Resolves the MAC address to an IP address using nmap. The subnet used
-    will be scanned for all devices on the network. This function must be run
+    will be scanned until the device answers. This function must be run
     as root and on the same direct layer 2 network as the device you are
     trying to resolve.
     """
     logger.info(f"Attempting to resolve MAC address '{mac_address}' to IP address")
-    nmap_discover_command = f"sudo nmap --host-timeout 30 --max-retries 0 -sP -n -oX - {subnet}"
-    output = run_command(nmap_discover_command)
-    logger.debug(f"Nmap discover output: {output}")
-    output = ET.fromstring(output)
-
-    for host in output.findall('host'):
-        addresses = [a for a in host.findall('address')]
-        mac = [a for a in addresses if a.get('addrtype') == 'mac']
-        ip = [a for a in addresses if a.get('addrtype') == 'ipv4']
-        if mac and ip:
-            mac = mac[0].get('addr').lower()
-            ip = ip[0].get('addr').lower()
-
-            if mac == mac_address:
-                logger.info(f"Resolved MAC address '{mac_address}' to IP address '{ip}'")
-                return ip
-    else:
+    mac_address = mac_address.lower()
+    index = nmap_sweep(subnet, stop=lambda ip, mac: mac == mac_address)
+    ip = index.ip_address(mac_address)
+
+    if ip is None:
         raise Exception(f"Could not resolve MAC address: {mac_address} to IP address on subnet: {subnet}")
 
+    logger.info(f"Resolved MAC address '{mac_address}' to IP address '{ip}'")
+    return ip
+
 
 def resolve_mac_address(ip_address: str, subnet: str) -> str:
     """
@@ -122,26 +197,16 @@ def resolve_mac_address(ip_address: str, subnet: str) -> str:
     If the device is not found, an exception will be thrown.
 
     Resolves the IP address to an MAC address using nmap. The subnet used
-    will be scanned for all devices on the network. This function must be run
+    will be scanned until the device answers. This function must be run
     as root and on the same direct layer 2 network as the device you are
     trying to resolve.
     """
     logger.info(f"Attempting to resolve IP address '{ip_address}' to MAC address")
-    nmap_discover_command = f"sudo nmap --host-timeout 30 --max-retries 0 -sP -n -oX - {subnet}"
-    output = run_command(nmap_discover_command)
-    logger.debug(f"Nmap discover output: {output}")
-    output = ET.fromstring(output)
-
-    for host in output.findall('host'):
-        addresses = [a for a in host.findall('address')]
-        mac = [a for a in addresses if a.get('addrtype') == 'mac']
-        ip = [a for a in addresses if a.get('addrtype') == 'ipv4']
-        if mac and ip:
-            mac = mac[0].get('addr').lower()
-            ip = ip[0].get('addr').lower()
-
-            if ip == ip_address:
-                logger.info(f"Resolved IP address '{ip_address}' to MAC address '{mac}'")
-                return mac
-    else:
+    index = nmap_sweep(subnet, stop=lambda ip, mac: ip == ip_address)
+    mac = index.mac_address(ip_address)
+
+    if mac is None:
         raise Exception(f"Could not resolve IP '{ip_address}' to mac address on subnet: {subnet}")
+
+    logger.info(f"Resolved IP address '{ip_address}' to MAC address '{mac}'")
+    return mac
@@ -0,0 +1,184 @@
+import time
+import logging
+import ipaddress
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from utilities import arp, command, leases
+from utilities.announcements import search as announcements_search
+
+logger = logging.getLogger(__name__)
+
+# 'arp' resolves addresses in process with scapy, 'nmap' shells out to an nmap ping sweep
+DISCOVERY_BACKENDS = ['arp', 'nmap']
+DEFAULT_DISCOVERY_BACKEND = 'arp'
+# Subnets larger than a shard are split into shards that are scanned in parallel
+SHARD_PREFIX_LENGTH = 24
+DEFAULT_DISCOVERY_WORKERS = 4
+# How long a shard waits for late ARP replies after its last request has been sent
+SHARD_REPLY_TIMEOUT = 0.5
+
+
+def discovery_options(resource: dict, last_known_ip_address: str = None) -> dict:
+    """
+    Returns the discovery options of the resource. The last known ip address of the device and the DHCP pool range
+    are used as hints so the shards nearest to them are scanned first.
+    Devices provisioned with the 'announced_mac_address' strategy are asked to announce themselves before the subnet is scanned.
+    """
+    network = resource['spec']['network']
+    return {
+        'backend': resource['spec']['workflow'].get('discovery_backend', DEFAULT_DISCOVERY_BACKEND),
+        'workers': resource['spec']['workflow'].get('discovery_workers', DEFAULT_DISCOVERY_WORKERS),
+        'announcements': resource['spec']['workflow']['provision_strategy'] == 'announced_mac_address',
+        'hints': [
+            last_known_ip_address,
+            network.get('dhcp_ip_address'),
+            network.get('static_ip_address'),
+            network.get('dhcp_range'),
+        ],
+    }
+
+
+def parse_hint(hint: str) -> tuple:
+    """ Parses an ip address (10.0.9.20) or an ip address range (10.0.9.100-10.0.9.200) to an inclusive integer range """
+    start, _, end = hint.partition('-')
+    start = int(ipaddress.ip_address(start.strip()))
+    end = int(ipaddress.ip_address(end.strip())) if end else start
+    return min(start, end), max(start, end)
+
+
+def shard_subnet(subnet: str, prefix_length: int = SHARD_PREFIX_LENGTH, hints: list = ()) -> list:
+    """
+    Splits the subnet into shards of the prefix length. The shards are ordered by their distance
+    to the nearest hint (an ip address or ip address range) so the shards most likely to contain the device are scanned first.
+    """
+    network = ipaddress.ip_network(subnet, strict=False)
+    if network.prefixlen >= prefix_length:
+        return [network]
+
+    ranges = []
+    for hint in filter(None, hints):
+        try:
+            ranges.append(parse_hint(hint))
+        except ValueError:
+            logger.warning(f"Ignoring invalid discovery hint '{hint}'")
+
+    def distance(shard) -> int:
+        start, end = int(shard.network_address), int(shard.broadcast_address)
+        return min((max(low - end, start - high, 0) for low, high in ranges), default=0)
+
+    return sorted(network.subnets(new_prefix=prefix_length), key=distance)
+
+
+def scan_shards(shards: list, scan, workers: int = DEFAULT_DISCOVERY_WORKERS):
+    """
+    Scans the shards in parallel, in order, with scan(shard, cancel) and returns the first result that is not None.
+    Once a result is found the `cancel` event is set and the shards that have not started are cancelled.
+    If no shard has a result, the first error raised by a scan is raised, otherwise None is returned.
+    """
+    cancel = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix='discovery')
+    futures = [executor.submit(scan, str(shard), cancel) for shard in shards]
+    errors = []
+    try:
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                logger.warning(f"Failed to scan shard: {e}")
+                errors.append(e)
+                continue
+            if result is not None:
+                return result
+    finally:
+        cancel.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    if errors:
+        raise errors[0]
+    return None
+
+
+def resolve_ip_address(mac_address: str, subnet: str, backend: str = DEFAULT_DISCOVERY_BACKEND, workers: int = DEFAULT_DISCOVERY_WORKERS, hints: list = (), announcements: bool = False) -> str:
+    """
+    This will return the ip address for the device if it is found on the network using the selected discovery backend.
+    If the device is not found, an exception will be thrown.
+
+    The site lease service (LEASE_SERVICE_URL), which also caches SSDP and Bonjour announcements, is asked first.
+    With `announcements` the device is then asked to announce itself, the subnet is only scanned when both miss.
+    Subnets larger than a /24 are split into shards that are scanned by `workers` in parallel, the shards nearest
+    to the hints first. The remaining shards are cancelled as soon as the device answers.
+    If the arp backend can not be used (e.g missing privileges to open a raw socket) the nmap backend is used instead.
+    """
+    mac_address = arp.normalize_mac_address(mac_address)
+    start_time = time.time()
+
+    ip_address = leases.lookup(mac_address)
+    if ip_address and ipaddress.ip_address(ip_address) in ipaddress.ip_network(subnet, strict=False):
+        logger.info(f"Resolved MAC address '{mac_address}' to IP address '{ip_address}' from the lease service in {time.time() - start_time:.3f} seconds")
+        return ip_address
+
+    if announcements:
+        ip_address = announcements_search(mac_address, subnet=subnet)
+        if ip_address:
+            return ip_address
+        logger.info(f"AXIS device '{mac_address}' did not announce itself, falling back to scanning subnet {subnet}")
+
+    shards = shard_subnet(subnet, hints=hints)
+
+    def arp_scan(shard, cancel):
+        replies = arp.arp_sweep(shard, mac_address=mac_address, cancel=cancel, timeout=SHARD_REPLY_TIMEOUT)
+        return next((ip for ip, mac in replies.items() if mac == mac_address), None)
+
+    def nmap_scan(shard, cancel):
+        index = command.nmap_sweep(shard, stop=lambda ip, mac: mac == mac_address, cancel=cancel)
+        return index.ip_address(mac_address)
+
+    if backend == 'arp':
+        try:
+            ip_address = arp.resolve_from_neighbour_table(mac_address, subnet) or scan_shards(shards, arp_scan, workers)
+        except OSError:
+            logger.exception("ARP discovery is unavailable, falling back to nmap")
+            ip_address = scan_shards(shards, nmap_scan, workers)
+    else:
+        ip_address = scan_shards(shards, nmap_scan, workers)
+
+    if ip_address is None:
+        raise Exception(f"Could not resolve MAC address: {mac_address} to IP address on subnet: {subnet}")
+
+    logger.info(f"Resolved MAC address '{mac_address}' to IP address '{ip_address}' in {time.time() - start_time:.3f} seconds, {len(shards)} shards")
+    return ip_address
+
+
+def resolve_mac_address(ip_address: str, subnet: str, backend: str = DEFAULT_DISCOVERY_BACKEND, **kwargs) -> str:
+    """
+    This will return the mac address for the device if it is found on the network using the selected discovery backend.
+    If the device is not found, an exception will be thrown.
+    If the arp backend can not be used (e.g missing privileges to open a raw socket) the nmap backend is used instead.
+    """
+    if backend == 'arp':
+        try:
+            return arp.resolve_mac_address(ip_address=ip_address, subnet=subnet)
+        except OSError:
+            logger.exception("ARP discovery is unavailable, falling back to nmap")
+
+    # only the shard that contains the ip address has to be scanned
+    shards = [shard for shard in shard_subnet(subnet) if ipaddress.ip_address(ip_address) in shard]
+    return command.resolve_mac_address(ip_address=ip_address, subnet=str(shards[0]) if shards else subnet)
+
+
+def sweep(subnet: str, backend: str = DEFAULT_DISCOVERY_BACKEND) -> command.HostIndex:
+    """
+    Sweeps the whole subnet once and returns a MAC <-> IP index of every host that answered.
+    Use this instead of resolving addresses one at a time when several devices or both directions need to be resolved.
+    """
+    if backend == 'arp':
+        try:
+            index = command.HostIndex()
+            for ip_address, mac_address in arp.arp_sweep(subnet).items():
+                index.add(ip_address=ip_address, mac_address=mac_address)
+            return index
+        except OSError:
+            logger.exception("ARP discovery is unavailable, falling back to nmap")
+
+    return command.nmap_sweep(subnet)
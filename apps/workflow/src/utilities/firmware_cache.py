@@ -0,0 +1,234 @@
+import io
+import os
+import json
+import fcntl
+import hashlib
+import logging
+import tempfile
+from contextlib import contextmanager
+
+import boto3
+
+logger = logging.getLogger(__name__)
+
+# The cache lives on a volume shared by the workflow pods of a node, so an image is only downloaded from S3 once
+FIRMWARE_CACHE_DIR = os.getenv('FIRMWARE_CACHE_DIR', '/var/cache/axis-firmware')
+FIRMWARE_CACHE_MAX_BYTES = int(os.getenv('FIRMWARE_CACHE_MAX_BYTES', 2 * 1024 ** 3))
+CHUNK_SIZE = 1024 * 1024
+
+
+def sha256_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class CachingReader:
+    """
+    File like reader of an S3 object body that writes every chunk it reads to a temporary file in the cache and hashes it,
+    so the image can be streamed to the camera while it is downloaded. It reports the object's length so requests
+    sends it with a Content-Length instead of chunked transfer encoding.
+
+    The reader verifies the length and the digest of the image before it hands out the chunk that completes it,
+    so an image that fails its integrity check raises before the device has received it completely.
+    It can be rewound (requests does so to resend the body after a digest authentication challenge), the bytes already
+    downloaded are then read again from the temporary file before the download continues.
+    """
+
+    def __init__(self, body, length: int, file, sha256: str = None):
+        self.body = body
+        self.length = length
+        self.file = file
+        self.sha256 = sha256
+        self.digest = hashlib.sha256()
+        self.read_bytes = 0
+        self.position = 0
+        self.replay = None
+        self.verified = False
+
+
+    def __len__(self):
+        return self.length
+
+
+    def _next(self, size: int) -> bytes:
+        chunk = self.body.read(size)
+        self.digest.update(chunk)
+        self.file.write(chunk)
+        self.read_bytes += len(chunk)
+        if not chunk or self.read_bytes >= self.length:
+            # chunk completes the image (or the download ended early)
+            self.verify()
+        return chunk
+
+
+    def read(self, size: int = -1) -> bytes:
+        size = CHUNK_SIZE if size is None or size < 0 else size
+        if self.position < self.read_bytes:
+            self.replay.seek(self.position)
+            chunk = self.replay.read(min(size, self.read_bytes - self.position))
+        else:
+            chunk = self._next(size)
+        self.position += len(chunk)
+        return chunk
+
+
+    def tell(self) -> int:
+        return self.position
+
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        """ Moves to a position within the bytes downloaded so far """
+        position = {io.SEEK_SET: 0, io.SEEK_CUR: self.position, io.SEEK_END: self.length}[whence] + offset
+        if not 0 <= position <= self.read_bytes:
+            raise io.UnsupportedOperation(f"Can not seek to {position}, {self.read_bytes} bytes of the image have been downloaded")
+        if position < self.read_bytes and self.replay is None:
+            self.file.flush()
+            self.replay = open(self.file.name, 'rb')
+        self.position = position
+        return position
+
+
+    def close(self):
+        if self.replay is not None:
+            self.replay.close()
+
+
+    def verify(self):
+        """ Raises an exception if the image read does not have the length of the object or the expected digest """
+        if self.verified:
+            return
+        if self.read_bytes != self.length:
+            raise Exception(f"Firmware image is {self.read_bytes} bytes, expected {self.length} bytes")
+        if self.sha256 and self.digest.hexdigest() != self.sha256:
+            raise Exception(f"Firmware image has sha256 {self.digest.hexdigest()}, expected {self.sha256}")
+        self.verified = True
+
+
+    def drain(self):
+        """ Reads whatever the upload did not, so the complete image can still be cached """
+        while self.read(CHUNK_SIZE):
+            pass
+
+
+class FirmwareCache:
+    """
+    Content addressed cache of firmware images.
+
+    Images are stored as objects/<sha256>.bin and index.json maps the image filename in S3 to its sha256.
+    The content of an image is verified against its address before it is used, a corrupt image is evicted and downloaded again.
+    Images are evicted least recently used first (by modification time, which is touched on every use) once the cache
+    holds more than max_bytes. Index updates and evictions are serialized with a lock file, since pods share the cache.
+    """
+
+    def __init__(self, root: str = FIRMWARE_CACHE_DIR, max_bytes: int = FIRMWARE_CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.objects = os.path.join(root, 'objects')
+        os.makedirs(self.objects, exist_ok=True)
+
+
+    def path(self, sha256: str) -> str:
+        return os.path.join(self.objects, f'{sha256}.bin')
+
+
+    @contextmanager
+    def _locked_index(self):
+        """ Yields the index, holding the cache lock, and writes it back atomically """
+        with open(os.path.join(self.root, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            index_path = os.path.join(self.root, 'index.json')
+            try:
+                with open(index_path) as f:
+                    index = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                index = {}
+            yield index
+            with tempfile.NamedTemporaryFile('w', dir=self.root, delete=False) as f:
+                json.dump(index, f)
+            os.replace(f.name, index_path)
+
+
+    def lookup(self, filename: str) -> str:
+        """ Returns the path of the cached image, after verifying its integrity, or None if it is not cached """
+        with self._locked_index() as index:
+            sha256 = index.get(filename)
+            if sha256 is None:
+                return None
+            path = self.path(sha256)
+            if not os.path.isfile(path) or sha256_file(path) != sha256:
+                logger.warning(f"Cached firmware image {filename} is missing or corrupt, evicting it")
+                index.pop(filename)
+                if os.path.exists(path):
+                    os.remove(path)
+                return None
+            os.utime(path)
+            return path
+
+
+    def commit(self, filename: str, sha256: str, temp_path: str):
+        """ Moves a downloaded image into the cache under its address and evicts the least recently used images """
+        os.replace(temp_path, self.path(sha256))
+        with self._locked_index() as index:
+            index[filename] = sha256
+            self._evict(index, keep=sha256)
+        logger.info(f"Cached firmware image {filename} as {sha256}")
+
+
+    def _evict(self, index: dict, keep: str):
+        entries = sorted(
+            (os.path.getmtime(os.path.join(self.objects, name)), name)
+            for name in os.listdir(self.objects) if name.endswith('.bin')
+        )
+        total = sum(os.path.getsize(os.path.join(self.objects, name)) for _, name in entries)
+        for _, name in entries:
+            if total <= self.max_bytes:
+                break
+            sha256 = name.removesuffix('.bin')
+            if sha256 == keep:
+                continue
+            total -= os.path.getsize(self.path(sha256))
+            os.remove(self.path(sha256))
+            for filename in [filename for filename, address in index.items() if address == sha256]:
+                index.pop(filename)
+            logger.info(f"Evicted firmware image {sha256} from the cache")
+
+
+    @contextmanager
+    def open(self, bucket: str, filename: str, sha256: str = None):
+        """
+        Yields a file like object of the firmware image to stream to the camera.
+        A cached image is read from the cache. On a miss the S3 object is streamed as it is downloaded and
+        cached once it has been read completely.
+
+        The image is verified against a known digest: the sha256 given, or the sha256 in the metadata of the S3 object
+        (x-amz-meta-sha256, hex encoded). The reader raises before the chunk completing the image is handed to the upload when it does not match,
+        so a corrupt download is neither installed nor cached. Without a known digest only the length of the image is verified.
+        """
+        path = self.lookup(filename)
+        if path:
+            logger.info(f"Using cached firmware image {filename}")
+            with open(path, 'rb') as f:
+                yield f
+            return
+
+        logger.info(f"Firmware image {filename} is not cached, streaming it from s3://{bucket}/{filename}")
+        s3_object = boto3.client('s3').get_object(Bucket=bucket, Key=filename)
+        expected = (sha256 or s3_object.get('Metadata', {}).get('sha256') or '').lower() or None
+        if expected is None:
+            logger.warning(f"No known sha256 of firmware image {filename}, only its length is verified")
+        with tempfile.NamedTemporaryFile(dir=self.objects, suffix='.part', delete=False) as temp:
+            reader = CachingReader(s3_object['Body'], s3_object['ContentLength'], temp, sha256=expected)
+            try:
+                yield reader
+                reader.drain()
+            except BaseException:
+                os.remove(temp.name)
+                raise
+            finally:
+                reader.close()
+                s3_object['Body'].close()
+
+        self.commit(filename, reader.digest.hexdigest(), temp.name)
@@ -0,0 +1,85 @@
+import logging
+import subprocess
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Frames are decoded to 8 bit luminance at this size, whatever the resolution of the snapshots
+FRAME_WIDTH = 320
+FRAME_HEIGHT = 240
+# Bounds of the frame quality checks, on 8 bit luminance
+FRAME_THRESHOLDS = {
+    # mean luminance below it is a black frame (lens cap, dead sensor), above it is a washed out frame (blinded, overexposed)
+    'min_mean_luminance': 16.0,
+    'max_mean_luminance': 235.0,
+    # a standard deviation below it is a featureless frame (covered or fogged lens, water on the dome, pointed at a wall)
+    'min_luminance_std': 6.0,
+    # a mean absolute difference between consecutive frames below it everywhere is a frozen stream, sensor noise alone is above it
+    'min_frame_difference': 0.3,
+    # a variance of the Laplacian below it is an out of focus frame
+    'min_focus': 30.0,
+}
+
+
+def frame_thresholds(overrides: dict = None) -> dict:
+    """
+    Returns FRAME_THRESHOLDS with the thresholds set on the resource (spec.video.frame_thresholds),
+    e.g a lower min_luminance_std and min_frame_difference for open water or net pen scenes that are uniform and static.
+    A minimum of 0 disables its check.
+    """
+    return {**FRAME_THRESHOLDS, **{key: float(value) for key, value in (overrides or {}).items() if key in FRAME_THRESHOLDS}}
+
+
+def decode_jpegs(images: list, width: int = FRAME_WIDTH, height: int = FRAME_HEIGHT) -> np.ndarray:
+    """ Decodes the JPEG images with a single ffmpeg process into an array of (frames, height, width) luminance values """
+    process = subprocess.run(
+        ['ffmpeg', '-loglevel', 'error', '-f', 'image2pipe', '-c:v', 'mjpeg', '-i', '-',
+         '-vf', f'scale={width}:{height}', '-f', 'rawvideo', '-pix_fmt', 'gray', '-'],
+        input=b''.join(images),
+        capture_output=True,
+        timeout=60
+    )
+    if process.returncode != 0:
+        raise Exception(f"Could not decode the frames: {process.stderr.decode().strip()}")
+    frames = np.frombuffer(process.stdout, dtype=np.uint8)
+    if frames.size != len(images) * width * height:
+        raise Exception(f"Decoded {frames.size // (width * height)} frames out of {len(images)} images")
+    return frames.reshape(len(images), height, width)
+
+
+def frame_quality(frames: np.ndarray, thresholds: dict = FRAME_THRESHOLDS) -> dict:
+    """
+    Measures a batch of (frames, height, width) luminance frames in one vectorized pass and returns the per frame metrics,
+    the thresholds and the failures: black, washed out or featureless frames (judged on the median frame so a single
+    transient frame does not fail the camera), a frozen stream and blurred frames.
+    """
+    f = frames.astype(np.float32)
+    mean = f.mean(axis=(1, 2))
+    std = f.std(axis=(1, 2))
+    difference = np.abs(np.diff(f, axis=0)).mean(axis=(1, 2))
+    # 4 neighbour Laplacian of the interior pixels of every frame
+    laplacian = f[:, :-2, 1:-1] + f[:, 2:, 1:-1] + f[:, 1:-1, :-2] + f[:, 1:-1, 2:] - 4 * f[:, 1:-1, 1:-1]
+    focus = laplacian.var(axis=(1, 2))
+
+    failures = []
+    if np.median(mean) < thresholds['min_mean_luminance']:
+        failures.append(f"frames are black, mean luminance {np.median(mean):.1f} is below {thresholds['min_mean_luminance']}")
+    elif np.median(mean) > thresholds['max_mean_luminance']:
+        failures.append(f"frames are washed out, mean luminance {np.median(mean):.1f} is above {thresholds['max_mean_luminance']}")
+    if np.median(std) < thresholds['min_luminance_std']:
+        failures.append(f"frames are featureless, luminance deviation {np.median(std):.1f} is below {thresholds['min_luminance_std']}")
+    if difference.size and difference.max() < thresholds['min_frame_difference']:
+        failures.append(f"stream is frozen, frame difference {difference.max():.2f} is below {thresholds['min_frame_difference']}")
+    if np.median(focus) < thresholds['min_focus']:
+        failures.append(f"frames are blurred, focus {np.median(focus):.1f} is below {thresholds['min_focus']}")
+
+    return {
+        'frames': len(frames),
+        'mean_luminance': np.round(mean, 1).tolist(),
+        'luminance_std': np.round(std, 1).tolist(),
+        'frame_difference': np.round(difference, 2).tolist(),
+        'focus': np.round(focus, 1).tolist(),
+        'thresholds': thresholds,
+        'failures': failures,
+    }
@@ -0,0 +1,249 @@
+import os
+import json
+import time
+import logging
+import ipaddress
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import requests
+
+from utilities.arp import normalize_mac_address
+from utilities.announcements import listen as listen_for_announcements
+
+logger = logging.getLogger(__name__)
+
+# Leases older than this are not trusted by lookups, in seconds
+DEFAULT_LEASE_MAX_AGE = 120
+DEFAULT_LEASE_SERVICE_PORT = 8080
+DEFAULT_LEASE_SCAN_INTERVAL = 60
+
+
+class LeaseTable:
+    """
+    In memory MAC address -> IP address table of the devices seen on the site subnets with the time they were first and last seen.
+    Waiters are woken up whenever a lease is added, moves to a new ip address or is seen again.
+    """
+
+    def __init__(self):
+        self.leases = {}
+        self.condition = threading.Condition()
+
+
+    def update(self, mac_address: str, ip_address: str, source: str):
+        """ Records that the MAC address was seen at the ip address by the source (sweep, arp, dhcp, ssdp or mdns) """
+        mac_address = normalize_mac_address(mac_address)
+        now = time.time()
+        with self.condition:
+            lease = self.leases.get(mac_address)
+            if lease is None or lease['ip_address'] != ip_address:
+                logger.info(f"Lease for '{mac_address}' is now '{ip_address}' (was '{lease and lease['ip_address']}') seen by {source}")
+                lease = {'mac_address': mac_address, 'ip_address': ip_address, 'first_seen': now}
+                self.leases[mac_address] = lease
+            lease['last_seen'] = now
+            lease['source'] = source
+            self.condition.notify_all()
+
+
+    def lookup(self, mac_address: str) -> dict:
+        """ Returns the lease of the MAC address or None """
+        with self.condition:
+            lease = self.leases.get(normalize_mac_address(mac_address))
+            return dict(lease) if lease else None
+
+
+    def wait(self, mac_address: str, exclude_ip_address: str = None, since: float = 0, timeout: float = 60) -> dict:
+        """
+        Waits until the MAC address has been seen at an ip address other than `exclude_ip_address` after `since` (epoch seconds).
+        Returns the lease, or None if the timeout, in seconds, passed first.
+        """
+        mac_address = normalize_mac_address(mac_address)
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                lease = self.leases.get(mac_address)
+                if lease and lease['ip_address'] != exclude_ip_address and lease['last_seen'] >= since:
+                    return dict(lease)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+
+
+    def all(self) -> list:
+        with self.condition:
+            return [dict(lease) for lease in self.leases.values()]
+
+
+def scan(table: LeaseTable, subnets: list, backend: str, interval: float, stop: threading.Event):
+    """ Actively sweeps the subnets every interval seconds and records every host that answered """
+    from utilities.discovery import sweep
+
+    while not stop.is_set():
+        for subnet in subnets:
+            try:
+                index = sweep(subnet, backend=backend)
+            except Exception:
+                logger.exception(f"Failed to sweep subnet {subnet}")
+                continue
+            for ip_address, mac_address in index.mac_addresses.items():
+                table.update(mac_address, ip_address, source='sweep')
+            logger.info(f"Swept subnet {subnet}, {len(index)} hosts answered")
+        stop.wait(interval)
+
+
+def sniff(table: LeaseTable, subnets: list):
+    """
+    Passively sniffs ARP and DHCP traffic and records the addresses of the senders and the DHCP acknowledged leases.
+    Returns the started sniffer.
+    """
+    from scapy.all import ARP, BOOTP, DHCP, AsyncSniffer
+
+    networks = [ipaddress.ip_network(subnet, strict=False) for subnet in subnets]
+
+    def on_subnets(ip_address: str) -> bool:
+        return ip_address != '0.0.0.0' and any(ipaddress.ip_address(ip_address) in network for network in networks)
+
+    def on_packet(packet):
+        if ARP in packet and on_subnets(packet[ARP].psrc):
+            table.update(packet[ARP].hwsrc, packet[ARP].psrc, source='arp')
+        elif DHCP in packet and BOOTP in packet:
+            # DHCP message type 5 is an acknowledgement of the lease
+            if ('message-type', 5) in packet[DHCP].options and on_subnets(packet[BOOTP].yiaddr):
+                mac_address = ':'.join(f'{byte:02x}' for byte in bytes(packet[BOOTP].chaddr)[:6])
+                table.update(mac_address, packet[BOOTP].yiaddr, source='dhcp')
+
+    sniffer = AsyncSniffer(filter='arp or (udp and (port 67 or port 68))', prn=on_packet, store=False)
+    sniffer.start()
+    return sniffer
+
+
+class LeaseRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET /leases                     every lease
+    GET /leases/<mac>               the lease of the MAC address
+    GET /leases/<mac>/wait          long polls until the MAC address is seen at an ip address,
+                                    query parameters: exclude_ip_address, since (epoch seconds), timeout (seconds)
+    GET /healthz
+    """
+    table: LeaseTable = None
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} - {format % args}")
+
+    def respond(self, status: int, body):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        parts = [part for part in url.path.split('/') if part]
+
+        if parts == ['healthz']:
+            return self.respond(200, {'status': 'ok'})
+
+        if parts == ['leases']:
+            return self.respond(200, self.table.all())
+
+        if len(parts) == 2 and parts[0] == 'leases':
+            lease = self.table.lookup(parts[1])
+            return self.respond(200, lease) if lease else self.respond(404, {'error': f"No lease for '{parts[1]}'"})
+
+        if len(parts) == 3 and parts[0] == 'leases' and parts[2] == 'wait':
+            lease = self.table.wait(
+                parts[1],
+                exclude_ip_address=query.get('exclude_ip_address'),
+                since=float(query.get('since', 0)),
+                timeout=min(float(query.get('timeout', 60)), 300),
+            )
+            return self.respond(200, lease) if lease else self.respond(408, {'error': f"'{parts[1]}' was not seen at a new ip address in time"})
+
+        self.respond(404, {'error': 'Not found'})
+
+
+def serve(subnets: list, backend: str, port: int = DEFAULT_LEASE_SERVICE_PORT, interval: float = DEFAULT_LEASE_SCAN_INTERVAL):
+    """
+    Runs the lease service. The subnets are actively swept every interval and passively sniffed for ARP and DHCP traffic
+    and for the SSDP and Bonjour announcements of AXIS devices. The lease table is served over HTTP so workflows
+    can query it instead of sweeping the subnets themselves.
+    """
+    table = LeaseTable()
+    stop = threading.Event()
+
+    try:
+        sniff(table, subnets)
+    except Exception:
+        logger.exception("Failed to start passive ARP/DHCP sniffing, only active sweeps will be used")
+
+    threading.Thread(target=scan, args=(table, subnets, backend, interval, stop), daemon=True, name='lease-scanner').start()
+
+    # the serial number an AXIS device announces over SSDP and Bonjour is its MAC address
+    networks = [ipaddress.ip_network(subnet, strict=False) for subnet in subnets]
+
+    def on_announcement(serial_number: str, ip_address: str, protocol: str):
+        if any(ipaddress.ip_address(ip_address) in network for network in networks):
+            table.update(serial_number, ip_address, source=protocol)
+
+    def announcements():
+        try:
+            listen_for_announcements(on_announcement, stop)
+        except OSError:
+            logger.exception("Failed to listen for SSDP and Bonjour announcements")
+    threading.Thread(target=announcements, daemon=True, name='lease-announcements').start()
+
+    LeaseRequestHandler.table = table
+    server = ThreadingHTTPServer(('0.0.0.0', port), LeaseRequestHandler)
+    server.daemon_threads = True
+    logger.info(f"Serving leases for subnets {', '.join(subnets)} on port {port}")
+    try:
+        server.serve_forever()
+    finally:
+        stop.set()
+        server.server_close()
+
+
+def lookup(mac_address: str, max_age: float = DEFAULT_LEASE_MAX_AGE, url: str = None) -> str:
+    """
+    Returns the ip address the lease service last saw the MAC address at, if it was seen within max_age seconds.
+    Returns None if the lease is unknown or stale, or if the lease service is not configured (LEASE_SERVICE_URL) or unreachable.
+    """
+    url = url or os.getenv('LEASE_SERVICE_URL')
+    if not url:
+        return None
+    try:
+        response = requests.get(f"{url}/leases/{normalize_mac_address(mac_address)}", timeout=5)
+    except requests.exceptions.RequestException:
+        logger.warning(f"Lease service at {url} is unreachable")
+        return None
+    if not response.ok:
+        return None
+    lease = response.json()
+    if time.time() - lease['last_seen'] > max_age:
+        return None
+    return lease['ip_address']
+
+
+def wait_for_ip_address(mac_address: str, exclude_ip_address: str = None, since: float = 0, timeout: float = 120, url: str = None) -> str:
+    """
+    Long polls the lease service until the MAC address is seen at an ip address other than `exclude_ip_address`.
+    Returns the ip address, or None if it was not seen in time or the lease service is not configured or unreachable.
+    """
+    url = url or os.getenv('LEASE_SERVICE_URL')
+    if not url:
+        return None
+    try:
+        response = requests.get(
+            f"{url}/leases/{normalize_mac_address(mac_address)}/wait",
+            params={'exclude_ip_address': exclude_ip_address or '', 'since': since, 'timeout': timeout},
+            timeout=timeout + 10
+        )
+    except requests.exceptions.RequestException:
+        logger.warning(f"Lease service at {url} is unreachable")
+        return None
+    return response.json()['ip_address'] if response.ok else None
@@ -0,0 +1,212 @@
+import time
+import socket
+import struct
+import asyncio
+import logging
+import itertools
+
+logger = logging.getLogger(__name__)
+
+ICMP_ECHO_REPLY = 0
+ICMP_ECHO_REQUEST = 8
+# How long a single probe waits for an answer, in seconds
+PROBE_TIMEOUT = 1.0
+# Probes of a host that has not changed state are spaced out from the interval to the max interval by the backoff factor
+PROBE_INTERVAL = 1.0
+MAX_PROBE_INTERVAL = 5.0
+PROBE_BACKOFF = 1.5
+TCP_PROBE_PORT = 80
+
+
+def checksum(data: bytes) -> int:
+    """ RFC 1071 internet checksum """
+    if len(data) % 2:
+        data += b'\x00'
+    total = sum(struct.unpack(f'!{len(data) // 2}H', data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+def echo_request(sequence: int, payload: bytes = b'kube-axis') -> bytes:
+    """ Builds an ICMP echo request. The identifier is set by the kernel for ICMP datagram sockets """
+    header = struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, 0, 0, sequence)
+    return struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, checksum(header + payload), 0, sequence) + payload
+
+
+class Reachability:
+    """
+    In process reachability probes of many hosts multiplexed on the running event loop.
+
+    Hosts (ip addresses) are probed with ICMP echo requests sent over a single unprivileged ICMP datagram socket
+    (allowed by net.ipv4.ping_group_range, or as root). If the socket can not be opened or a request can not be sent,
+    the host is probed by connecting to TCP port 80 instead, where a refused connection also counts as reachable.
+    """
+
+    def __init__(self, timeout: float = PROBE_TIMEOUT, port: int = TCP_PROBE_PORT):
+        self.timeout = timeout
+        self.port = port
+        self.loop = asyncio.get_running_loop()
+        self.sequence = itertools.count(1)
+        self.pending = {}
+        self.probes = 0
+        self.sock = None
+        try:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+            self.sock.setblocking(False)
+            self.loop.add_reader(self.sock.fileno(), self._receive)
+        except OSError as e:
+            logger.warning(f"ICMP datagram sockets are unavailable ({e}), hosts will be probed on TCP port {port}")
+            if self.sock:
+                self.sock.close()
+            self.sock = None
+
+
+    def _receive(self):
+        """ Resolves the pending probes of every echo reply waiting on the socket """
+        while True:
+            try:
+                data, (host, _) = self.sock.recvfrom(1024)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                logger.debug(f"ICMP socket error: {e}")
+                return
+            if len(data) < 8 or data[0] != ICMP_ECHO_REPLY:
+                continue
+            sequence = struct.unpack('!H', data[6:8])[0]
+            future = self.pending.pop((host, sequence), None)
+            if future and not future.done():
+                future.set_result(True)
+
+
+    async def _icmp(self, host: str) -> bool:
+        sequence = next(self.sequence) & 0xffff
+        future = self.loop.create_future()
+        self.pending[(host, sequence)] = future
+        try:
+            self.sock.sendto(echo_request(sequence), (host, 0))
+        except OSError as e:
+            self.pending.pop((host, sequence), None)
+            logger.debug(f"Failed to send ICMP echo request to {host} ({e}), probing TCP port {self.port}")
+            return await self._tcp(host)
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.pending.pop((host, sequence), None)
+
+
+    async def _tcp(self, host: str) -> bool:
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(host, self.port), self.timeout)
+        except ConnectionRefusedError:
+            return True
+        except (OSError, asyncio.TimeoutError):
+            return False
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+        return True
+
+
+    async def probe(self, host: str) -> bool:
+        """ Returns True if the host answered a single probe within the probe timeout """
+        self.probes += 1
+        return await (self._icmp(host) if self.sock else self._tcp(host))
+
+
+    async def alive(self, hosts: list) -> list:
+        """ Probes every host at once and returns the hosts that answered """
+        results = await asyncio.gather(*(self.probe(host) for host in hosts))
+        return [host for host, answered in zip(hosts, results) if answered]
+
+
+    async def wait_for(self, host: str, up: bool, timeout: float, successes: int = 1, interval: float = PROBE_INTERVAL,
+                       max_interval: float = MAX_PROBE_INTERVAL, backoff: float = PROBE_BACKOFF) -> float:
+        """
+        Probes the host until it has been up (or down) for `successes` consecutive probes and returns how long it took, in seconds.
+        Probes are sent every interval, backing off to the max interval while the host has not reached the state.
+        An exception is raised if the host did not reach the state within the timeout, in seconds.
+        """
+        start_time = time.monotonic()
+        deadline = start_time + timeout
+        delay = interval
+        count = 0
+        while True:
+            if await self.probe(host) == up:
+                count += 1
+                if count >= successes:
+                    return time.monotonic() - start_time
+                delay = interval
+            else:
+                count = 0
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise Exception(f"Host {host} did not go {'up' if up else 'down'} within {timeout} seconds")
+            await asyncio.sleep(min(delay, remaining))
+            if count == 0:
+                delay = min(delay * backoff, max_interval)
+
+
+    async def wait_until_up(self, host: str, timeout: float = 60, successes: int = 1, **kwargs) -> float:
+        """ Waits until the host answers `successes` consecutive probes and returns how long it took, in seconds """
+        return await self.wait_for(host, up=True, timeout=timeout, successes=successes, **kwargs)
+
+
+    async def wait_until_down_then_up(self, host: str, down_timeout: float = 60, timeout: float = 300, successes: int = 3, **kwargs) -> dict:
+        """
+        Waits for a reboot of the host, it must first stop answering and then answer `successes` consecutive probes.
+        The host is probed at a steady interval while waiting for it to go down, so a short reboot is not missed.
+        If the host is never seen down within the down timeout it is assumed to have rebooted between probes.
+        Returns how long the host took to go down and to come back up, in seconds.
+        """
+        start_time = time.monotonic()
+        try:
+            down = await self.wait_for(host, up=False, timeout=down_timeout, **{**kwargs, 'backoff': 1})
+        except Exception:
+            logger.warning(f"Host {host} was not seen going down within {down_timeout} seconds")
+            down = None
+        up = await self.wait_for(host, up=True, timeout=max(timeout - (time.monotonic() - start_time), 0), successes=successes, **kwargs)
+        return {'down': down, 'up': up}
+
+
+    def close(self):
+        if self.sock:
+            self.loop.remove_reader(self.sock.fileno())
+            self.sock.close()
+            self.sock = None
+        for future in self.pending.values():
+            future.cancel()
+        self.pending.clear()
+
+
+def wait_until_up(host: str, timeout: float = 60, **kwargs) -> float:
+    """
+    Waits until the host answers and returns how long it took, in seconds.
+    If it does not answer within the timeout, provided in seconds, an exception will be thrown indicating the host is unreachable.
+    """
+    async def wait():
+        reachability = Reachability()
+        try:
+            return await reachability.wait_until_up(host, timeout=timeout, **kwargs)
+        finally:
+            reachability.close()
+
+    return asyncio.run(wait())
+
+
+def alive(hosts: list, timeout: float = PROBE_TIMEOUT) -> list:
+    """ Probes every host at once and returns the hosts that answered within the timeout, provided in seconds """
+    async def probe():
+        reachability = Reachability(timeout=timeout)
+        try:
+            return await reachability.alive(hosts)
+        finally:
+            reachability.close()
+
+    return asyncio.run(probe())
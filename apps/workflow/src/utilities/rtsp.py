@@ -0,0 +1,369 @@
+import re
+import time
+import base64
+import socket
+import struct
+import hashlib
+import logging
+from urllib.parse import urlsplit, parse_qs
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RTSP_PORT = 554
+# How long the whole probe may take and how long the stream is sampled after the first keyframe, in seconds
+PROBE_BUDGET = 15.0
+SAMPLE_DURATION = 5.0
+DEFAULT_CLOCK_RATE = 90000
+
+NAL_SLICE = 1
+NAL_IDR = 5
+NAL_SPS = 7
+NAL_STAP_A = 24
+NAL_FU_A = 28
+
+
+class BitReader:
+    """ Reads the bits and exp-Golomb codes of an H.264 RBSP """
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.position = 0
+
+
+    def bit(self) -> int:
+        byte = self.data[self.position >> 3]
+        value = (byte >> (7 - (self.position & 7))) & 1
+        self.position += 1
+        return value
+
+
+    def bits(self, count: int) -> int:
+        value = 0
+        for _ in range(count):
+            value = (value << 1) | self.bit()
+        return value
+
+
+    def ue(self) -> int:
+        zeros = 0
+        while self.bit() == 0:
+            zeros += 1
+        return (1 << zeros) - 1 + self.bits(zeros)
+
+
+    def se(self) -> int:
+        value = self.ue()
+        return (value + 1) // 2 if value & 1 else -(value // 2)
+
+
+def unescape(nal: bytes) -> bytes:
+    """ Removes the emulation prevention bytes (00 00 03) of a NAL unit """
+    return re.sub(b'\x00\x00\x03', b'\x00\x00', nal)
+
+
+def parse_sps(nal: bytes) -> tuple:
+    """ Returns the (width, height) in pixels coded in an H.264 sequence parameter set NAL unit """
+    reader = BitReader(unescape(nal[1:]))
+    profile_idc = reader.bits(8)
+    reader.bits(16)  # constraint flags and level_idc
+    reader.ue()  # seq_parameter_set_id
+    chroma_format_idc = 1
+    if profile_idc in (100, 110, 122, 244, 44, 83, 86, 118, 128, 138, 139, 134, 135):
+        chroma_format_idc = reader.ue()
+        if chroma_format_idc == 3:
+            reader.bit()  # separate_colour_plane_flag
+        reader.ue()  # bit_depth_luma_minus8
+        reader.ue()  # bit_depth_chroma_minus8
+        reader.bit()  # qpprime_y_zero_transform_bypass_flag
+        if reader.bit():  # seq_scaling_matrix_present_flag
+            for i in range(8 if chroma_format_idc != 3 else 12):
+                if reader.bit():
+                    last, next_scale = 8, 8
+                    for _ in range(16 if i < 6 else 64):
+                        if next_scale:
+                            next_scale = (last + reader.se() + 256) % 256
+                        last = next_scale or last
+    reader.ue()  # log2_max_frame_num_minus4
+    pic_order_cnt_type = reader.ue()
+    if pic_order_cnt_type == 0:
+        reader.ue()
+    elif pic_order_cnt_type == 1:
+        reader.bit()
+        reader.se()
+        reader.se()
+        for _ in range(reader.ue()):
+            reader.se()
+    reader.ue()  # max_num_ref_frames
+    reader.bit()  # gaps_in_frame_num_value_allowed_flag
+    width_in_mbs = reader.ue() + 1
+    height_in_map_units = reader.ue() + 1
+    frame_mbs_only = reader.bit()
+    if not frame_mbs_only:
+        reader.bit()  # mb_adaptive_frame_field_flag
+    reader.bit()  # direct_8x8_inference_flag
+    crop = (0, 0, 0, 0)
+    if reader.bit():  # frame_cropping_flag
+        crop = (reader.ue(), reader.ue(), reader.ue(), reader.ue())
+    crop_x = 1 if chroma_format_idc in (0, 3) else 2
+    crop_y = (1 if chroma_format_idc in (0, 2, 3) else 2) * (2 - frame_mbs_only)
+    width = width_in_mbs * 16 - crop_x * (crop[0] + crop[1])
+    height = (2 - frame_mbs_only) * height_in_map_units * 16 - crop_y * (crop[2] + crop[3])
+    return width, height
+
+
+def nal_types(payload: bytes) -> list:
+    """ Returns the types of the NAL units that start in an H.264 RTP payload (RFC 6184) """
+    nal_type = payload[0] & 0x1f
+    if nal_type == NAL_FU_A:
+        start = payload[1] & 0x80
+        return [payload[1] & 0x1f] if start else []
+    if nal_type == NAL_STAP_A:
+        types, offset = [], 1
+        while offset + 2 < len(payload):
+            size = struct.unpack('!H', payload[offset:offset + 2])[0]
+            types.append(payload[offset + 2] & 0x1f)
+            offset += 2 + size
+        return types
+    return [nal_type]
+
+
+def parameter_sets(payload: bytes) -> list:
+    """ Returns the complete SPS NAL units carried in an H.264 RTP payload """
+    nal_type = payload[0] & 0x1f
+    if nal_type == NAL_SPS:
+        return [payload]
+    if nal_type == NAL_STAP_A:
+        units, offset = [], 1
+        while offset + 2 < len(payload):
+            size = struct.unpack('!H', payload[offset:offset + 2])[0]
+            unit = payload[offset + 2:offset + 2 + size]
+            if unit and unit[0] & 0x1f == NAL_SPS:
+                units.append(unit)
+            offset += 2 + size
+        return units
+    return []
+
+
+def parse_sdp(sdp: str, base_url: str) -> dict:
+    """ Returns the control url, payload format, clock rate and SPS of the first video media of a session description """
+    media = None
+    for line in sdp.splitlines():
+        line = line.strip()
+        if line.startswith('m='):
+            if media:
+                break
+            if line.startswith('m=video'):
+                media = {'control': base_url, 'encoding': None, 'clock_rate': DEFAULT_CLOCK_RATE, 'sps': None}
+        elif media and line.startswith('a=control:'):
+            control = line.removeprefix('a=control:')
+            if control.startswith('rtsp://'):
+                media['control'] = control
+            elif control != '*':
+                media['control'] = f"{base_url.rstrip('/')}/{control}"
+        elif media and line.startswith('a=rtpmap:'):
+            encoding = line.split(' ', 1)[1].split('/')
+            media['encoding'] = encoding[0]
+            media['clock_rate'] = int(encoding[1]) if len(encoding) > 1 else DEFAULT_CLOCK_RATE
+        elif media and line.startswith('a=fmtp:') and 'sprop-parameter-sets=' in line:
+            sets = line.split('sprop-parameter-sets=', 1)[1].split(';')[0].split(',')
+            media['sps'] = next((base64.b64decode(s) for s in sets if s and base64.b64decode(s)[0] & 0x1f == NAL_SPS), None)
+    if media is None:
+        raise Exception("The stream does not describe a video media")
+    return media
+
+
+class RTSPProbe:
+    """
+    In process RTSP client that plays a stream over interleaved TCP (RTP/AVP/TCP) and measures it, within a bounded budget.
+
+    Measures the TCP connect latency, the time until the PLAY response, the time to the first frame and to the first keyframe
+    (IDR) from the start of the probe, and once the first keyframe has been received samples the stream for the sample duration:
+    the effective fps and bitrate from the RTP timestamps, the resolution coded in the SPS, the number of frames between
+    keyframes (GOP lengths) and the RTP packets lost.
+    """
+
+    def __init__(self, url: str, username: str = None, password: str = None, budget: float = PROBE_BUDGET, sample_duration: float = SAMPLE_DURATION):
+        self.url = url
+        self.username = username
+        self.password = password
+        self.budget = budget
+        self.sample_duration = sample_duration
+        self.cseq = 0
+        self.session = None
+        self.challenge = None
+        self.sock = None
+        self.reader = None
+
+
+    def _remaining(self) -> float:
+        remaining = self.deadline - time.monotonic()
+        if remaining <= 0:
+            raise Exception(f"RTSP probe of {self.url} exceeded its budget of {self.budget} seconds")
+        return remaining
+
+
+    def _authorization(self, method: str, url: str) -> str:
+        """ Returns the Authorization header answering the challenge of the camera, a digest is computed for every request """
+        if self.challenge.startswith('Digest'):
+            fields = dict(re.findall(r'(\w+)="?([^",]+)"?', self.challenge))
+            ha1 = hashlib.md5(f"{self.username}:{fields['realm']}:{self.password}".encode()).hexdigest()
+            ha2 = hashlib.md5(f"{method}:{url}".encode()).hexdigest()
+            response = hashlib.md5(f"{ha1}:{fields['nonce']}:{ha2}".encode()).hexdigest()
+            return f'Digest username="{self.username}", realm="{fields["realm"]}", nonce="{fields["nonce"]}", uri="{url}", response="{response}"'
+        return 'Basic ' + base64.b64encode(f"{self.username}:{self.password}".encode()).decode()
+
+
+    def request(self, method: str, url: str, headers: dict = None) -> tuple:
+        """ Sends an RTSP request and returns the status code, headers and body of its response. Authenticates on a 401 """
+        for _ in range(2):
+            self.cseq += 1
+            lines = [f"{method} {url} RTSP/1.0", f"CSeq: {self.cseq}", "User-Agent: kube-axis"]
+            if self.session:
+                lines.append(f"Session: {self.session}")
+            if self.challenge:
+                lines.append(f"Authorization: {self._authorization(method, url)}")
+            lines += [f"{key}: {value}" for key, value in (headers or {}).items()]
+            self.sock.settimeout(self._remaining())
+            self.sock.sendall(('\r\n'.join(lines) + '\r\n\r\n').encode())
+            status, response_headers, body = self._read_response()
+            if status == 401 and self.username and self.challenge is None:
+                self.challenge = response_headers.get('www-authenticate', '')
+                continue
+            if status != 200:
+                raise Exception(f"RTSP {method} {url} failed with status {status}")
+            return status, response_headers, body
+        raise Exception(f"RTSP {method} {url} was not authorized")
+
+
+    def _read_response(self) -> tuple:
+        while True:
+            first = self.reader.read(1)
+            if not first:
+                raise Exception("RTSP connection closed by the camera")
+            if first == b'$':
+                # interleaved data ahead of the response
+                _, length = struct.unpack('!BH', self.reader.read(3))
+                self.reader.read(length)
+                continue
+            status_line = first + self.reader.readline()
+            break
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = self.reader.readline().decode().strip()
+            if not line:
+                break
+            key, _, value = line.partition(':')
+            headers[key.strip().lower()] = value.strip()
+        body = self.reader.read(int(headers.get('content-length', 0)))
+        return status, headers, body
+
+
+    def _read_packet(self) -> tuple:
+        """ Returns the channel and payload of the next interleaved packet, skipping RTSP messages in between """
+        while True:
+            first = self.reader.read(1)
+            if not first:
+                raise Exception("RTSP connection closed by the camera")
+            if first == b'$':
+                channel, length = struct.unpack('!BH', self.reader.read(3))
+                return channel, self.reader.read(length)
+            self.reader.readline()
+
+
+    def run(self) -> dict:
+        start_time = time.monotonic()
+        self.deadline = start_time + self.budget
+        elapsed = lambda: round(time.monotonic() - start_time, 3)
+        parts = urlsplit(self.url)
+        requested = {key: values[0] for key, values in parse_qs(parts.query).items()}
+        metrics = {'url': self.url, 'requested': {'resolution': requested.get('resolution'), 'fps': float(requested['FPS']) if 'FPS' in requested else None}}
+
+        self.sock = socket.create_connection((parts.hostname, parts.port or DEFAULT_RTSP_PORT), timeout=self._remaining())
+        self.reader = self.sock.makefile('rb')
+        metrics['connect_latency'] = elapsed()
+        try:
+            self.request('OPTIONS', self.url)
+            _, headers, body = self.request('DESCRIBE', self.url, {'Accept': 'application/sdp'})
+            media = parse_sdp(body.decode(), headers.get('content-base', self.url))
+            _, headers, _ = self.request('SETUP', media['control'], {'Transport': 'RTP/AVP/TCP;unicast;interleaved=0-1'})
+            self.session = headers.get('session', '').split(';')[0] or None
+            self.request('PLAY', self.url, {'Range': 'npt=0.000-'})
+            metrics['play_latency'] = elapsed()
+            metrics.update(self._sample(media, elapsed))
+            try:
+                self.request('TEARDOWN', self.url)
+            except Exception:
+                pass
+        finally:
+            self.reader.close()
+            self.sock.close()
+        metrics['duration'] = elapsed()
+        return metrics
+
+
+    def _sample(self, media: dict, elapsed) -> dict:
+        clock_rate = media['clock_rate']
+        sps = media['sps']
+        frames = []  # [rtp timestamp, bytes, keyframe]
+        sample_end = None
+        expected_sequence = None
+        lost = 0
+        first_frame = first_keyframe = None
+        while True:
+            if sample_end and time.monotonic() >= sample_end:
+                break
+            self.sock.settimeout(max(min(self._remaining(), (sample_end or self.deadline) - time.monotonic()), 0.01))
+            try:
+                channel, packet = self._read_packet()
+            except socket.timeout:
+                if sample_end:
+                    break
+                raise
+            if channel != 0 or len(packet) < 12:
+                continue
+
+            # RTP header (RFC 3550), skipping CSRCs and extensions
+            sequence, timestamp = struct.unpack('!HI', packet[2:8])
+            offset = 12 + 4 * (packet[0] & 0x0f)
+            if packet[0] & 0x10:
+                offset += 4 + 4 * struct.unpack('!H', packet[offset + 2:offset + 4])[0]
+            payload = packet[offset:]
+            if not payload:
+                continue
+            if expected_sequence is not None and sequence != expected_sequence:
+                lost += (sequence - expected_sequence) & 0xffff
+            expected_sequence = (sequence + 1) & 0xffff
+
+            if sps is None:
+                sps = next(iter(parameter_sets(payload)), None)
+            if not frames or frames[-1][0] != timestamp:
+                frames.append([timestamp, 0, False])
+                if first_frame is None:
+                    first_frame = elapsed()
+            frames[-1][1] += len(payload)
+            if NAL_IDR in nal_types(payload):
+                frames[-1][2] = True
+                if first_keyframe is None:
+                    first_keyframe = elapsed()
+                    sample_end = time.monotonic() + self.sample_duration
+                    # frames before the first keyframe can not be decoded, the sample starts at the keyframe
+                    frames = [frames[-1]]
+
+        metrics = {'time_to_first_frame': first_frame, 'time_to_first_keyframe': first_keyframe, 'packets_lost': lost}
+        metrics['resolution'] = '{}x{}'.format(*parse_sps(sps)) if sps else None
+        # the last frame may be incomplete, rates are measured over the frames before it
+        complete = frames[:-1]
+        duration = ((frames[-1][0] - frames[0][0]) & 0xffffffff) / clock_rate if len(frames) > 1 else 0
+        metrics['frames'] = len(complete)
+        metrics['fps'] = round(len(complete) / duration, 2) if duration else 0
+        metrics['bitrate_kbps'] = round(sum(frame[1] for frame in complete) * 8 / duration / 1000, 1) if duration else 0
+        keyframes = [index for index, frame in enumerate(complete) if frame[2]]
+        metrics['keyframes'] = len(keyframes)
+        metrics['gop_lengths'] = [b - a for a, b in zip(keyframes, keyframes[1:])]
+        return metrics
+
+
+def probe(url: str, username: str = None, password: str = None, budget: float = PROBE_BUDGET, sample_duration: float = SAMPLE_DURATION) -> dict:
+    """ Plays the RTSP stream and returns its metrics, see RTSPProbe. An exception is raised if the budget is exceeded """
+    return RTSPProbe(url, username=username, password=password, budget=budget, sample_duration=sample_duration).run()
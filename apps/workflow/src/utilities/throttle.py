@@ -0,0 +1,65 @@
+import os
+import time
+import threading
+
+
+class TokenBucket:
+    """
+    Thread safe token bucket limiting the rate, in bytes per second, shared by every reader that consumes from it.
+    Consuming more tokens than are available goes into debt and sleeps until the debt is paid off,
+    so concurrent readers share the rate.
+    """
+
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+
+    def consume(self, amount: int):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.tokens + (now - self.updated) * self.rate, self.capacity)
+            self.updated = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class ThrottledReader:
+    """
+    File like reader whose reads are limited by a token bucket. It reports the length of the wrapped reader
+    and passes tell and seek through, so requests can rewind the body to resend it after a digest authentication challenge.
+    A resent byte is charged to the bucket again, it uses the uplink again.
+    """
+
+    def __init__(self, reader, bucket: TokenBucket):
+        self.reader = reader
+        self.bucket = bucket
+        self.length = len(reader) if hasattr(reader, '__len__') else os.fstat(reader.fileno()).st_size
+        # bytes charged to the bucket since the body was last rewound
+        self.charged = 0
+
+
+    def __len__(self):
+        return self.length
+
+
+    def read(self, size: int = -1) -> bytes:
+        chunk = self.reader.read(size)
+        self.bucket.consume(len(chunk))
+        self.charged += len(chunk)
+        return chunk
+
+
+    def tell(self) -> int:
+        return self.reader.tell()
+
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        position = self.reader.seek(offset, whence)
+        self.charged = 0
+        return position
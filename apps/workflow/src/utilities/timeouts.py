@@ -0,0 +1,113 @@
+import threading
+
+# Smoothing gains and variance multiplier of the RFC 6298 retransmission timeout estimator
+SRTT_GAIN = 1 / 8
+RTTVAR_GAIN = 1 / 4
+RTTVAR_MULTIPLIER = 4
+# Connect timeout of a host without samples and the bounds of the one derived from its response times, in seconds
+INITIAL_CONNECT_TIMEOUT = 3.05
+MIN_CONNECT_TIMEOUT = 1.0
+MAX_CONNECT_TIMEOUT = 10.0
+# (floor, ceiling) of the read timeout of a cgi endpoint in seconds. An endpoint without samples starts at its ceiling,
+# which is the static timeout the endpoint used before it was learned. Slow endpoints get their own budget.
+DEFAULT_BUDGET = (2.0, 30.0)
+ENDPOINT_BUDGETS = {
+    'firmwareupgrade.cgi': (120.0, 600.0),
+    'disks/format.cgi': (10.0, 120.0),
+}
+# Timeouts double after every request that timed out, up to the ceiling, until a response is seen again
+TIMEOUT_BACKOFF = 2
+
+
+class Estimate:
+    """ Smoothed response time (SRTT) and its variation (RTTVAR) of a series of samples, as in RFC 6298 """
+
+    def __init__(self, srtt: float = None, rttvar: float = None, samples: int = 0):
+        self.srtt = srtt
+        self.rttvar = rttvar
+        self.samples = samples
+        self.backoff = 1
+
+
+    def update(self, sample: float):
+        if self.srtt is None:
+            self.srtt = sample
+            self.rttvar = sample / 2
+        else:
+            self.rttvar = (1 - RTTVAR_GAIN) * self.rttvar + RTTVAR_GAIN * abs(self.srtt - sample)
+            self.srtt = (1 - SRTT_GAIN) * self.srtt + SRTT_GAIN * sample
+        self.samples += 1
+        self.backoff = 1
+
+
+    def timeout(self, floor: float, ceiling: float) -> float:
+        """ Returns SRTT + 4 * RTTVAR, backed off after timeouts and bounded by the floor and ceiling. Without samples it is the ceiling """
+        if self.srtt is None:
+            return ceiling
+        return min(max((self.srtt + RTTVAR_MULTIPLIER * self.rttvar) * self.backoff, floor), ceiling)
+
+
+    def to_state(self) -> dict:
+        return {'srtt': round(self.srtt, 4), 'rttvar': round(self.rttvar, 4), 'samples': self.samples}
+
+
+class AdaptiveTimeouts:
+    """
+    Request timeouts of a camera learned from its measured response times.
+
+    Every response updates the estimate of its cgi endpoint and of the host. The read timeout of a request is derived
+    from the estimate of its endpoint and bounded by the endpoint's budget, the connect timeout from the estimate of the host.
+    A camera on the LAN quickly gets short timeouts that detect failures fast, a camera behind a congested link
+    gets timeouts long enough for its normal response times.
+    The estimates are saved in the workflow state so the following steps start from them.
+    """
+
+    def __init__(self, estimates: dict = None):
+        self._lock = threading.Lock()
+        self.host = Estimate()
+        self.endpoints = {}
+        for endpoint, estimate in (estimates or {}).items():
+            if endpoint == 'host':
+                self.host = Estimate(**estimate)
+            else:
+                self.endpoints[endpoint] = Estimate(**estimate)
+
+
+    @classmethod
+    def from_state(cls, state: dict) -> 'AdaptiveTimeouts':
+        """ Returns the timeouts learned by the previous steps of the workflow """
+        return cls(state.get('vapix', {}).get('timeouts'))
+
+
+    def timeout(self, endpoint: str) -> tuple:
+        """ Returns the (connect, read) timeouts of a request to the endpoint, in seconds """
+        floor, ceiling = ENDPOINT_BUDGETS.get(endpoint, DEFAULT_BUDGET)
+        with self._lock:
+            read = self.endpoints.get(endpoint, Estimate()).timeout(floor, ceiling)
+            connect = self.host.timeout(MIN_CONNECT_TIMEOUT, MAX_CONNECT_TIMEOUT) if self.host.samples else INITIAL_CONNECT_TIMEOUT
+        return (connect, read)
+
+
+    def record(self, endpoint: str, elapsed: float):
+        """ Records the response time of a request to the endpoint, in seconds """
+        with self._lock:
+            self.endpoints.setdefault(endpoint, Estimate()).update(elapsed)
+            # the slow endpoints are busy on the camera for most of their response time, which says little about the link
+            if endpoint not in ENDPOINT_BUDGETS:
+                self.host.update(elapsed)
+
+
+    def record_timeout(self, endpoint: str):
+        """ Backs off the timeouts of the endpoint and of the host after a request timed out """
+        with self._lock:
+            estimate = self.endpoints.setdefault(endpoint, Estimate())
+            estimate.backoff *= TIMEOUT_BACKOFF
+            self.host.backoff *= TIMEOUT_BACKOFF
+
+
+    def to_state(self) -> dict:
+        with self._lock:
+            estimates = {endpoint: estimate.to_state() for endpoint, estimate in self.endpoints.items() if estimate.samples}
+            if self.host.samples:
+                estimates['host'] = self.host.to_state()
+        return estimates
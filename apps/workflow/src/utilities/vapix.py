@@ -1,10 +1,176 @@
+import re
+import time
+import asyncio
 import logging
+import threading
+from urllib.parse import urlencode, urlparse
+from xml.etree import ElementTree
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPDigestAuth
 
+from utilities.timeouts import AdaptiveTimeouts
+
 logger = logging.getLogger(__name__)
 
+# Batched param.cgi updates are split so the request url never exceeds this length
+MAX_PARAMETER_URL_LENGTH = 2048
+# How long parameter updates are collected before they are flushed to the camera in as few requests as possible
+PARAMETER_BATCH_WINDOW = 0.05
+# (connect, read) timeouts in seconds of requests that are not made to a cgi endpoint, e.g exporting a recording
+DEFAULT_TIMEOUT = (3.05, 30)
+# Consecutive failures to reach a host that open its circuit breaker, and how long it stays open in seconds
+CIRCUIT_BREAKER_THRESHOLD = 3
+CIRCUIT_BREAKER_RESET_TIMEOUT = 30
+
+
+class VAPIXError(Exception):
+    """ Base class of the errors raised by VAPIX requests. `retryable` is False if retrying the request can not help """
+    retryable = True
+
+
+class DeviceUnreachableError(VAPIXError):
+    """ The camera could not be connected to or did not respond in time """
+
+
+class CircuitOpenError(DeviceUnreachableError):
+    """ The camera has failed to respond repeatedly, the request was not sent """
+    retryable = False
+
+
+class AuthenticationError(VAPIXError):
+    """ The camera rejected the credentials """
+    retryable = False
+
+
+class DeviceError(VAPIXError):
+    """ The camera responded with an HTTP error or reported an error for the request """
+
+
+class MalformedResponseError(VAPIXError):
+    """ The camera responded with a body that could not be parsed """
+
+
+class CircuitBreaker:
+    """
+    Per host circuit breaker shared by every VAPIX client of the host.
+    After `threshold` consecutive failures to reach the host the breaker opens and requests fail fast with CircuitOpenError
+    instead of each waiting for its own timeout. Once `reset_timeout` seconds have passed a single trial request is let through,
+    if it reaches the host the breaker closes again, otherwise it stays open for another `reset_timeout`.
+    """
+    _breakers = {}
+    _breakers_lock = threading.Lock()
+
+    def __init__(self, host: str, threshold: int = CIRCUIT_BREAKER_THRESHOLD, reset_timeout: float = CIRCUIT_BREAKER_RESET_TIMEOUT):
+        self.host = host
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_host(cls, host: str) -> 'CircuitBreaker':
+        with cls._breakers_lock:
+            if host not in cls._breakers:
+                cls._breakers[host] = cls(host)
+            return cls._breakers[host]
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        return 'half-open' if self.trial else 'open'
+
+    def before_request(self):
+        """ Raises CircuitOpenError if the breaker is open, otherwise lets the request through """
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if self.trial or time.monotonic() - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError(f"[{self.host}] Circuit breaker is open after {self.failures} consecutive failures to reach the camera")
+            self.trial = True
+
+    def record_success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                logger.info(f"[{self.host}] Circuit breaker closed, the camera is reachable again")
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.trial or (self.opened_at is None and self.failures >= self.threshold):
+                logger.warning(f"[{self.host}] Circuit breaker opened after {self.failures} consecutive failures to reach the camera")
+                self.opened_at = time.monotonic()
+            self.trial = False
+
+
+class ParameterUpdate:
+    """
+    The parameter updates requested by a single owner (e.g. a configuration step).
+    Once the updates have been sent, the errors reported by the camera for any of these parameters are attributed to this owner.
+    """
+
+    def __init__(self, owner: str, parameters: dict):
+        self.owner = owner
+        self.parameters = {key: str(value) for key, value in parameters.items()}
+        self.errors = {}
+        self.responses = []
+
+    @property
+    def ok(self) -> bool:
+        return bool(self.responses) and not self.errors
+
+    @property
+    def text(self) -> str:
+        return '\n'.join(response.text for response in self.responses if response is not None)
+
+    @property
+    def error(self) -> str:
+        return ', '.join(f"{key}: {reason}" for key, reason in self.errors.items())
+
+
+class ParameterBatch:
+    """
+    A set of parameter updates, possibly from several owners, that is sent to param.cgi in a single request.
+    """
+
+    def __init__(self):
+        self.parameters = {}
+        self.owners = {}
+
+    def add(self, update: ParameterUpdate, key: str, value: str):
+        self.parameters[key] = value
+        self.owners[key] = update
+
+    def resolve(self, response: requests.Response):
+        """
+        Attributes the result of the param.cgi update to the owners of each parameter.
+        On success param.cgi responds with 'OK', otherwise with lines like "# Error: Error setting 'SNMP.V3' to 'no'!"
+        """
+        for update in set(self.owners.values()):
+            update.responses.append(response)
+
+        if response is None or not response.ok:
+            reason = 'no response from camera' if response is None else f'HTTP {response.status_code}'
+            for key, update in self.owners.items():
+                update.errors[key] = reason
+            return
+
+        errors = [line.strip() for line in response.text.splitlines() if 'error' in line.lower()]
+        for error in errors:
+            keys = [key for key in re.findall(r"'([^']+)'", error) if key in self.owners]
+            # errors that can't be attributed to a parameter fail every parameter in the request
+            for key in keys or self.owners:
+                self.owners[key].errors[key] = error
+                logger.error(f"param.cgi failed to update '{key}' requested by '{self.owners[key].owner}': {error}")
+
 
 class VAPIX:
     """
@@ -15,16 +181,36 @@ class VAPIX:
     When debugging server side errors a list of system event logs can be found here http://<your-axis-cam-ip>/axis-cgi/admin/systemlog.cgi
     """
 
-    def __init__(self, name: str, host: str, username: str = None, password: str = None, timeout=None):
+    def __init__(self, name: str, host: str, username: str = None, password: str = None, timeout=None,
+                 pool_size: int = 10, circuit_breaker: bool = True, timeouts: AdaptiveTimeouts = None):
         self.name = name
         self.host = host
         self.username = username
         self.password = password
+        # a static (connect, read) timeout, otherwise timeouts are learned from the response times of the camera
         self.timeout = timeout
+        self.timeouts = timeouts or AdaptiveTimeouts()
+        # disable the circuit breaker when the camera is expected to be unreachable for a while, e.g polling for readiness
+        self.circuit_breaker = circuit_breaker
+
+        # A single session keeps the TCP connections to the camera alive between cgi calls and
+        # a single digest auth instance reuses the server nonce (incrementing the nonce count),
+        # so only the first request has to go through the 401 challenge round trip.
+        self.auth = HTTPDigestAuth(username, password)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.requests = 0
+        self.challenges = 0
+        self._counter_lock = threading.Lock()
+
         self.stream_profile_cgi = f"http://{host}/axis-cgi/streamprofile.cgi"
         self.disk_management_list_cgi = f"http://{host}/axis-cgi/disks/list.cgi"
         self.zipstream_setgop_cgi = f"http://{host}/axis-cgi/zipstream/setgop.cgi"
         self.zipstream_setstrength_cgi = f"http://{host}/axis-cgi/zipstream/setstrength.cgi"
+        self.zipstream_getgop_cgi = f"http://{host}/axis-cgi/zipstream/getgop.cgi"
+        self.zipstream_getstrength_cgi = f"http://{host}/axis-cgi/zipstream/getstrength.cgi"
         self.textoverlay_cgi = f"http://{host}/axis-cgi/dynamicoverlay/dynamicoverlay.cgi"
         self.record_export_cgi = f"http://{host}/axis-cgi/record/export/exportrecording.cgi"
         self.record_remove_cgi = f"http://{host}/axis-cgi/record/remove.cgi"
@@ -38,6 +224,7 @@ class VAPIX:
         self.ntp_cgi = f"http://{host}/axis-cgi/ntp.cgi"
         self.pwdgrp_cgi = f"http://{host}/axis-cgi/pwdgrp.cgi"
         self.network_settings_cgi = f"http://{host}/axis-cgi/network_settings.cgi"
+        self.image_cgi = f"http://{host}/axis-cgi/jpg/image.cgi"
 
 
     def _list_disks(self, params):
@@ -72,6 +259,24 @@ class VAPIX:
         return self.request('GET', self.zipstream_setstrength_cgi, params=params)
 
 
+    def _get_zipstream_gop(self, params):
+        """ Use zipstream/getgop.cgi to retrieve the GOP mode and the maximum GOP length of the video channels. """
+        logger.debug(f"VAPIX [{self.host}] Getting the Zipstream GOP mode and the maximum GOP length.")
+        return self.request('GET', self.zipstream_getgop_cgi, params=params)
+
+
+    def _get_zipstream_strength(self, params):
+        """ Use zipstream/getstrength.cgi to retrieve the Zipstream strength of the video channels. """
+        logger.debug(f"VAPIX [{self.host}] Getting the Zipstream strength")
+        return self.request('GET', self.zipstream_getstrength_cgi, params=params)
+
+
+    def _get_image(self, params):
+        """ Use jpg/image.cgi to request a JPEG snapshot of a video channel. """
+        logger.debug(f"VAPIX [{self.host}] Requesting a JPEG snapshot")
+        return self.request('GET', self.image_cgi, headers={}, params=params)
+
+
     def _text_overlay(self, data):
         """
         List all overlays previously created by add methods.
@@ -127,6 +332,36 @@ class VAPIX:
         return self.request(method=method, url=self.params_cgi, params=params)
 
 
+    def _batch_parameter_updates(self, updates: list) -> list:
+        """
+        Packs the parameter updates into as few param.cgi update requests as the url length limit allows.
+        A parameter updated more than once is moved to the next request so the updates are applied in order.
+        """
+        batches = [ParameterBatch()]
+        length = len(f"{self.params_cgi}?{urlencode({'action': 'update'})}")
+        for update in updates:
+            for key, value in update.parameters.items():
+                size = len(urlencode({key: value})) + 1
+                batch = batches[-1]
+                if batch.parameters and (key in batch.parameters or length + size > MAX_PARAMETER_URL_LENGTH):
+                    batches.append(ParameterBatch())
+                    length = len(f"{self.params_cgi}?{urlencode({'action': 'update'})}")
+                batches[-1].add(update, key, value)
+                length += size
+        return [batch for batch in batches if batch.parameters]
+
+
+    def update_parameters(self, parameters: dict, owner: str = None) -> ParameterUpdate:
+        """
+        Updates the parameters with param.cgi in as few requests as possible.
+        Returns the update, its `ok` property is False if the camera failed to update any of the parameters.
+        """
+        update = ParameterUpdate(owner, parameters)
+        for batch in self._batch_parameter_updates([update]):
+            batch.resolve(self._parameter_management(method='GET', params={'action': 'update', **batch.parameters}))
+        return update
+
+
     def _firmware_management(self, method, params=None, data=None, files=None, mp=None):
         """
         Firmware management API describes how to manage the firmware of the Axis products in order to:
@@ -175,7 +410,7 @@ class VAPIX:
         return self.request(method='POST', url=self.network_settings_cgi, data=data)
 
 
-    def request(self, method, url, headers={'Content-Type': 'application/json'}, params=None, data=None):
+    def request(self, method, url, headers={'Content-Type': 'application/json'}, params=None, data=None, timeout=None):
         """
         Parameters
         ----------
@@ -185,6 +420,8 @@ class VAPIX:
         headers: dict
         params: dict
         data: json
+        timeout: (connect, read) timeouts in seconds, defaults to the static timeout of the client
+            or the timeouts learned for the cgi endpoint
 
         Returns:
         --------
@@ -192,34 +429,90 @@ class VAPIX:
         Content-type: text/xml video/x-matroska
         HTTP code: 200 OK
         Content-disposition: attachment; filename="[YYYYMMDD_HHMMSSMMMM_YYYYMMDD_HHMMSSMMMM.mkv]"
+
+        Raises:
+        -------
+        DeviceUnreachableError if the camera could not be connected to or did not respond in time,
+        CircuitOpenError if the camera has failed to respond repeatedly and MalformedResponseError if the response could not be read.
+        HTTP error responses are returned, use check or parse to raise them.
         """
-        response = None
+        breaker = CircuitBreaker.for_host(urlparse(url).netloc) if self.circuit_breaker else None
+        if breaker:
+            breaker.before_request()
+        endpoint = urlparse(url).path.removeprefix('/axis-cgi/')
         try:
-            response = requests.request(
+            response = self.session.request(
                 method,
                 url,
-                auth=HTTPDigestAuth(self.username, self.password),
+                auth=self.auth,
                 headers=headers,
                 data=data,
                 params=params,
-                timeout=self.timeout
+                timeout=timeout or self.timeout or self.timeouts.timeout(endpoint)
             )
-        except requests.exceptions.ConnectionError:
-            logger.exception(f"[{self.host}] The cgi request failed to connect with exception")
-        except requests.exceptions.Timeout:
-            logger.exception(f"[{self.host}] The cgi request timed out")
-        except Exception:
-            logger.exception(f"[{self.host}] The cgi request failed with exception:")
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            logger.error(f"[{self.host}] The cgi request to {endpoint} failed to reach the camera: {e}")
+            if isinstance(e, requests.exceptions.Timeout):
+                self.timeouts.record_timeout(endpoint)
+            if breaker:
+                breaker.record_failure()
+            raise DeviceUnreachableError(f"{self.name} [{self.host}] -  Camera is unreachable: {e}") from e
+        except (requests.exceptions.ChunkedEncodingError, requests.exceptions.ContentDecodingError) as e:
+            raise MalformedResponseError(f"{self.name} [{self.host}] -  Malformed response from {urlparse(url).path}: {e}") from e
+
+        if breaker:
+            breaker.record_success()
+        # elapsed is measured from sending the (last) request until its response headers were parsed
+        self.timeouts.record(endpoint, response.elapsed.total_seconds())
+        # only requests the camera answered count, so a failed request is not counted as a challenge avoided
+        with self._counter_lock:
+            self.requests += 1
+            if any(r.status_code == 401 for r in [*response.history, response]):
+                self.challenges += 1
         return response
 
 
+    def check(self, response: requests.Response, action: str) -> requests.Response:
+        """ Raises AuthenticationError if the camera rejected the credentials or DeviceError if the request failed """
+        if response.status_code in (401, 403):
+            raise AuthenticationError(f"{self.name} [{self.host}] -  Credentials were rejected (HTTP {response.status_code}) when {action}")
+        if not response.ok:
+            raise DeviceError(f"{self.name} [{self.host}] -  HTTP {response.status_code} when {action}")
+        return response
+
+
+    def parse(self, response: requests.Response, action: str) -> dict:
+        """
+        Returns the result of a VAPIX JSON API response. Raises like check, MalformedResponseError if the response
+        is not JSON and DeviceError if the camera reported an error for the request.
+        """
+        self.check(response, action)
+        try:
+            result = response.json()
+        except ValueError:
+            raise MalformedResponseError(f"{self.name} [{self.host}] -  Malformed response when {action}: {response.text[:200]}")
+        error = result.get('error')
+        if error:
+            raise DeviceError(f"{self.name} [{self.host}] -  Error {error.get('code')} when {action}. {error.get('message')}")
+        return result
+
+
+    def parse_xml(self, response: requests.Response, action: str) -> ElementTree.Element:
+        """ Returns the root element of a VAPIX XML response. Raises like check and MalformedResponseError if the response is not XML """
+        self.check(response, action)
+        try:
+            return ElementTree.fromstring(response.content)
+        except ElementTree.ParseError:
+            raise MalformedResponseError(f"{self.name} [{self.host}] -  Malformed response when {action}: {response.text[:200]}")
+
+
     def _export(self, recording_id):
         """ Use record/export/exportrecording.cgi to export a recording. """
         logger.debug(f"VAPIX [{self.host}] Exporting recording")
-        return requests.get(
+        return self.session.get(
             self.record_export_cgi,
             stream=True,
-            timeout=self.timeout,
+            timeout=self.timeout or DEFAULT_TIMEOUT,
             params={
                 "schemaversion": 1,
                 "recordingid": recording_id,
@@ -227,3 +520,111 @@ class VAPIX:
                 "exportformat": "matroska",
             }
         )
+
+
+    @property
+    def connections(self) -> int:
+        """ The number of TCP connections that have been opened to the camera by the session """
+        adapters = {id(adapter): adapter for adapter in self.session.adapters.values()}.values()
+        return sum(
+            adapter.poolmanager.pools[key].num_connections
+            for adapter in adapters
+            for key in adapter.poolmanager.pools.keys()
+        )
+
+
+    def statistics(self) -> dict:
+        """
+        Returns counters of how many requests the camera answered and how many
+        TCP handshakes and digest authentication challenges were avoided by reusing the session.
+        """
+        connections = self.connections
+        return {
+            'requests': self.requests,
+            'connections': connections,
+            'handshakes_avoided': max(self.requests - connections, 0),
+            'challenges': self.challenges,
+            'challenges_avoided': self.requests - self.challenges,
+        }
+
+
+    def close(self):
+        """ Closes the session and any open connections to the camera """
+        statistics = self.statistics()
+        logger.info(
+            f"VAPIX [{self.host}] {statistics['requests']} requests over {statistics['connections']} connections, "
+            f"avoided {statistics['handshakes_avoided']} TCP handshakes and {statistics['challenges_avoided']} digest challenges"
+        )
+        self.session.close()
+
+
+class AsyncVAPIX(VAPIX):
+    """
+    Asyncio flavour of the VAPIX client with the same endpoint surface, every endpoint method returns an awaitable.
+    e.g. `response = await camera._parameter_management(method='GET', params=params)`
+
+    Requests are executed on a small per camera thread pool sharing the pooled session of the sync client.
+    The size of the pool caps how many requests can be in flight to the camera at once so the device isn't overwhelmed.
+    """
+
+    def __init__(self, name: str, host: str, username: str = None, password: str = None, timeout=None, max_concurrency: int = 4,
+                 timeouts: AdaptiveTimeouts = None, circuit_breaker: bool = True):
+        super().__init__(name, host, username=username, password=password, timeout=timeout, pool_size=max_concurrency,
+                         circuit_breaker=circuit_breaker, timeouts=timeouts)
+        self.max_concurrency = max_concurrency
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix=f'vapix-{name}')
+        self._pending_parameter_updates = []
+        self._parameter_flush = None
+
+
+    async def request(self, method, url, headers={'Content-Type': 'application/json'}, params=None, data=None, timeout=None):
+        """ Performs the cgi request without blocking the event loop. See VAPIX.request """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor,
+            lambda: super(AsyncVAPIX, self).request(method, url, headers=headers, params=params, data=data, timeout=timeout)
+        )
+
+
+    async def update_parameters(self, parameters: dict, owner: str = None) -> ParameterUpdate:
+        """
+        Queues the parameter updates and waits for them to be applied.
+        Updates queued by every caller within PARAMETER_BATCH_WINDOW are coalesced into as few param.cgi requests as possible,
+        the returned update only reports the errors of the parameters requested by this owner.
+        """
+        loop = asyncio.get_running_loop()
+        update = ParameterUpdate(owner, parameters)
+        future = loop.create_future()
+        self._pending_parameter_updates.append((update, future))
+        if self._parameter_flush is None:
+            self._parameter_flush = loop.create_task(self._flush_parameter_updates())
+        return await future
+
+
+    async def _flush_parameter_updates(self):
+        """ Sends all of the queued parameter updates once the batch window has passed """
+        await asyncio.sleep(PARAMETER_BATCH_WINDOW)
+        pending, self._pending_parameter_updates = self._pending_parameter_updates, []
+        self._parameter_flush = None
+
+        try:
+            batches = self._batch_parameter_updates([update for update, _ in pending])
+            logger.debug(f"VAPIX [{self.host}] Flushing {len(pending)} parameter updates in {len(batches)} param.cgi requests")
+            # one after another, a parameter updated more than once is in a later batch and its last update must win
+            for batch in batches:
+                batch.resolve(await self._parameter_management(method='GET', params={'action': 'update', **batch.parameters}))
+        except Exception as e:
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for update, future in pending:
+            if not future.done():
+                future.set_result(update)
+
+
+    def close(self):
+        """ Closes the session and shuts down the request thread pool """
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        super().close()
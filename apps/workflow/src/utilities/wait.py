@@ -0,0 +1,90 @@
+import os
+import time
+import random
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Polls start at the interval and back off by the factor up to the max interval, every delay is randomized by +/- jitter
+DEFAULT_POLL_INTERVAL = 0.5
+DEFAULT_MAX_POLL_INTERVAL = 5.0
+DEFAULT_POLL_BACKOFF = 1.5
+DEFAULT_POLL_JITTER = 0.1
+# The activeDeadlineSeconds of the pod running the step, measured from the start of the process
+STEP_DEADLINE = os.getenv('STEP_DEADLINE_SECONDS')
+STARTED = time.monotonic()
+
+
+def time_left() -> float:
+    """ Returns the seconds left before the pod running the step is killed, or None if its deadline is not known (STEP_DEADLINE_SECONDS) """
+    if not STEP_DEADLINE:
+        return None
+    return float(STEP_DEADLINE) - (time.monotonic() - STARTED)
+
+
+def delays(interval: float = DEFAULT_POLL_INTERVAL, max_interval: float = DEFAULT_MAX_POLL_INTERVAL, backoff: float = DEFAULT_POLL_BACKOFF, jitter: float = DEFAULT_POLL_JITTER):
+    """ Yields the delays between polls, growing from the interval to the max interval """
+    delay = interval
+    while True:
+        yield delay * random.uniform(1 - jitter, 1 + jitter)
+        delay = min(delay * backoff, max_interval)
+
+
+def record(waits: list, name: str, elapsed: float, baseline=None):
+    """
+    Records how long a wait took in the list of waits (kept in the workflow state).
+    The baseline is the fixed delay the wait replaced, in seconds, or a function of the elapsed time that returns it,
+    the difference is recorded as the time the wait saved.
+    """
+    if waits is None:
+        return
+    entry = {'name': name, 'elapsed': round(elapsed, 3)}
+    if baseline is not None:
+        baseline = baseline(elapsed) if callable(baseline) else baseline
+        entry['baseline'] = baseline
+        entry['saved'] = round(baseline - elapsed, 3)
+    waits.append(entry)
+
+
+def poll(predicate, timeout: float, name: str, baseline=None, waits: list = None, **kwargs):
+    """
+    Calls the readiness predicate until it returns a truthy value and returns that value. The first call is made immediately,
+    the following calls are spaced out with adaptive backoff and jitter (see delays for the keyword arguments).
+    An exception is raised if the predicate is not ready within the timeout, provided in seconds.
+    Exceptions raised by the predicate are not retried, predicates should return a falsy value for transient failures.
+    """
+    start_time = time.monotonic()
+    deadline = start_time + timeout
+    for attempt, delay in enumerate(delays(**kwargs), start=1):
+        result = predicate()
+        elapsed = time.monotonic() - start_time
+        if result:
+            logger.info(f"{name} was ready after {elapsed:.1f} seconds and {attempt} polls")
+            record(waits, name, elapsed, baseline)
+            return result
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            record(waits, name, elapsed)
+            raise Exception(f"Timed out after {timeout} seconds waiting for {name}")
+        time.sleep(min(delay, remaining))
+
+
+async def poll_async(predicate, timeout: float, name: str, baseline=None, waits: list = None, **kwargs):
+    """ Awaits the readiness coroutine function until it returns a truthy value and returns that value, see poll """
+    start_time = time.monotonic()
+    deadline = start_time + timeout
+    for attempt, delay in enumerate(delays(**kwargs), start=1):
+        result = await predicate()
+        elapsed = time.monotonic() - start_time
+        if result:
+            logger.info(f"{name} was ready after {elapsed:.1f} seconds and {attempt} polls")
+            record(waits, name, elapsed, baseline)
+            return result
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            record(waits, name, elapsed)
+            raise Exception(f"Timed out after {timeout} seconds waiting for {name}")
+        await asyncio.sleep(min(delay, remaining))